@@ -0,0 +1,172 @@
+import logging
+import math
+from numbers import Number
+
+from pymongo import UpdateOne, ReplaceOne
+
+from coveragedb.settings import COVERAGE_INSERT_BATCH_SIZE
+from coveragedata.error_management import mongo_exception_manager
+from coveragedata.mongo import MongoCollection
+
+
+def numeric_stats(stats):
+    """
+
+    :param stats: the statistics of a transcript
+    :return: the pairs of name and value of the statistics having a numeric value
+    """
+    return [(k, v) for k, v in (stats or {}).items() if isinstance(v, Number) and not isinstance(v, bool)]
+
+
+def _combine(function, a, b):
+    return b if a is None else a if b is None else function(a, b)
+
+
+def add_to_totals(totals, stats):
+    """
+    Adds the statistics of one sample to the running totals of a gene, in the format of the aggregates collection
+    """
+    totals['n'] = totals.get('n', 0) + 1
+    for k, v in numeric_stats(stats):
+        field = totals.setdefault(k, {'sum': 0.0, 'sumsq': 0.0, 'n': 0, 'min': v, 'max': v})
+        field['sum'] += v
+        field['sumsq'] += v * v
+        field['n'] += 1
+        field['min'] = min(field['min'], v)
+        field['max'] = max(field['max'], v)
+
+
+class AggregateManager(object):
+    """
+    Keeps running totals of the statistics of the union transcript of every gene across the samples of a gene
+    collection: sum, sum of squares, count, minimum and maximum of every statistic. Totals are updated when a
+    sample is registered or removed, so aggregate queries read one document per gene and gene collection whatever
+    the number of samples. Minimum and maximum cannot be updated when a sample is removed, then they are flagged
+    as stale until the aggregates are rebuilt.
+
+    Every aggregate lists the versions of the samples it includes in 'members', an update is applied only to the
+    aggregates including or missing the version, so adding or removing a sample again after a failure updates
+    only the genes the failed attempt did not.
+    """
+    aggregate_collection = MongoCollection('gene_aggregates')
+    coverage_collection = MongoCollection('coverage')
+
+    def _union_stats(self, query):
+        return self.coverage_collection.find(query, {'name': 1, 'gcol': 1, 'sample': 1, 'ver': 1,
+                                                     'union_tr.stats': 1, '_id': 0})
+
+    def _bulk_write(self, requests):
+        # ordered, the aggregate of a gene is created before it is updated
+        for i in range(0, len(requests), COVERAGE_INSERT_BATCH_SIZE):
+            self.aggregate_collection.bulk_write(requests[i:i + COVERAGE_INSERT_BATCH_SIZE])
+
+    def _update(self, sample_name, gene_collection, version, sign):
+        requests = []
+        genes = 0
+        member = {'sample': sample_name, 'ver': version}
+        query = {'sample': sample_name, 'gcol': gene_collection, 'ver': version}
+        for document in self._union_stats(query):
+            genes += 1
+            stats = numeric_stats(document['union_tr']['stats'])
+            update = {'$inc': {'n': sign}}
+            for k, v in stats:
+                update['$inc']['stats.{}.sum'.format(k)] = sign * v
+                update['$inc']['stats.{}.sumsq'.format(k)] = sign * v * v
+                update['$inc']['stats.{}.n'.format(k)] = sign
+            gene = {'gcol': gene_collection, 'name': document['name']}
+            if sign > 0:
+                update['$min'] = {'stats.{}.min'.format(k): v for k, v in stats}
+                update['$max'] = {'stats.{}.max'.format(k): v for k, v in stats}
+                update['$push'] = {'members': member}
+                # the aggregate is created first, an upsert filtered by its members would insert it again
+                requests.append(UpdateOne(gene, {'$setOnInsert': {'n': 0, 'members': []}}, upsert=True))
+                requests.append(UpdateOne(dict(gene, members={'$ne': member}), update))
+            else:
+                update['$set'] = {'stale': True}
+                update['$pull'] = {'members': member}
+                requests.append(UpdateOne(dict(gene, members=member), update))
+        self._bulk_write(requests)
+        return genes
+
+    @mongo_exception_manager
+    def add_sample(self, sample_name, gene_collection, version=None):
+        """
+        Adds the coverage of a sample to the aggregates of its genes
+
+        :param version: the version of the coverage of the sample
+        """
+        genes = self._update(sample_name, gene_collection, version, 1)
+        logging.info('Aggregates of {} genes for collection {} include sample {}'.format(
+            genes, gene_collection, sample_name))
+
+    @mongo_exception_manager
+    def remove_sample(self, sample_name, gene_collection, version=None):
+        """
+        Removes the coverage of a sample from the aggregates of its genes, it must be called before the coverage
+        is deleted
+
+        :param version: the version of the coverage of the sample
+        """
+        genes = self._update(sample_name, gene_collection, version, -1)
+        logging.info('Sample {} was removed from the aggregates of {} genes for collection {}'.format(
+            sample_name, genes, gene_collection))
+
+    @mongo_exception_manager
+    def rebuild(self, gene_collection, visible_query):
+        """
+        Computes again the aggregates of a gene collection from its coverage
+
+        :param gene_collection: the gene collection name
+        :param visible_query: a query matching the coverage of the gene collection queries read
+        :return: the number of genes aggregated
+        """
+        totals = {}
+        members = {}
+        for document in self._union_stats(visible_query):
+            add_to_totals(totals.setdefault(document['name'], {}), document['union_tr']['stats'])
+            members.setdefault(document['name'], []).append({'sample': document['sample'],
+                                                             'ver': document.get('ver')})
+        self._bulk_write([ReplaceOne({'gcol': gene_collection, 'name': name},
+                                     {'gcol': gene_collection, 'name': name, 'n': gene_totals.pop('n'),
+                                      'stats': gene_totals, 'stale': False, 'members': members[name]}, upsert=True)
+                          for name, gene_totals in totals.items()])
+        self.aggregate_collection.delete_many({'gcol': gene_collection, 'name': {'$nin': list(totals)}})
+        logging.info('Aggregates of {} genes for collection {} were rebuilt'.format(len(totals), gene_collection))
+        return len(totals)
+
+    @mongo_exception_manager
+    def get_aggregated_by_gene(self, gene_list, gene_collection=None):
+        """
+
+        :param gene_list: the genes of interest
+        :param gene_collection: the gene collection of interest, all of them if None
+        :return: for every gene the number of samples and the mean, standard deviation, minimum and maximum of every
+        statistic of its union transcript
+        """
+        query = {'name': {'$in': gene_list}}
+        if gene_collection is not None:
+            query['gcol'] = gene_collection
+        genes = {}
+        for document in self.aggregate_collection.find(query, {'members': 0}):
+            gene = genes.setdefault(document['name'], {'n': 0, 'stats': {}, 'stale': False})
+            gene['n'] += document.get('n', 0)
+            gene['stale'] = gene['stale'] or document.get('stale', False)
+            for k, field in document.get('stats', {}).items():
+                total = gene['stats'].setdefault(k, {'sum': 0.0, 'sumsq': 0.0, 'n': 0, 'min': None, 'max': None})
+                for key in ('sum', 'sumsq', 'n'):
+                    total[key] += field.get(key, 0)
+                total['min'] = _combine(min, total['min'], field.get('min'))
+                total['max'] = _combine(max, total['max'], field.get('max'))
+        results = []
+        for name, gene in sorted(genes.items()):
+            result = {'_id': name, 'n': gene['n'], 'stale': gene['stale']}
+            for k, total in gene['stats'].items():
+                if total['n'] <= 0:
+                    continue
+                mean = total['sum'] / total['n']
+                result['avg_{}'.format(k)] = mean
+                result['sd_{}'.format(k)] = math.sqrt(max(total['sumsq'] / total['n'] - mean * mean, 0.0))
+                result['min_{}'.format(k)] = total['min']
+                result['max_{}'.format(k)] = total['max']
+            results.append(result)
+        return results
@@ -0,0 +1,178 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from bson import BSON, ObjectId
+from bson.raw_bson import RawBSONDocument
+from pymongo.errors import BulkWriteError
+
+DUPLICATE_KEY_ERROR = 11000
+
+
+class BatchStats(object):
+    __slots__ = ['index', 'documents', 'bytes', 'seconds']
+
+    def __init__(self, index, documents, bytes, seconds):
+        self.index = index
+        self.documents = documents
+        self.bytes = bytes
+        self.seconds = seconds
+
+    def to_json_dict(self):
+        return {k: self.__getattribute__(k) for k in self.__slots__}
+
+
+class BulkWriteStats(object):
+    """
+    Latency and throughput of a bulk write, both per batch and overall
+    """
+
+    def __init__(self):
+        self.batches = []
+        self.seconds = 0.0
+
+    @property
+    def documents(self):
+        return sum(b.documents for b in self.batches)
+
+    @property
+    def bytes(self):
+        return sum(b.bytes for b in self.batches)
+
+    @property
+    def documents_per_second(self):
+        return self.documents / self.seconds if self.seconds else 0.0
+
+    @property
+    def bytes_per_second(self):
+        return self.bytes / self.seconds if self.seconds else 0.0
+
+    def to_json_dict(self):
+        return {'documents': self.documents,
+                'bytes': self.bytes,
+                'seconds': self.seconds,
+                'documents_per_second': self.documents_per_second,
+                'bytes_per_second': self.bytes_per_second,
+                'batches': [b.to_json_dict() for b in self.batches]
+                }
+
+
+class BulkWriter(object):
+    """
+    Inserts a stream of documents in unordered batches sent by a small pool of writer threads, so the next batch
+    is built while the previous ones are on the wire.
+
+    Batches are closed when they reach either `batch_size` documents or `batch_bytes` bytes of BSON. At most
+    `writers` batches are in flight, which bounds memory usage. By default the write is all or nothing: if any
+    batch fails every document inserted by this writer is removed before the error is raised. Otherwise the
+    committed batches are kept and `on_commit` tells how far the write can be resumed from.
+    """
+
+    def __init__(self, collection, batch_size, batch_bytes, writers, all_or_nothing=True, ignore_duplicates=False,
+                 on_commit=None):
+        """
+
+        :param collection: the collection to insert into
+        :param batch_size: the maximum number of documents in a batch
+        :param batch_bytes: the maximum size in bytes of the BSON documents in a batch
+        :param writers: the number of writer threads
+        :param all_or_nothing: removes the inserted documents when the write fails
+        :param ignore_duplicates: considers documents rejected by a unique index as already inserted
+        :param on_commit: called with the number of leading documents of the stream that are stored every time it
+        grows, batches may finish out of order so documents after them may be stored too
+        """
+        self.collection = collection
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+        self.writers = writers
+        self.all_or_nothing = all_or_nothing
+        self.ignore_duplicates = ignore_duplicates
+        self.on_commit = on_commit
+        self._finished = {}
+        self._committed_batches = 0
+        self._committed_documents = 0
+
+    def write(self, documents):
+        """
+
+        :param documents: an iterable of documents, those without `_id` are inserted as a copy with a new one so
+        the documents of the caller are left as they are
+        :return: the statistics of the write
+        """
+        stats = BulkWriteStats()
+        inserted_ids = []
+        pending = set()
+        batch = []
+        batch_bytes = 0
+        submitted = 0
+        self._finished = {}
+        self._committed_batches = 0
+        self._committed_documents = 0
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=self.writers) as executor:
+            try:
+                for document in documents:
+                    if '_id' not in document:
+                        document = dict(document, _id=ObjectId())
+                    inserted_ids.append(document['_id'])
+                    raw = RawBSONDocument(BSON.encode(document))
+                    size = len(raw.raw)
+                    if batch and (len(batch) >= self.batch_size or batch_bytes + size > self.batch_bytes):
+                        if len(pending) >= self.writers:
+                            pending = self._collect(wait(pending, return_when=FIRST_COMPLETED), stats)
+                        pending.add(executor.submit(self._insert, submitted, batch, batch_bytes))
+                        submitted += 1
+                        batch = []
+                        batch_bytes = 0
+                    batch.append(raw)
+                    batch_bytes += size
+                if batch:
+                    pending.add(executor.submit(self._insert, submitted, batch, batch_bytes))
+                self._collect(wait(pending), stats)
+            except Exception:
+                for future in pending:
+                    future.cancel()
+                wait(pending)
+                if self.all_or_nothing:
+                    self._rollback(inserted_ids)
+                raise
+        stats.seconds = time.time() - start
+        logging.info('{} documents ({} bytes) inserted in {} batches in {:.3f} seconds ({:.1f} documents/s)'.format(
+            stats.documents, stats.bytes, len(stats.batches), stats.seconds, stats.documents_per_second))
+        return stats
+
+    def _insert(self, index, batch, batch_bytes):
+        start = time.time()
+        try:
+            self.collection.insert_many(batch, ordered=False)
+        except BulkWriteError as ex:
+            if not self.ignore_duplicates or ex.details.get('writeConcernErrors') or \
+                    any(e['code'] != DUPLICATE_KEY_ERROR for e in ex.details['writeErrors']):
+                raise ex
+            logging.info('{} documents of batch {} were already stored'.format(len(ex.details['writeErrors']), index))
+        batch_stats = BatchStats(index=index, documents=len(batch), bytes=batch_bytes, seconds=time.time() - start)
+        logging.debug('Batch {} of {} documents ({} bytes) inserted in {:.3f} seconds'.format(
+            index, batch_stats.documents, batch_stats.bytes, batch_stats.seconds))
+        return batch_stats
+
+    def _collect(self, done_and_not_done, stats):
+        """
+        Records the finished batches and returns those still in flight, raises the error of any failed batch
+        """
+        done, not_done = done_and_not_done
+        for future in done:
+            batch_stats = future.result()
+            stats.batches.append(batch_stats)
+            self._finished[batch_stats.index] = batch_stats.documents
+        committed_documents = self._committed_documents
+        while self._committed_batches in self._finished:
+            self._committed_documents += self._finished.pop(self._committed_batches)
+            self._committed_batches += 1
+        if self.on_commit is not None and self._committed_documents > committed_documents:
+            self.on_commit(self._committed_documents)
+        return set(not_done)
+
+    def _rollback(self, inserted_ids):
+        logging.error('Bulk write failed, removing {} documents'.format(len(inserted_ids)))
+        for i in range(0, len(inserted_ids), self.batch_size):
+            self.collection.delete_many({'_id': {'$in': inserted_ids[i:i + self.batch_size]}})
@@ -2,4 +2,7 @@
 # TODO: support other optional fields
 STATS_ORDERED_KEYS = ("med", "avg", "gte30x", "pct25", "pct75", "gte15x", "lt15x", "gte50x")
 
-EXON_EXCLUDED_KEYS = ('exon',)
\ No newline at end of file
+EXON_EXCLUDED_KEYS = ('exon',)
+
+# gaps of this length or shorter are not stored
+GAP_MIN_LENGTH = 5
@@ -1,19 +1,132 @@
 import logging
-from pymongo import MongoClient, ASCENDING
+from pymongo import ASCENDING, UpdateOne
 
-from coveragedb.settings import COVERAGE_DB_HOST, COVERAGE_DB
+from coveragedb.settings import COVERAGE_INSERT_BATCH_SIZE, COVERAGE_INSERT_BATCH_BYTES, COVERAGE_INSERT_WRITERS, \
+    COVERAGE_DELETE_BATCH_SIZE
+from coveragedata.aggregate_manager import AggregateManager
+from coveragedata.bulk_writer import BulkWriter
 from coveragedata.error_management import mongo_exception_manager
+from coveragedata.mongo import MongoCollection
+
+# fields of the coverage documents read at every depth of the gene coverage endpoints, everything is read by 'all'
+GENE_FIELDS = {'name': 1, 'sample': 1, 'gcol': 1, '_id': 0}
+COVERAGE_DEPTH_PROJECTIONS = {
+    'union': dict(GENE_FIELDS, **{'union_tr.stats': 1}),
+    'union_exons': dict(GENE_FIELDS, union_tr=1),
+    'stats': dict(GENE_FIELDS, **{'union_tr.stats': 1, 'trs.id': 1, 'trs.stats': 1}),
+    'all': None
+}
+DEFAULT_COVERAGE_DEPTH = 'all'
 
 
 class CoverageManager(object):
-    c = MongoClient(host=COVERAGE_DB_HOST)
-    coverage_db = c[COVERAGE_DB]
-    coverage_collection = coverage_db['coverage']
+    coverage_collection = MongoCollection('coverage')
+    hidden_collection = MongoCollection('hidden_coverage')
+
+    def visible(self, query, samples=None, gene_collection=None):
+        """
+        Restricts a query to the coverage not hidden. The hidden_coverage collection lists the samples being
+        deleted, the versions being ingested and the version shown of the samples whose previous versions are not
+        removed yet, so the filter only grows with the samples changing and not with the size of the cohort.
+
+        :param query: a query over the coverage collection
+        :param samples: the samples the query is restricted to, if known
+        :param gene_collection: the gene collection, or the list of gene collections, the query is restricted to,
+        if known
+        :return: the query matching only visible coverage
+        """
+        hidden_query = {}
+        if samples is not None:
+            hidden_query['sample'] = {'$in': samples}
+        if isinstance(gene_collection, list):
+            hidden_query['gcol'] = {'$in': gene_collection}
+        elif gene_collection is not None:
+            hidden_query['gcol'] = gene_collection
+        clauses = []
+        for hidden in self.hidden_collection.find(hidden_query, {'_id': 0}):
+            clause = {'sample': hidden['sample'], 'gcol': hidden['gcol']}
+            if 'all' not in hidden:
+                clause['ver'] = {'$ne': hidden['shown']} if 'shown' in hidden else {'$in': hidden.get('vers', [])}
+            clauses.append(clause)
+        if not clauses:
+            return query
+        return {'$and': [query, {'$nor': clauses}]}
+
+    @mongo_exception_manager
+    def hide_version(self, sample_name, gene_collection, version):
+        """
+        Hides a version of the coverage of a sample until show_version, it is called before any of it is stored
+        """
+        self.hidden_collection.update_one({'sample': sample_name, 'gcol': gene_collection},
+                                          {'$addToSet': {'vers': version}}, upsert=True)
+
+    @mongo_exception_manager
+    def show_version(self, sample_name, gene_collection, version):
+        """
+        Shows a version of the coverage of a sample once it is registered. Any other version stored is hidden by the
+        same write, so queries never read two versions of a sample, until collect_versions removes it
+
+        :return: whether other versions of the coverage of the sample are stored
+        """
+        query = {'sample': sample_name, 'gcol': gene_collection}
+        others = self.coverage_collection.find_one(dict(query, ver={'$ne': version}), {'_id': 1}) is not None
+        if others:
+            self.hidden_collection.update_one(query, {'$pull': {'vers': version}, '$set': {'shown': version}},
+                                              upsert=True)
+        else:
+            self.hidden_collection.update_one(query, {'$pull': {'vers': version}, '$unset': {'shown': ''}})
+            self._forget_shown(query)
+        return others
+
+    @mongo_exception_manager
+    def forget_versions(self, sample_name, gene_collection, version):
+        """
+        Stops hiding the versions of a sample other than the one shown, once collect_versions removed them
+        """
+        query = {'sample': sample_name, 'gcol': gene_collection}
+        self.hidden_collection.update_one(dict(query, shown=version), {'$unset': {'shown': ''}})
+        self._forget_shown(query)
+
+    def _forget_shown(self, query):
+        self.hidden_collection.delete_one(dict(query, vers={'$in': [None, []]}, shown={'$exists': False},
+                                               all={'$exists': False}))
+
+    @mongo_exception_manager
+    def hide_samples(self, sample_names, gene_collection):
+        """
+        Hides every version of the coverage of the samples, before they are deleted
+        """
+        if not sample_names:
+            return
+        self.hidden_collection.bulk_write([UpdateOne({'sample': name, 'gcol': gene_collection},
+                                                     {'$set': {'all': True}}, upsert=True)
+                                           for name in sample_names], ordered=False)
+
+    @mongo_exception_manager
+    def show_samples(self, sample_names, gene_collection):
+        """
+        Forgets the samples hidden by hide_samples, once their coverage is removed or if their deletion failed
+        """
+        self.hidden_collection.delete_many({'sample': {'$in': sample_names}, 'gcol': gene_collection})
 
     @mongo_exception_manager
-    def add_coverage_data(self, coverage_data):
-        result = self.coverage_collection.insert_many(coverage_data)
-        logging.info('{} gene coverage metrics inserted'.format(len(result.inserted_ids)))
+    def add_coverage_data(self, coverage_data, batch_size=COVERAGE_INSERT_BATCH_SIZE,
+                          batch_bytes=COVERAGE_INSERT_BATCH_BYTES, writers=COVERAGE_INSERT_WRITERS,
+                          all_or_nothing=True, resume=False, on_commit=None):
+        """
+        Inserts the coverage documents in unordered batches
+
+        :param coverage_data: an iterable of coverage documents
+        :param all_or_nothing: if any batch fails none of the documents is kept
+        :param resume: documents already stored by a previous attempt are skipped
+        :param on_commit: called with the number of leading documents stored so far
+        :return: the statistics of the bulk write
+        """
+        writer = BulkWriter(self.coverage_collection, batch_size=batch_size, batch_bytes=batch_bytes, writers=writers,
+                            all_or_nothing=all_or_nothing, ignore_duplicates=resume, on_commit=on_commit)
+        stats = writer.write(coverage_data)
+        logging.info('{} gene coverage metrics inserted'.format(stats.documents))
+        return stats
 
     @mongo_exception_manager
     def remove_coverage_data(self, sample_name, gene_collection):
@@ -23,40 +136,88 @@ class CoverageManager(object):
                      )
 
     @mongo_exception_manager
-    def get_sample_info(self, sample, gene_collection, list_of_genes, last_gene, limit=100):
-        gene_search = {"$in": list_of_genes}
+    def remove_coverage_data_batch(self, sample_name, gene_collection, below_version=None,
+                                   batch_size=COVERAGE_DELETE_BATCH_SIZE):
+        """
+        Removes some of the coverage documents of a sample, so a large sample is removed by many short operations
+
+        :param sample_name: the sample name
+        :param gene_collection: the gene collection name
+        :param below_version: removes only the documents of the versions before this one, including those without
+        a version
+        :param batch_size: the maximum number of documents to remove
+        :return: the number of documents removed, 0 once there are none left
+        """
+        query = {'sample': sample_name, 'gcol': gene_collection}
+        if below_version is not None:
+            query['$or'] = [{'ver': {'$lt': below_version}}, {'ver': None}]
+        ids = [d['_id'] for d in self.coverage_collection.find(query, {'_id': 1}).limit(batch_size)]
+        if not ids:
+            return 0
+        return self.coverage_collection.delete_many({'_id': {'$in': ids}}).deleted_count
+
+    @mongo_exception_manager
+    def get_sample_info(self, sample, gene_collection, list_of_genes, last_gene, limit=100,
+                        depth=DEFAULT_COVERAGE_DEPTH):
+        """
+
+        :param list_of_genes: the genes of interest, all the genes of the sample if None
+        :param limit: the maximum number of genes, all of them if None
+        :param depth: the parts of the genes read, one of COVERAGE_DEPTH_PROJECTIONS
+        """
+        gene_search = {"$in": list_of_genes} if list_of_genes is not None else {}
         if last_gene:
             gene_search['$gt'] = last_gene
+        query = {'sample': sample, 'gcol': gene_collection}
+        if gene_search:
+            query['name'] = gene_search
 
-        result = self.coverage_collection.find({'sample': sample, 'gcol': gene_collection,
-                                                'name': gene_search}
-                                               ).sort('name', ASCENDING).limit(limit)
+        result = self.coverage_collection.find(self.visible(query, [sample], gene_collection),
+                                               COVERAGE_DEPTH_PROJECTIONS[depth]
+                                               ).sort('name', ASCENDING).limit(limit or 0)
         return result
 
     @mongo_exception_manager
-    def get_gene_info(self, sample_list, gene_collection, gene):
-        result = self.coverage_collection.find({'sample': {"$in": sample_list}, 'gcol': gene_collection, 'name': gene})
+    def get_gene_info(self, sample_list, gene_collection, gene, depth=DEFAULT_COVERAGE_DEPTH):
+        """
+
+        :param depth: the parts of the gene read, one of COVERAGE_DEPTH_PROJECTIONS
+        """
+        result = self.coverage_collection.find(self.visible({'gcol': gene_collection, 'name': gene},
+                                                            sample_list, gene_collection),
+                                               COVERAGE_DEPTH_PROJECTIONS[depth])
         return result
 
     @mongo_exception_manager
-    def get_aggregated_by_gene(self, gene_list):
-        query = [
-            {'$match': {'name': {'$in': gene_list}}},
-            {'$group': {
-                '_id': '$name',
-                'avg_med': {'$avg': '$union_tr.stats.med'},
-                'avg_gte15x': {'$avg': '$union_tr.stats.gte15x'},
-                'avg_gte50x': {'$avg': '$union_tr.stats.gte50x'},
-                'avg_avg': {'$avg': '$union_tr.stats.avg'},
-                'avg_pct75': {'$avg': '$union_tr.stats.pct75'},
-                'avg_gte30x': {'$avg': '$union_tr.stats.gte30x'},
-                'avg_pct25': {'$avg': '$union_tr.stats.pct25'},
-                # 'avg_lt15x': {'$avg': '$union_tr.stats.lt15x'},
-            }}
+    def get_union_stats(self, sample_list, gene_collection, gene_list, stats):
+        """
+        Reads only the requested statistics of the union transcript, so a whole cohort is read by a single query
 
-        ]
+        :param sample_list: the samples of interest, all the samples of the gene collection if None
+        :param gene_collection: the gene collection of interest
+        :param gene_list: the genes of interest
+        :param stats: the names of the statistics of interest
+        :return: a cursor of documents with sample, name and the requested union_tr.stats
+        """
+        query = {'gcol': gene_collection, 'name': {'$in': gene_list}}
+        if sample_list is not None:
+            query['sample'] = {'$in': sample_list}
+        projection = {'sample': 1, 'name': 1, '_id': 0}
+        projection.update({'union_tr.stats.{}'.format(k): 1 for k in stats})
+        return self.coverage_collection.find(self.visible(query, sample_list, gene_collection), projection)
+
+    @mongo_exception_manager
+    def get_aggregated_by_gene(self, gene_list, gene_collection=None):
+        """
+        Reads the aggregates maintained on ingestion and deletion, so the cost does not depend on the number of
+        samples
 
-        return self.coverage_collection.aggregate(query)
+        :param gene_list: the genes of interest
+        :param gene_collection: the gene collection of interest, all of them if None
+        :return: for every gene the number of samples and the mean, standard deviation, minimum and maximum of every
+        statistic of its union transcript
+        """
+        return AggregateManager().get_aggregated_by_gene(gene_list, gene_collection)
 
     @mongo_exception_manager
     def get_coverage_by_sample_and_genes(self, sample, gene_list):
@@ -71,7 +232,7 @@ class CoverageManager(object):
             query['name'] = {"$in": gene_list}
         projection = {'union_tr.stats.avg': 1, 'name': 1, 'sample': 1, '_id': 0}
         cursor = self.coverage_collection.find(
-            query,
+            self.visible(query, [sample]),
             projection
         ).sort('name', ASCENDING)
         return cursor
@@ -83,7 +244,7 @@ class CoverageManager(object):
         :param samples: the list of samples to query
         :return: a list of documents where _id is the sample and group is the field gcol without repetitions
         """
-        query = {"$match": {"sample": {"$in": samples}}}
+        query = {"$match": self.visible({}, samples)}
         projection = {"$project": {"gcol": 1, "sample": 1, "_id": 0}}
         group = {"$group": {"_id": "$sample", "group": {"$first": "$gcol"}}}
         results = self.coverage_collection.aggregate([query, projection, group])
@@ -96,7 +257,7 @@ class CoverageManager(object):
         :param group: a group (ie: gcol) of interest
         :return: a list of genes for which there is coverage data in the group
         """
-        group_genes = self.coverage_collection.distinct("name", {"gcol": group})
+        group_genes = self.coverage_collection.distinct("name", self.visible({"gcol": group}, gene_collection=group))
         return group_genes
 
     @mongo_exception_manager
@@ -104,16 +265,20 @@ class CoverageManager(object):
         """
 
         :param groups: the list of groups (ie: gcol) of interest
-        :return: a list of genes for which there is coverage data in all groups
+        :return: a list of genes for which there is coverage data in all groups, sorted by name
         """
-        genes = []
-        for group in groups:
-            group_genes = self.get_genes_by_group(group)
-            if not genes:
-                genes = group_genes
-            else:
-                genes = list(set(genes).intersection(set(group_genes)))
-        return genes
+        groups = sorted(set(groups))
+        if not groups:
+            return []
+        # a single query for all the groups, genes are counted once per group they are covered in
+        results = self.coverage_collection.aggregate([
+            {'$match': self.visible({'gcol': {'$in': groups}}, gene_collection=groups)},
+            {'$group': {'_id': {'name': '$name', 'gcol': '$gcol'}}},
+            {'$group': {'_id': '$_id.name', 'groups': {'$sum': 1}}},
+            {'$match': {'groups': len(groups)}},
+            {'$sort': {'_id': ASCENDING}}
+        ], allowDiskUse=True)
+        return [r['_id'] for r in results]
 
     @mongo_exception_manager
     def get_samples_by_group(self, group):
@@ -122,7 +287,8 @@ class CoverageManager(object):
         :param group: a group (ie: gcol) of interest
         :return: a list of samples belonging to the group
         """
-        group_samples = self.coverage_collection.distinct("sample", {"gcol": group})
+        group_samples = self.coverage_collection.distinct("sample", self.visible({"gcol": group},
+                                                                                gene_collection=group))
         return group_samples
 
     @mongo_exception_manager
@@ -130,9 +296,19 @@ class CoverageManager(object):
         """
 
         :param groups: a list of groups (ie: gcol) of interest
-        :return: a list of samples belonging to the groups
+        :return: a list of samples belonging to the groups, in the order of the groups
         """
+        if not groups:
+            return []
+        by_group = {}
+        results = self.coverage_collection.aggregate([
+            {'$match': self.visible({'gcol': {'$in': list(groups)}}, gene_collection=list(groups))},
+            {'$group': {'_id': {'sample': '$sample', 'gcol': '$gcol'}}},
+            {'$sort': {'_id.sample': ASCENDING}}
+        ], allowDiskUse=True)
+        for result in results:
+            by_group.setdefault(result['_id']['gcol'], []).append(result['_id']['sample'])
         samples = []
         for group in groups:
-            samples += self.get_samples_by_group(group)
+            samples += by_group.get(group, [])
         return samples
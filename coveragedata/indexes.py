@@ -0,0 +1,112 @@
+import datetime
+import logging
+
+import pymongo
+
+COLLECTIONS = (
+    'genes',
+    'samples',
+    'coverage',
+    'gene_aggregates',
+    'hidden_coverage'
+)
+
+# bumped whenever INDEXES or SUPERSEDED_INDEXES change, databases with indexes of an older version are migrated
+#  1: samples unique by name, coverage unique by (sample, name) and an index on the statistics of the union transcript
+#  2: versions in the unique index of the coverage, samples unique by gene collection and name
+#  3: an index for every query of the managers, the index on the statistics is dropped as no query reads it
+#  4: the coverage hidden is listed in its own collection, queries no longer read the samples to hide coverage
+INDEXES_VERSION = 4
+VERSION_COLLECTION = 'schema_versions'
+VERSION_ID = 'indexes'
+
+INDEXES = {
+    'samples': [
+        # samples of a gene collection, read by SampleManager
+        ([('gene_collection', pymongo.ASCENDING), ('name', pymongo.ASCENDING)], {'unique': True})
+    ],
+    'coverage': [
+        # the genes of a sample in order: pages of gene coverage, resumed ingestions and deletions of samples,
+        # every version of a sample is stored next to the others
+        ([('sample', pymongo.ASCENDING), ('gcol', pymongo.ASCENDING), ('name', pymongo.ASCENDING),
+          ('ver', pymongo.ASCENDING)], {'unique': True}),
+        # a gene across the samples of a gene collection: gene details, coverage matrices and the genes or samples
+        # of gene collections
+        ([('gcol', pymongo.ASCENDING), ('name', pymongo.ASCENDING), ('sample', pymongo.ASCENDING),
+          ('ver', pymongo.ASCENDING)], {})
+    ],
+    'gene_aggregates': [
+        ([('gcol', pymongo.ASCENDING), ('name', pymongo.ASCENDING)], {'unique': True}),
+        # aggregates of a gene across gene collections
+        ([('name', pymongo.ASCENDING)], {})
+    ],
+    'hidden_coverage': [
+        # the coverage hidden of some samples, whatever their gene collection
+        ([('sample', pymongo.ASCENDING), ('gcol', pymongo.ASCENDING)], {'unique': True}),
+        # the coverage hidden of gene collections
+        ([('gcol', pymongo.ASCENDING)], {})
+    ]
+}
+
+# indexes replaced by those above, either they reject documents now valid or no query reads them
+SUPERSEDED_INDEXES = {
+    'samples': [
+        # unique by name in the baseline, it rejects a sample registered in a second gene collection
+        'name_1',
+        # read to hide the coverage of the samples not registered before hidden_coverage
+        'name_1_gene_collection_1'
+    ],
+    'coverage': [
+        # unique by (sample, name) in the baseline, it rejects the coverage of a sample in a second gene collection
+        # and it is stricter than the unique index resumed ingestions rely on
+        'sample_1_name_1',
+        # unique by (sample, gcol, name) before versions, it rejects the coverage of a replacing version
+        'sample_1_gcol_1_name_1',
+        'stats'
+    ]
+}
+
+
+def get_indexes_version(database):
+    """
+
+    :param database: the coverage database
+    :return: the version of the indexes of the database, 0 if they were never migrated
+    """
+    document = database[VERSION_COLLECTION].find_one({'_id': VERSION_ID})
+    return document['version'] if document is not None else 0
+
+
+def migrate_indexes(database, force=False):
+    """
+    Creates the collections and indexes missing and then drops the superseded indexes, so queries are served by
+    an index all along. Nothing is done if the indexes of the database are at INDEXES_VERSION already.
+
+    :param database: the coverage database
+    :param force: migrates the indexes whatever their version
+    :return: the version of the indexes before the migration
+    """
+    version = get_indexes_version(database)
+    if version >= INDEXES_VERSION and not force:
+        logging.info('Indexes are at version {} already'.format(version))
+        return version
+    logging.info('Migrating indexes from version {} to {}'.format(version, INDEXES_VERSION))
+    available = database.list_collection_names()
+    for collection in COLLECTIONS:
+        if collection not in available:
+            logging.info('Creating {} collection'.format(collection))
+            database.create_collection(name=collection)
+    for collection, indexes in INDEXES.items():
+        for keys, options in indexes:
+            logging.info('Creating index "{}" with parameters "{}" on {}'.format(keys, options, collection))
+            database[collection].create_index(keys, **options)
+        existing = database[collection].index_information()
+        for name in SUPERSEDED_INDEXES.get(collection, []):
+            if name in existing:
+                logging.info('Dropping index "{}" of {}'.format(name, collection))
+                database[collection].drop_index(name)
+    database[VERSION_COLLECTION].replace_one({'_id': VERSION_ID},
+                                             {'_id': VERSION_ID, 'version': INDEXES_VERSION,
+                                              'migrated': datetime.datetime.utcnow()},
+                                             upsert=True)
+    return version
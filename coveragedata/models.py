@@ -1,5 +1,9 @@
+import json
+import math
+
 from coveragedata.constants import STATS_ORDERED_KEYS
-from coveragedata.coverage_manager import CoverageManager
+from coveragedata.coverage_manager import CoverageManager, DEFAULT_COVERAGE_DEPTH
+from coveragedata.packing import unpack_exons, PACKED_EXONS_KEY
 
 
 class Stats(object):
@@ -29,6 +33,94 @@ class Stats(object):
         return {k: self.__getattribute__(k) for k in self.__slots__}
 
 
+# the serialisation of Stats, built straight from the stored statistics
+STATS_FIELDS = tuple(k for k in Stats.__slots__ if k != 'other_stats')
+EMPTY_STATS = dict.fromkeys(STATS_FIELDS)
+
+
+def stats_json(stats):
+    """
+    Same as `Stats(**stats).to_json_dict()`
+    """
+    result = dict(EMPTY_STATS)
+    other_stats = {}
+    for k, v in stats.items():
+        if k in result:
+            result[k] = v
+        if k not in STATS_ORDERED_KEYS:
+            other_stats[k] = v
+    result['other_stats'] = other_stats
+    return result
+
+
+def exon_json(exon):
+    """
+    Same as `ExonCoverage(**exon).to_json_dict()`, the array of statistics is keyed by STATS_ORDERED_KEYS
+    """
+    stats = dict(EMPTY_STATS)
+    stats.update(zip(STATS_ORDERED_KEYS, exon['stats']))
+    stats['other_stats'] = {}
+    return {'s': exon.get('s', None), 'e': exon.get('e', None), 'stats': stats, 'gaps': exon.get('gaps', None)}
+
+
+def transcript_json(transcript):
+    """
+    Same as `TranscriptCoverage(**transcript).to_json_dict()`
+    """
+    result = {}
+    if PACKED_EXONS_KEY in transcript:
+        result['exons'] = [exon_json(e) for e in unpack_exons(transcript[PACKED_EXONS_KEY])]
+    elif 'exons' in transcript:
+        result['exons'] = [exon_json(e) for e in transcript['exons']]
+    result['name'] = transcript.get('id', None)
+    result['stats'] = stats_json(transcript['stats'])
+    return result
+
+
+# the same JSON text as rendered by the REST framework
+encode_json = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'), allow_nan=False).encode
+
+# the JSON text of the stats of an exon, the array of statistics is formatted in the order of STATS_FIELDS
+EXON_STATS_KEYS = tuple(k for k in STATS_FIELDS if k in STATS_ORDERED_KEYS)
+EXON_STATS_TEXT = '{' + ','.join('"{}":{}'.format(k, '%s' if k in STATS_ORDERED_KEYS else 'null')
+                                 for k in STATS_FIELDS) + ',"other_stats":{}}'
+EXON_TEXT = '{"s":%s,"e":%s,"stats":' + EXON_STATS_TEXT + ',"gaps":%s}'
+
+
+def _value_text(value):
+    return 'null' if value is None else encode_json(value)
+
+
+def exon_json_text(exon):
+    """
+    Same as `encode_json(exon_json(exon))`, finite numbers are formatted straight into a template as the encoder
+    does, anything else goes through the encoder
+    """
+    stats = dict(zip(STATS_ORDERED_KEYS, exon['stats']))
+    values = tuple(stats.get(k) for k in EXON_STATS_KEYS)
+    gaps = exon.get('gaps', None)
+    if None not in values and all(map(math.isfinite, values)) and 's' in exon and 'e' in exon and gaps is not None:
+        return EXON_TEXT % ((exon['s'], exon['e']) + values +
+                            ('[' + ','.join(['[%s,%s]' % (g[0], g[1]) for g in gaps]) + ']',))
+    return '{"s":' + _value_text(exon.get('s', None)) + ',"e":' + _value_text(exon.get('e', None)) + \
+           ',"stats":' + EXON_STATS_TEXT % tuple(_value_text(v) for v in values) + ',"gaps":' + _value_text(gaps) + '}'
+
+
+def transcript_json_text(transcript):
+    """
+    Same as `encode_json(transcript_json(transcript))`
+    """
+    parts = ['{']
+    exons = transcript.get('exons', None)
+    if PACKED_EXONS_KEY in transcript:
+        exons = unpack_exons(transcript[PACKED_EXONS_KEY])
+    if exons is not None:
+        parts.append('"exons":[' + ','.join([exon_json_text(e) for e in exons]) + '],')
+    parts.extend(['"name":', _value_text(transcript.get('id', None)),
+                  ',"stats":', encode_json(stats_json(transcript['stats'])), '}'])
+    return ''.join(parts)
+
+
 class ExonCoverage(object):
     __slots__ = ['s', 'e', 'stats', 'gaps']
 
@@ -44,62 +136,167 @@ class ExonCoverage(object):
 
 
 class TranscriptCoverage(object):
-    __slots__ = ['name', 'exons', 'stats']
+    __slots__ = ['name', '_exons', '_packed_exons', 'stats']
 
     def __init__(self, **kwargs):
         self.name = kwargs.get('id', None)
-        self.exons = [ExonCoverage(**e) for e in kwargs.get('exons', None)]
+        self._packed_exons = kwargs.get(PACKED_EXONS_KEY, None)
+        self._exons = None
+        if self._packed_exons is None and 'exons' in kwargs:
+            self._exons = [ExonCoverage(**e) for e in kwargs['exons']]
         self.stats = Stats(**kwargs.get('stats', None))
 
+    @property
+    def exons(self):
+        """
+        The exons of the transcript, None if they were not read
+        """
+        # packed exons are decoded the first time they are needed
+        if self._exons is None and self._packed_exons is not None:
+            self._exons = [ExonCoverage(**e) for e in unpack_exons(self._packed_exons)]
+        return self._exons
+
     def to_json_dict(self):
-        return {'exons': [e.to_json_dict() for e in self.exons],
-                'name': self.name,
-                'stats': self.stats.to_json_dict()
-                }
+        result = {}
+        if self.exons is not None:
+            result['exons'] = [e.to_json_dict() for e in self.exons]
+        result['name'] = self.name
+        result['stats'] = self.stats.to_json_dict()
+        return result
 
 
 class GeneCoverage(object):
-    __slots__ = [
-        'name', 'union_transcript', 'gen_collection', 'transcripts',
-        'sample'
-    ]
+    """
+    Coverage of a gene over its document, either a dict or a RawBSONDocument. Transcripts are only built when they
+    are accessed and `to_json_dict` reads the document directly, without building any intermediate object. A raw
+    document is decoded one level at a time as it is read, which pays off when only part of it is read
+    """
+    __slots__ = ['_document', '_union_transcript', '_transcripts']
 
-    def __init__(self, **kwargs):
-        self.name = kwargs.get('name', None)
-        self.union_transcript = TranscriptCoverage(**kwargs.get('union_tr', None))
-        self.gen_collection = kwargs.get('gcol', None)
-        self.transcripts = [TranscriptCoverage(**t) for t in kwargs.get('trs', None)]
-        self.sample = kwargs.get('sample', None)
+    def __init__(self, document=None, **kwargs):
+        self._document = document if document is not None else kwargs
+        self._union_transcript = None
+        self._transcripts = None
+
+    @property
+    def name(self):
+        return self._document.get('name', None)
+
+    @property
+    def gen_collection(self):
+        return self._document.get('gcol', None)
+
+    @property
+    def sample(self):
+        return self._document.get('sample', None)
+
+    @property
+    def union_transcript(self):
+        if self._union_transcript is None:
+            self._union_transcript = TranscriptCoverage(**self._document['union_tr'])
+        return self._union_transcript
+
+    @property
+    def transcripts(self):
+        """
+        The transcripts of the gene, None if they were not read
+        """
+        if self._transcripts is None and 'trs' in self._document:
+            self._transcripts = [TranscriptCoverage(**t) for t in self._document['trs']]
+        return self._transcripts
 
     @classmethod
-    def get(cls, gene_name, gene_collection, sample):
+    def get(cls, gene_name, gene_collection, sample, depth=DEFAULT_COVERAGE_DEPTH):
         """
 
         :type sample: str
         :type gene_name: str
+        :param depth: the parts of the gene read, one of COVERAGE_DEPTH_PROJECTIONS
         """
 
         cm = CoverageManager()
-        result = cm.get_gene_info(sample, gene_collection, gene_name)
-        if result.count() > 0:
-            return cls(**result.next())
+        result = next(cm.get_gene_info(sample, gene_collection, gene_name, depth).limit(1), None)
+        if result is not None:
+            return cls(result)
         else:
             return None
 
     @classmethod
-    def list(cls, sample, gene_list, gene_collection, last_gene=None, limit=None):
+    def list(cls, sample, gene_list, gene_collection, last_gene=None, limit=None, depth=DEFAULT_COVERAGE_DEPTH):
         cm = CoverageManager()
-        results = cm.get_sample_info(sample, gene_collection, gene_list, last_gene, limit)
+        results = cm.get_sample_info(sample, gene_collection, gene_list, last_gene, limit, depth)
         if results is not None:
             for r in results:
-                yield cls(**r)
+                yield cls(r)
         else:
             return None
 
     def to_json_dict(self):
-        return {'name': self.name,
-                'union_transcript': self.union_transcript.to_json_dict(),
-                'gen_collection': self.gen_collection,
-                'transcripts': [t.to_json_dict() for t in self.transcripts],
-                'sample': self.sample
+        document = self._document
+        result = {'name': document.get('name', None),
+                  'union_transcript': transcript_json(document['union_tr']),
+                  'gen_collection': document.get('gcol', None)
+                  }
+        if 'trs' in document:
+            result['transcripts'] = [transcript_json(t) for t in document['trs']]
+        result['sample'] = document.get('sample', None)
+        return result
+
+    def to_json_text(self):
+        """
+        Same as `encode_json(self.to_json_dict())` written straight from the document
+        """
+        document = self._document
+        parts = ['{"name":', _value_text(document.get('name', None)),
+                 ',"union_transcript":', transcript_json_text(document['union_tr']),
+                 ',"gen_collection":', _value_text(document.get('gcol', None))]
+        if 'trs' in document:
+            parts.append(',"transcripts":[' + ','.join([transcript_json_text(t) for t in document['trs']]) + ']')
+        parts.extend([',"sample":', _value_text(document.get('sample', None)), '}'])
+        return ''.join(parts)
+
+
+class CoverageMatrix(object):
+    """
+    Dense matrix of statistics of the union transcript, one row per sample and one column per gene for every
+    statistic. Missing values, genes not covered in a sample or statistics not computed, are None
+    """
+    __slots__ = ['samples', 'genes', 'stats', 'values']
+
+    def __init__(self, samples, genes, stats, documents):
+        """
+
+        :param samples: the row labels, the samples found in the documents sorted by name if None
+        :param genes: the column labels
+        :param stats: the names of the statistics
+        :param documents: the documents with sample, name and union_tr.stats
+        """
+        documents = list(documents)
+        if samples is None:
+            samples = sorted({d['sample'] for d in documents})
+        self.samples = list(samples)
+        self.genes = list(genes)
+        self.stats = list(stats)
+        rows = {s: i for i, s in enumerate(self.samples)}
+        columns = {g: j for j, g in enumerate(self.genes)}
+        self.values = [[[None] * len(self.genes) for _ in self.samples] for _ in self.stats]
+        for document in documents:
+            i = rows.get(document['sample'])
+            j = columns.get(document['name'])
+            if i is None or j is None:
+                continue
+            stats = document.get('union_tr', {}).get('stats', {})
+            for k, stat in enumerate(self.stats):
+                self.values[k][i][j] = stats.get(stat)
+
+    @classmethod
+    def get(cls, sample_list, gene_collection, gene_list, stats):
+        cm = CoverageManager()
+        return cls(sample_list, gene_list, stats, cm.get_union_stats(sample_list, gene_collection, gene_list, stats))
+
+    def to_json_dict(self):
+        return {'samples': self.samples,
+                'genes': self.genes,
+                'stats': self.stats,
+                'values': self.values
                 }
@@ -0,0 +1,175 @@
+import logging
+import os
+import threading
+
+from pymongo import MongoClient, monitoring
+
+from coveragedb.settings import COVERAGE_DB_HOST, COVERAGE_DB, COVERAGE_DB_MAX_POOL_SIZE, COVERAGE_DB_MIN_POOL_SIZE, \
+    COVERAGE_DB_MAX_IDLE_TIME_MS, COVERAGE_DB_CONNECT_TIMEOUT_MS, COVERAGE_DB_SOCKET_TIMEOUT_MS, \
+    COVERAGE_DB_SERVER_SELECTION_TIMEOUT_MS, COVERAGE_DB_WAIT_QUEUE_TIMEOUT_MS, COVERAGE_DB_READ_PREFERENCE, \
+    COVERAGE_DB_WRITE_CONCERN, COVERAGE_DB_COMPRESSORS
+
+
+def client_options():
+    """
+
+    :return: the options of the MongoDB client from the settings, those not set are left to pymongo
+    """
+    options = {'maxPoolSize': COVERAGE_DB_MAX_POOL_SIZE,
+               'minPoolSize': COVERAGE_DB_MIN_POOL_SIZE,
+               'connectTimeoutMS': COVERAGE_DB_CONNECT_TIMEOUT_MS,
+               'serverSelectionTimeoutMS': COVERAGE_DB_SERVER_SELECTION_TIMEOUT_MS,
+               'readPreference': COVERAGE_DB_READ_PREFERENCE
+               }
+    for option, value in (('maxIdleTimeMS', COVERAGE_DB_MAX_IDLE_TIME_MS),
+                          ('socketTimeoutMS', COVERAGE_DB_SOCKET_TIMEOUT_MS),
+                          ('waitQueueTimeoutMS', COVERAGE_DB_WAIT_QUEUE_TIMEOUT_MS)):
+        if value:
+            options[option] = int(value)
+    if COVERAGE_DB_WRITE_CONCERN:
+        options['w'] = int(COVERAGE_DB_WRITE_CONCERN) if COVERAGE_DB_WRITE_CONCERN.isdigit() \
+            else COVERAGE_DB_WRITE_CONCERN
+    if COVERAGE_DB_COMPRESSORS:
+        options['compressors'] = COVERAGE_DB_COMPRESSORS
+    return options
+
+
+class PoolStatistics(monitoring.ConnectionPoolListener):
+    """
+    Counts the connections of the pools of a client as they are opened, checked out, checked in and closed
+    """
+    COUNTERS = ('connections_created', 'connections_closed', 'checkouts', 'checkout_failures', 'pools_cleared')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.open = 0
+        self.in_use = 0
+        self.max_in_use = 0
+        self.counters = dict.fromkeys(self.COUNTERS, 0)
+
+    def _count(self, counter):
+        with self._lock:
+            self.counters[counter] += 1
+
+    def connection_created(self, event):
+        with self._lock:
+            self.open += 1
+            self.counters['connections_created'] += 1
+
+    def connection_closed(self, event):
+        with self._lock:
+            self.open -= 1
+            self.counters['connections_closed'] += 1
+
+    def connection_checked_out(self, event):
+        with self._lock:
+            self.in_use += 1
+            self.max_in_use = max(self.max_in_use, self.in_use)
+            self.counters['checkouts'] += 1
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self.in_use -= 1
+
+    def connection_check_out_failed(self, event):
+        self._count('checkout_failures')
+
+    def pool_cleared(self, event):
+        self._count('pools_cleared')
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def to_json_dict(self):
+        with self._lock:
+            result = {'open': self.open, 'in_use': self.in_use, 'max_in_use': self.max_in_use}
+            result.update(self.counters)
+        return result
+
+
+class MongoClientRegistry(object):
+    """
+    Holds the MongoDB client of the process. The client is created the first time it is used, so importing the
+    managers does not connect, and it is created again in a child process after a fork, so connections opened
+    before the fork are never shared
+    """
+
+    def __init__(self, host=COVERAGE_DB_HOST, database=COVERAGE_DB, **options):
+        """
+
+        :param options: the options of the client, those from the settings if not given
+        """
+        self.host = host
+        self.database_name = database
+        self.options = options or client_options()
+        self._client = None
+        self._pid = None
+        self._statistics = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        if self._client is None or self._pid != os.getpid():
+            with self._lock:
+                if self._client is None or self._pid != os.getpid():
+                    # the client inherited from the parent process is dropped, not closed, as its sockets are
+                    # still in use by the parent
+                    self._statistics = PoolStatistics()
+                    self._client = MongoClient(host=self.host, event_listeners=[self._statistics], **self.options)
+                    self._pid = os.getpid()
+                    logging.info('Connecting to {} from process {}'.format(self.host, self._pid))
+        return self._client
+
+    @property
+    def database(self):
+        return self.client[self.database_name]
+
+    def collection(self, name):
+        return self.database[name]
+
+    def close(self):
+        with self._lock:
+            if self._client is not None and self._pid == os.getpid():
+                self._client.close()
+            self._client = None
+
+    def stats(self):
+        """
+
+        :return: the options of the client and the usage of its connection pools in this process
+        """
+        connected = self._client is not None and self._pid == os.getpid()
+        return {'pid': os.getpid(),
+                'connected': connected,
+                'options': {k: v for k, v in self.options.items()},
+                'pool': self._statistics.to_json_dict() if connected else None
+                }
+
+
+class MongoCollection(object):
+    """
+    A collection of the coverage database as a class attribute of a manager, it is looked up in the registry on
+    every access so it always belongs to the client of the current process
+    """
+
+    def __init__(self, name, registry=None):
+        self.name = name
+        self.registry = registry
+
+    def __get__(self, instance, owner):
+        return (self.registry or mongo_clients).collection(self.name)
+
+
+mongo_clients = MongoClientRegistry()
@@ -0,0 +1,157 @@
+"""
+Compact encoding of the exons of a transcript. Instead of one sub-document per exon, the starts, ends, statistics
+and gaps of all the exons are stored as little endian typed arrays: int32 for positions and, for every statistic,
+int32 if all its values are integers, float32 if they all survive the round trip through float32 or float64
+otherwise. Gaps are stored as a flat array of (start, end) pairs plus the offset of the first gap of every exon.
+Exons with a statistic mixing integers and floats, or integers out of the int32 range, are not packed, so unpacked
+exons always equal the original ones, types included.
+"""
+import math
+import sys
+from array import array
+
+from bson.binary import Binary
+
+from coveragedata.constants import STATS_ORDERED_KEYS
+
+COVERAGE_SCHEMA_VERSION = 1
+
+PACKED_COVERAGE_SCHEMA_VERSION = 2
+
+PACKED_EXONS_KEY = 'exb'
+
+# float32 holds about 7 significant digits, decoded values are rounded to 6 to drop the float32 noise
+STATS_SIGNIFICANT_DIGITS = '%.6g'
+
+# the typed array of the statistics stored with every typecode
+STATS_ARRAYS = {'i': 'si', 'f': 'st', 'd': 'sd'}
+
+# missing integer statistics, int32 has no NaN
+INT32_NONE = -2 ** 31
+INT32_MAX = 2 ** 31 - 1
+
+
+def _to_binary(values):
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return Binary(values.tobytes())
+
+
+def _from_binary(typecode, data):
+    values = array(typecode)
+    values.frombytes(bytes(data))
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+
+def _decode_stat(value):
+    return None if math.isnan(value) else float(STATS_SIGNIFICANT_DIGITS % value)
+
+
+def _decode_int_stat(value):
+    return None if value == INT32_NONE else value
+
+
+def _decode_double_stat(value):
+    return None if math.isnan(value) else value
+
+
+DECODERS = {'i': _decode_int_stat, 'f': _decode_stat, 'd': _decode_double_stat}
+
+
+def _stat_typecode(values):
+    """
+
+    :param values: the values of a statistic in every exon
+    :return: the typecode of the array storing them exactly, None if there is none
+    """
+    values = [v for v in values if v is not None]
+    if values and all(type(v) is int and INT32_NONE < v <= INT32_MAX for v in values):
+        return 'i'
+    if all(type(v) is float for v in values):
+        # values out of the range of float32 become infinite and are stored as float64 too
+        return 'f' if [_decode_stat(v) for v in array('f', values)] == values else 'd'
+    return None
+
+
+def pack_exons(exons):
+    """
+
+    :param exons: a list of minimized exons, ie: with stats as a list ordered by STATS_ORDERED_KEYS
+    :return: a sub-document with the packed exons
+    :raises ValueError: if any statistic cannot be stored exactly
+    """
+    gaps = array('i')
+    gap_offsets = array('i', [0])
+    for exon in exons:
+        for gap in exon['gaps']:
+            gaps.extend(gap)
+        gap_offsets.append(len(gaps) // 2)
+    typecodes = [_stat_typecode(column) for column in zip(*[exon['stats'] for exon in exons])]
+    if None in typecodes:
+        raise ValueError('Statistics mixing integers and floats or out of the int32 range cannot be packed')
+    stats = {typecode: array(typecode) for typecode in STATS_ARRAYS}
+    for exon in exons:
+        for typecode, value in zip(typecodes, exon['stats']):
+            if value is None:
+                value = INT32_NONE if typecode == 'i' else float('nan')
+            stats[typecode].append(value)
+    packed = {'n': len(exons),
+              'k': len(STATS_ORDERED_KEYS),
+              's': _to_binary(array('i', [exon['s'] for exon in exons])),
+              'e': _to_binary(array('i', [exon['e'] for exon in exons])),
+              'sc': ''.join(typecodes),
+              'go': _to_binary(gap_offsets),
+              'g': _to_binary(gaps)
+              }
+    for typecode, key in STATS_ARRAYS.items():
+        if stats[typecode]:
+            packed[key] = _to_binary(stats[typecode])
+    return packed
+
+
+def unpack_exons(packed):
+    """
+
+    :param packed: a sub-document created by `pack_exons`
+    :return: the list of exons as stored in the uncompressed format
+    """
+    starts = _from_binary('i', packed['s'])
+    ends = _from_binary('i', packed['e'])
+    k = packed['k']
+    typecodes = packed['sc']
+    columns = {typecode: iter([DECODERS[typecode](v) for v in _from_binary(typecode, packed[key])])
+               for typecode, key in STATS_ARRAYS.items() if key in packed}
+    stats = [next(columns[typecode]) for _ in range(packed['n']) for typecode in typecodes]
+    gap_offsets = _from_binary('i', packed['go'])
+    gaps = _from_binary('i', packed['g'])
+    return [{'s': starts[i],
+             'e': ends[i],
+             'stats': stats[i * k:(i + 1) * k],
+             'gaps': [[gaps[2 * j], gaps[2 * j + 1]] for j in range(gap_offsets[i], gap_offsets[i + 1])]
+             } for i in range(packed['n'])]
+
+
+def pack_transcript(transcript):
+    try:
+        packed_exons = pack_exons(transcript['exons'])
+    except ValueError:
+        # kept as they are, the exons of every transcript are read in the format they are stored in
+        return transcript
+    packed = {k: v for k, v in transcript.items() if k != 'exons'}
+    packed[PACKED_EXONS_KEY] = packed_exons
+    return packed
+
+
+def pack_gene(gene):
+    """
+
+    :param gene: a minimized gene
+    :return: the gene with the exons of the union transcript and every transcript packed
+    """
+    packed = {k: v for k, v in gene.items() if k not in ('union_tr', 'trs')}
+    packed['union_tr'] = pack_transcript(gene['union_tr'])
+    packed['trs'] = [pack_transcript(t) for t in gene['trs']]
+    packed['v'] = PACKED_COVERAGE_SCHEMA_VERSION
+    return packed
@@ -1,27 +1,39 @@
 import logging
-from pymongo import MongoClient, ASCENDING
+from bson import ObjectId
+from pymongo import ASCENDING
 
-from coveragedb.settings import COVERAGE_DB_HOST, COVERAGE_DB
 from coveragedata.error_management import mongo_exception_manager
+from coveragedata.mongo import MongoCollection
 
 
 class SampleManager(object):
-    c = MongoClient(host=COVERAGE_DB_HOST)
-    coverage_db = c[COVERAGE_DB]
-    sample_collection = coverage_db['samples']
+    sample_collection = MongoCollection('samples')
 
     def check(self):
         print("".join([s for s in self.sample_collection.list_indexes()]))
 
     @mongo_exception_manager
-    def add_sample(self, sample_name, number_of_genes, parameters, coding_region, whole_genome, gene_collection):
-        self.sample_collection.insert_one({'name': sample_name,
-                                           'nog': number_of_genes,
-                                           'parameters': parameters,
-                                           'coding_region': coding_region,
-                                           'whole_genome': whole_genome,
-                                           'gene_collection': gene_collection
-                                           })
+    def add_sample(self, sample_name, number_of_genes, parameters, coding_region, whole_genome, gene_collection,
+                   version=None):
+        """
+        Registers a sample, replacing any previous registration. Coverage queries only read the version of the
+        coverage of the registered sample, so this switches them to the new version at once. Every registration
+        gets a new token, which tells cached responses apart.
+
+        :param version: the version of the coverage of the sample
+        """
+        sample = {'name': sample_name,
+                  'nog': number_of_genes,
+                  'parameters': parameters,
+                  'coding_region': coding_region,
+                  'whole_genome': whole_genome,
+                  'gene_collection': gene_collection,
+                  'reg': ObjectId()
+                  }
+        if version is not None:
+            sample['ver'] = version
+        self.sample_collection.replace_one({'name': sample_name, 'gene_collection': gene_collection}, sample,
+                                           upsert=True)
         logging.info('Sample {} for collection {} was added'.format(sample_name, gene_collection))
 
     @mongo_exception_manager
@@ -29,13 +41,49 @@ class SampleManager(object):
         self.sample_collection.delete_one({'name': sample_name, 'gene_collection': gene_collection})
         logging.info('Sample {} for collection {} was removed'.format(sample_name, gene_collection))
 
+    @mongo_exception_manager
+    def get_versions(self, sample_names, gene_collection):
+        """
+
+        :param sample_names: the names of the samples
+        :param gene_collection: the gene collection name
+        :return: the version of the coverage of every registered sample, None for samples registered without one
+        """
+        return {s['name']: s.get('ver') for s in self.sample_collection.find(
+            {'name': {'$in': sample_names}, 'gene_collection': gene_collection}, {'name': 1, 'ver': 1, '_id': 0})}
+
+    @mongo_exception_manager
+    def get_registrations(self, sample_names, gene_collection):
+        """
+        Reads what identifies the data of the samples, it changes whenever their data changes
+
+        :param sample_names: the names of the samples
+        :param gene_collection: the gene collection name
+        :return: the registration token of every registered sample, samples registered before tokens existed are
+        identified by their version
+        """
+        return {s['name']: str(s['reg']) if 'reg' in s else 'v{}'.format(s.get('ver')) for s in
+                self.sample_collection.find({'name': {'$in': sample_names}, 'gene_collection': gene_collection},
+                                            {'name': 1, 'reg': 1, 'ver': 1, '_id': 0})}
+
+    @mongo_exception_manager
+    def remove_samples(self, sample_names, gene_collection):
+        """
+        Removes many samples at once, their coverage is hidden straight away
+
+        :param sample_names: the names of the samples
+        :param gene_collection: the gene collection name
+        """
+        result = self.sample_collection.delete_many({'name': {'$in': sample_names}, 'gene_collection': gene_collection})
+        logging.info('{} samples for collection {} were removed'.format(result.deleted_count, gene_collection))
+
     @mongo_exception_manager
     def get_sample_info(self, sample_list, gene_collection, last_sample=None, limit=100):
         sample_search = {"$in": sample_list}
         if last_sample:
             sample_search['$gt'] = last_sample
 
-        result = self.sample_collection.find({'gene_collection': gene_collection, 'name': sample_search}
-                                             ).sort('name', ASCENDING).limit(limit)
+        result = self.sample_collection.find({'gene_collection': gene_collection, 'name': sample_search},
+                                             {'reg': 0}).sort('name', ASCENDING).limit(limit)
         return result
 
@@ -0,0 +1,571 @@
+import copy
+import os
+import threading
+from unittest import SkipTest
+
+from bson.son import SON
+from django.test import TestCase
+from mock import patch, Mock
+from pymongo import ASCENDING, DeleteMany, DeleteOne, ReplaceOne, UpdateMany, UpdateOne
+from pymongo.errors import BulkWriteError, ConnectionFailure, PyMongoError
+
+from coveragedb.settings import COVERAGE_DB
+from coveragedata.aggregate_manager import AggregateManager, add_to_totals
+from coveragedata.bulk_writer import BulkWriter
+from coveragedata.coverage_manager import CoverageManager
+from coveragedata.indexes import INDEXES, INDEXES_VERSION, migrate_indexes
+from coveragedata.mongo import MongoClientRegistry, MongoCollection, PoolStatistics
+from coveragedata.sample_manager import SampleManager
+
+
+class TestMongoClientRegistry(TestCase):
+
+    def setUp(self):
+        patcher = patch('coveragedata.mongo.MongoClient')
+        self.mongo_client = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.registry = MongoClientRegistry(host='mongodb://localhost', database='test', maxPoolSize=5)
+
+    def test_lazy(self):
+        self.assertFalse(self.registry.stats()['connected'])
+        self.mongo_client.assert_not_called()
+        self.registry.collection('samples')
+        self.registry.collection('coverage')
+        self.assertEqual(1, self.mongo_client.call_count)
+        self.assertEqual(5, self.mongo_client.call_args[1]['maxPoolSize'])
+        self.assertTrue(self.registry.stats()['connected'])
+
+    def test_fork(self):
+        self.mongo_client.side_effect = lambda **kwargs: Mock()
+        with patch('os.getpid', return_value=1):
+            parent = self.registry.client
+            self.assertIs(parent, self.registry.client)
+        with patch('os.getpid', return_value=2):
+            self.assertFalse(self.registry.stats()['connected'])
+            child = self.registry.client
+            self.assertIsNot(parent, child)
+            self.registry.close()
+        parent.close.assert_not_called()
+        child.close.assert_called_once_with()
+        self.assertEqual(2, self.mongo_client.call_count)
+
+    def test_collection_descriptor(self):
+        class Manager(object):
+            collection = MongoCollection('samples', registry=self.registry)
+        self.mongo_client.assert_not_called()
+        self.assertIs(self.mongo_client.return_value.__getitem__.return_value.__getitem__.return_value,
+                      Manager().collection)
+        self.mongo_client.return_value.__getitem__.assert_called_with('test')
+
+    def test_pool_statistics(self):
+        statistics = PoolStatistics()
+        for _ in range(2):
+            statistics.connection_created(None)
+            statistics.connection_checked_out(None)
+        statistics.connection_checked_in(None)
+        statistics.connection_checked_out(None)
+        statistics.connection_check_out_failed(None)
+        statistics.connection_closed(None)
+        pool = statistics.to_json_dict()
+        self.assertEqual(1, pool['open'])
+        self.assertEqual(2, pool['in_use'])
+        self.assertEqual(2, pool['max_in_use'])
+        self.assertEqual(3, pool['checkouts'])
+        self.assertEqual(1, pool['checkout_failures'])
+
+
+class FakeCollection(object):
+
+    def __init__(self, fail_on_batch=None):
+        self.fail_on_batch = fail_on_batch
+        self.batches = []
+        self.inserted = []
+        self.deleted = []
+        self.lock = threading.Lock()
+
+    def insert_many(self, documents, ordered=True):
+        with self.lock:
+            self.batches.append([d['name'] for d in documents])
+            self.inserted.extend(d['_id'] for d in documents)
+            if len(self.batches) == self.fail_on_batch:
+                raise BulkWriteError({'writeErrors': [{'code': 11000}], 'writeConcernErrors': []})
+
+    def delete_many(self, query):
+        with self.lock:
+            self.deleted.extend(query['_id']['$in'])
+
+
+class TestBulkWriter(TestCase):
+
+    def setUp(self):
+        self.documents = [{'name': 'gene{}'.format(i), 'sample': 'test_sample'} for i in range(10)]
+
+    def test_batch_size(self):
+        collection = FakeCollection()
+        stats = BulkWriter(collection, batch_size=3, batch_bytes=1024 * 1024, writers=2).write(self.documents)
+        self.assertEqual([3, 3, 3, 1], sorted([len(b) for b in collection.batches], reverse=True))
+        self.assertEqual(sorted(d['name'] for d in self.documents), sorted(sum(collection.batches, [])))
+        self.assertEqual(10, stats.documents)
+        self.assertEqual(4, len(stats.batches))
+
+    def test_batch_bytes(self):
+        collection = FakeCollection()
+        BulkWriter(collection, batch_size=100, batch_bytes=1, writers=2).write(self.documents)
+        self.assertEqual(10, len(collection.batches))
+
+    def test_documents_unchanged(self):
+        documents = copy.deepcopy(self.documents)
+        BulkWriter(FakeCollection(), batch_size=3, batch_bytes=1024 * 1024, writers=2).write(documents)
+        self.assertEqual(self.documents, documents)
+
+    def test_rollback(self):
+        collection = FakeCollection(fail_on_batch=2)
+        with self.assertRaises(BulkWriteError):
+            BulkWriter(collection, batch_size=3, batch_bytes=1024 * 1024, writers=1).write(self.documents)
+        self.assertEqual(6, len(collection.inserted))
+        self.assertLessEqual(set(collection.inserted), set(collection.deleted))
+
+    def test_checkpoints(self):
+        collection = FakeCollection(fail_on_batch=3)
+        checkpoints = []
+        with self.assertRaises(BulkWriteError):
+            BulkWriter(collection, batch_size=3, batch_bytes=1024 * 1024, writers=1, all_or_nothing=False,
+                       on_commit=checkpoints.append).write(self.documents)
+        self.assertEqual([3, 6], checkpoints)
+        self.assertEqual([], collection.deleted)
+
+    def test_ignore_duplicates(self):
+        collection = FakeCollection(fail_on_batch=1)
+        stats = BulkWriter(collection, batch_size=5, batch_bytes=1024 * 1024, writers=1,
+                           ignore_duplicates=True).write(self.documents)
+        self.assertEqual(10, stats.documents)
+
+
+class RequestCollection(object):
+    """
+    Records the requests of the bulk writes of the aggregates and finds the aggregates given
+    """
+
+    def __init__(self, documents=None):
+        self.documents = documents or []
+        self.requests = []
+
+    def find(self, query, projection=None):
+        return [d for d in self.documents if d['name'] in query['name']['$in']]
+
+    def bulk_write(self, requests, ordered=True):
+        self.requests.extend(requests)
+
+
+class TestGeneAggregates(TestCase):
+
+    def setUp(self):
+        self.coverage = [{'name': 'BRCA1', 'gcol': 'groupA', 'union_tr': {'stats': {'avg': 10.0, 'med': 8, 'x': None}}},
+                         {'name': 'CFTR', 'gcol': 'groupA', 'union_tr': {'stats': {'avg': 30.0, 'med': 20}}}]
+        self.member = {'sample': 'sample0', 'ver': 2}
+
+    def requests(self, method, *args):
+        """
+
+        :return: the requests of the bulk writes of a method of the manager called with the arguments
+        """
+        aggregate_collection = RequestCollection()
+        with patch.object(AggregateManager, 'aggregate_collection', aggregate_collection), \
+                patch.object(AggregateManager, '_union_stats', return_value=self.coverage):
+            getattr(AggregateManager(), method)(*args)
+        return aggregate_collection.requests
+
+    def test_add_sample(self):
+        requests = self.requests('add_sample', 'sample0', 'groupA', 2)
+        gene = {'gcol': 'groupA', 'name': 'BRCA1'}
+        self.assertEqual(4, len(requests))
+        # the aggregate is created before the update, which skips the aggregates including the sample already
+        self.assertEqual(UpdateOne(gene, {'$setOnInsert': {'n': 0, 'members': []}}, upsert=True), requests[0])
+        self.assertEqual(UpdateOne(dict(gene, members={'$ne': self.member}), {
+            '$inc': {'n': 1, 'stats.avg.sum': 10.0, 'stats.avg.sumsq': 100.0, 'stats.avg.n': 1,
+                     'stats.med.sum': 8, 'stats.med.sumsq': 64, 'stats.med.n': 1},
+            '$min': {'stats.avg.min': 10.0, 'stats.med.min': 8},
+            '$max': {'stats.avg.max': 10.0, 'stats.med.max': 8},
+            '$push': {'members': self.member}}), requests[1])
+
+    def test_remove_sample(self):
+        requests = self.requests('remove_sample', 'sample0', 'groupA', 2)
+        # minimum and maximum cannot be updated, the aggregate is flagged as stale
+        self.assertEqual([UpdateOne({'gcol': 'groupA', 'name': 'CFTR', 'members': self.member}, {
+            '$inc': {'n': -1, 'stats.avg.sum': -30.0, 'stats.avg.sumsq': -900.0, 'stats.avg.n': -1,
+                     'stats.med.sum': -20, 'stats.med.sumsq': -400, 'stats.med.n': -1},
+            '$set': {'stale': True},
+            '$pull': {'members': self.member}})], requests[1:])
+
+    def test_aggregated_by_gene(self):
+        documents = []
+        for gene_collection, values in (('groupA', [10.0, 20.0]), ('groupB', [30.0])):
+            totals = {}
+            for value in values:
+                add_to_totals(totals, {'avg': value})
+            documents.append({'gcol': gene_collection, 'name': 'BRCA1', 'n': totals.pop('n'), 'stats': totals})
+        with patch.object(AggregateManager, 'aggregate_collection', RequestCollection(documents)):
+            result, = AggregateManager().get_aggregated_by_gene(['BRCA1'])
+        self.assertEqual(3, result['n'])
+        self.assertAlmostEqual(20.0, result['avg_avg'])
+        self.assertAlmostEqual((200.0 / 3) ** 0.5, result['sd_avg'])
+        self.assertEqual(10.0, result['min_avg'])
+        self.assertEqual(30.0, result['max_avg'])
+        self.assertFalse(result['stale'])
+
+
+class TestIndexMigration(TestCase):
+
+    def setUp(self):
+        self.collections = {}
+        self.database = Mock(**{'list_collection_names.return_value': ['samples']})
+        self.database.__getitem__ = Mock(side_effect=lambda name: self.collections.setdefault(
+            name, Mock(**{'index_information.return_value': {'_id_': {}, 'stats': {}, 'name_1': {}}})))
+
+    def test_migration(self):
+        self.collections['schema_versions'] = Mock(**{'find_one.return_value': {'version': INDEXES_VERSION - 1}})
+        self.assertEqual(INDEXES_VERSION - 1, migrate_indexes(self.database))
+        self.assertEqual(['genes', 'coverage', 'gene_aggregates', 'hidden_coverage'],
+                         [c[1]['name'] for c in self.database.create_collection.call_args_list])
+        for collection, indexes in INDEXES.items():
+            self.assertEqual(len(indexes), self.collections[collection].create_index.call_count)
+        self.collections['coverage'].drop_index.assert_called_once_with('stats')
+        self.collections['samples'].drop_index.assert_called_once_with('name_1')
+        self.collections['gene_aggregates'].drop_index.assert_not_called()
+        self.assertEqual(INDEXES_VERSION, self.collections['schema_versions'].replace_one.call_args[0][1]['version'])
+
+    def migrate(self, collection, existing):
+        """
+
+        :param existing: the indexes of the collection before the migration
+        :return: the names of the indexes dropped from the collection
+        """
+        self.collections['schema_versions'] = Mock(**{'find_one.return_value': None})
+        self.collections[collection] = Mock(**{'index_information.return_value': existing})
+        migrate_indexes(self.database)
+        return [c[0][0] for c in self.collections[collection].drop_index.call_args_list]
+
+    def test_baseline_coverage_index(self):
+        # the unique index of the baseline rejects the coverage of a sample in a second gene collection and the
+        # resumed ingestions rely on duplicates being those of (sample, gcol, name)
+        dropped = self.migrate('coverage', {'_id_': {}, 'sample_1_name_1': {'unique': True}, 'stats': {}})
+        self.assertIn('sample_1_name_1', dropped)
+
+    def test_versioned_coverage_index(self):
+        # a replacement writes the coverage of a new version next to the previous one, any unique index of the
+        # coverage without the version rejects it
+        existing = {'_id_': {}, 'sample_1_name_1': {'unique': True}, 'sample_1_gcol_1_name_1': {'unique': True}}
+        dropped = self.migrate('coverage', existing)
+        self.assertEqual(['sample_1_name_1', 'sample_1_gcol_1_name_1'], dropped)
+        for keys, options in INDEXES['coverage']:
+            if options.get('unique'):
+                self.assertIn('ver', [key for key, direction in keys])
+
+    def test_baseline_samples_index(self):
+        # samples are unique by (gene_collection, name) now, the same sample is registered in several gene
+        # collections
+        dropped = self.migrate('samples', {'_id_': {}, 'name_1': {'unique': True}})
+        self.assertEqual(['name_1'], dropped)
+
+    def test_current_version(self):
+        self.collections['schema_versions'] = Mock(**{'find_one.return_value': {'version': INDEXES_VERSION}})
+        self.assertEqual(INDEXES_VERSION, migrate_indexes(self.database))
+        self.database.list_collection_names.assert_not_called()
+        self.collections['schema_versions'].replace_one.assert_not_called()
+
+
+class RecordingCursor(object):
+    """
+    Adds the sort and limit of a cursor to the find command it runs
+    """
+
+    def __init__(self, cursor, command):
+        self.cursor = cursor
+        self.command = command
+
+    def sort(self, key_or_list, direction=ASCENDING):
+        self.command['sort'] = SON([(key_or_list, direction)] if isinstance(key_or_list, str) else key_or_list)
+        self.cursor.sort(key_or_list, direction)
+        return self
+
+    def limit(self, limit):
+        if limit:
+            self.command['limit'] = limit
+        self.cursor.limit(limit)
+        return self
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+class RecordingCollection(object):
+    """
+    Records the command of every call to a collection reading or writing documents by query, with its sort,
+    projection and limit, to explain them afterwards. Commands are SON as their name must come first
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.queries = []
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+    def _update(self, query, update, upsert=False, multi=False):
+        self.queries.append(SON([('update', self.collection.name),
+                                 ('updates', [{'q': query, 'u': update, 'upsert': upsert, 'multi': multi}])]))
+
+    def _delete(self, query, limit):
+        self.queries.append(SON([('delete', self.collection.name), ('deletes', [{'q': query, 'limit': limit}])]))
+
+    def find(self, filter=None, projection=None, *args, **kwargs):
+        command = SON([('find', self.collection.name), ('filter', filter or {})])
+        if projection is not None:
+            command['projection'] = projection
+        self.queries.append(command)
+        return RecordingCursor(self.collection.find(filter, projection, *args, **kwargs), command)
+
+    def find_one(self, filter=None, projection=None, *args, **kwargs):
+        command = SON([('find', self.collection.name), ('filter', filter or {}), ('limit', 1)])
+        if projection is not None:
+            command['projection'] = projection
+        self.queries.append(command)
+        return self.collection.find_one(filter, projection, *args, **kwargs)
+
+    def distinct(self, key, filter=None, **kwargs):
+        self.queries.append(SON([('distinct', self.collection.name), ('key', key), ('query', filter or {})]))
+        return self.collection.distinct(key, filter, **kwargs)
+
+    def aggregate(self, pipeline, **kwargs):
+        self.queries.append(SON([('aggregate', self.collection.name), ('pipeline', pipeline), ('cursor', {})]))
+        return self.collection.aggregate(pipeline, **kwargs)
+
+    def delete_one(self, filter, **kwargs):
+        self._delete(filter, 1)
+        return self.collection.delete_one(filter, **kwargs)
+
+    def delete_many(self, filter, **kwargs):
+        self._delete(filter, 0)
+        return self.collection.delete_many(filter, **kwargs)
+
+    def replace_one(self, filter, replacement, upsert=False, **kwargs):
+        self._update(filter, replacement, upsert)
+        return self.collection.replace_one(filter, replacement, upsert, **kwargs)
+
+    def update_one(self, filter, update, upsert=False, **kwargs):
+        self._update(filter, update, upsert)
+        return self.collection.update_one(filter, update, upsert, **kwargs)
+
+    def update_many(self, filter, update, upsert=False, **kwargs):
+        self._update(filter, update, upsert, multi=True)
+        return self.collection.update_many(filter, update, upsert, **kwargs)
+
+    def bulk_write(self, requests, **kwargs):
+        for request in requests:
+            if isinstance(request, (UpdateOne, ReplaceOne, UpdateMany)):
+                self._update(request._filter, request._doc, bool(request._upsert),
+                             multi=isinstance(request, UpdateMany))
+            elif isinstance(request, (DeleteOne, DeleteMany)):
+                self._delete(request._filter, 1 if isinstance(request, DeleteOne) else 0)
+        return self.collection.bulk_write(requests, **kwargs)
+
+
+def plan_stages(explained):
+    """
+
+    :return: the stages of the winning plan of an explained query, rejected plans are skipped
+    """
+    if isinstance(explained, dict):
+        for key, value in explained.items():
+            if key == 'stage':
+                yield value
+            elif key != 'rejectedPlans':
+                for stage in plan_stages(value):
+                    yield stage
+    elif isinstance(explained, list):
+        for value in explained:
+            for stage in plan_stages(value):
+                yield stage
+
+
+class DatabaseTestCase(TestCase):
+    """
+    Runs on a database of its own of the MongoDB server at COVERAGE_DB_HOST, with the indexes of `migrate_indexes`.
+    It is skipped when no server is reachable, unless COVERAGE_TEST_DB_REQUIRED is set, as it is in CI, then it
+    fails.
+    """
+    database_suffix = None
+
+    @classmethod
+    def setUpClass(cls):
+        cls.registry = MongoClientRegistry(database='{}_{}'.format(COVERAGE_DB, cls.database_suffix),
+                                           serverSelectionTimeoutMS=500)
+        try:
+            cls.registry.client.admin.command('ping')
+        except PyMongoError:
+            cls.registry.close()
+            if os.getenv('COVERAGE_TEST_DB_REQUIRED'):
+                raise
+            raise SkipTest('No MongoDB server to run {}'.format(cls.__name__))
+        super(DatabaseTestCase, cls).setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.registry.client.drop_database(cls.registry.database_name)
+        cls.registry.close()
+        super(DatabaseTestCase, cls).tearDownClass()
+
+    def setUp(self):
+        self.registry.client.drop_database(self.registry.database_name)
+        migrate_indexes(self.registry.database)
+
+
+class TestQueryPlans(DatabaseTestCase):
+    """
+    Runs every query of the managers and fails if any of them scans a whole collection or sorts in memory
+    """
+    database_suffix = 'query_plans'
+
+    def setUp(self):
+        super(TestQueryPlans, self).setUp()
+        database = self.registry.database
+        database.samples.insert_many([{'name': 'sample0', 'gene_collection': 'groupA', 'ver': 2},
+                                      {'name': 'sample1', 'gene_collection': 'groupA'},
+                                      {'name': 'sample0', 'gene_collection': 'groupB', 'ver': 1}])
+        database.coverage.insert_many([{'sample': s, 'gcol': g, 'name': n, 'ver': v,
+                                        'union_tr': {'stats': {'avg': 1.0}}}
+                                       for s, g, v in (('sample0', 'groupA', 2), ('sample0', 'groupA', 1),
+                                                       ('sample1', 'groupA', None), ('sample0', 'groupB', 1))
+                                       for n in ('BRCA1', 'BRCA2', 'CFTR')])
+        database.hidden_coverage.insert_many([{'sample': 'sample0', 'gcol': 'groupA', 'shown': 2},
+                                              {'sample': 'sample1', 'gcol': 'groupA', 'all': True}])
+        self.collections = {}
+        for manager, attribute, name in ((CoverageManager, 'coverage_collection', 'coverage'),
+                                         (CoverageManager, 'hidden_collection', 'hidden_coverage'),
+                                         (SampleManager, 'sample_collection', 'samples'),
+                                         (AggregateManager, 'coverage_collection', 'coverage'),
+                                         (AggregateManager, 'aggregate_collection', 'gene_aggregates')):
+            collection = self.collections.setdefault(name, RecordingCollection(database[name]))
+            patcher = patch.object(manager, attribute, collection)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_no_collection_scan(self):
+        cm = CoverageManager()
+        sm = SampleManager()
+        am = AggregateManager()
+        am.rebuild('groupA', cm.visible({'gcol': 'groupA'}, gene_collection='groupA'))
+        am.add_sample('sample0', 'groupB', 1)
+        list(cm.get_sample_info('sample0', 'groupA', None, 'BRCA1', limit=2))
+        list(cm.get_sample_info('sample0', 'groupA', ['BRCA1', 'CFTR'], None))
+        list(cm.get_gene_info(['sample0', 'sample1'], 'groupA', 'BRCA2'))
+        list(cm.get_gene_info(None, 'groupA', 'BRCA2'))
+        list(cm.get_union_stats(['sample0'], 'groupA', ['BRCA1'], ['avg']))
+        list(cm.get_union_stats(None, 'groupA', ['BRCA1'], ['avg']))
+        list(cm.get_coverage_by_sample_and_genes('sample0', ['BRCA1']))
+        list(cm.get_coverage_by_sample_and_genes('sample0', []))
+        list(cm.get_groups_by_samples(['sample0', 'sample1']))
+        cm.get_genes_by_group('groupA')
+        cm.get_genes_by_groups(['groupA', 'groupB'])
+        cm.get_samples_by_group('groupA')
+        cm.get_samples_by_groups(['groupA', 'groupB'])
+        cm.get_aggregated_by_gene(['BRCA1'], 'groupA')
+        cm.get_aggregated_by_gene(['BRCA1'])
+        sm.add_sample('sample2', 3, {}, False, True, 'groupA', version=1)
+        sm.get_versions(['sample0'], 'groupA')
+        sm.get_registrations(['sample0'], 'groupA')
+        list(sm.get_sample_info(['sample0', 'sample1'], 'groupA', last_sample='sample0'))
+        cm.hide_version('sample2', 'groupA', 1)
+        cm.show_version('sample2', 'groupA', 1)
+        cm.remove_coverage_data_batch('sample0', 'groupA', below_version=2)
+        cm.forget_versions('sample0', 'groupA', 2)
+        cm.hide_samples(['sample1'], 'groupA')
+        am.remove_sample('sample1', 'groupA')
+        sm.remove_samples(['sample1'], 'groupA')
+        cm.remove_coverage_data('sample1', 'groupA')
+        cm.show_samples(['sample1'], 'groupA')
+
+        scans = []
+        for collection in self.collections.values():
+            for query in collection.queries:
+                explained = self.registry.database.command('explain', query, verbosity='queryPlanner')
+                stages = set(plan_stages(explained))
+                if 'COLLSCAN' in stages or 'SORT' in stages:
+                    scans.append(query)
+        self.assertGreater(sum(len(c.queries) for c in self.collections.values()), 20)
+        self.assertTrue(any('sort' in q for c in self.collections.values() for q in c.queries))
+        self.assertEqual([], scans)
+
+
+class FailingCollection(object):
+    """
+    Fails the bulk write number `fail_on_call` as if the connection was lost
+    """
+
+    def __init__(self, collection, fail_on_call):
+        self.collection = collection
+        self.fail_on_call = fail_on_call
+        self.calls = 0
+
+    def bulk_write(self, requests, **kwargs):
+        self.calls += 1
+        if self.calls == self.fail_on_call:
+            raise ConnectionFailure('connection lost')
+        return self.collection.bulk_write(requests, **kwargs)
+
+
+class TestGeneAggregateUpdates(DatabaseTestCase):
+    """
+    Applies the updates of the aggregates on a MongoDB server, repeated updates must be skipped by their filters
+    """
+    database_suffix = 'gene_aggregates'
+
+    def setUp(self):
+        super(TestGeneAggregateUpdates, self).setUp()
+        self.aggregate_collection = self.registry.database.gene_aggregates
+        coverage = [{'name': 'BRCA1', 'gcol': 'groupA', 'union_tr': {'stats': {'avg': 10.0, 'med': 8, 'x': None}}},
+                    {'name': 'CFTR', 'gcol': 'groupA', 'union_tr': {'stats': {'avg': 30.0, 'med': 20}}}]
+        patcher = patch.object(AggregateManager, '_union_stats', return_value=coverage)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def aggregates(self, aggregate_collection, *calls):
+        """
+
+        :param calls: the methods of the manager to call in turn with their arguments
+        :return: the aggregates by gene
+        """
+        with patch.object(AggregateManager, 'aggregate_collection', aggregate_collection):
+            for method, args in calls:
+                getattr(AggregateManager(), method)(*args)
+        return {d['name']: d for d in self.aggregate_collection.find({}, {'_id': 0})}
+
+    def test_remove_sample(self):
+        aggregates = self.aggregates(self.aggregate_collection, ('add_sample', ('sample0', 'groupA', 2)),
+                                     ('remove_sample', ('sample0', 'groupA', 2)))
+        self.assertEqual(0, aggregates['CFTR']['n'])
+        self.assertEqual([], aggregates['CFTR']['members'])
+        self.assertTrue(aggregates['CFTR']['stale'])
+
+    def test_updates_repeated(self):
+        # a sample added or removed again changes nothing, its version is a member of the aggregates or not
+        aggregates = self.aggregates(self.aggregate_collection, ('add_sample', ('sample0', 'groupA', 2)),
+                                     ('add_sample', ('sample0', 'groupA', 2)), ('add_sample', ('sample1', 'groupA', 1)),
+                                     ('remove_sample', ('sample1', 'groupA', 1)),
+                                     ('remove_sample', ('sample1', 'groupA', 1)))
+        self.assertEqual(1, aggregates['BRCA1']['n'])
+        self.assertEqual(10.0, aggregates['BRCA1']['stats']['avg']['sum'])
+        self.assertEqual([{'sample': 'sample0', 'ver': 2}], aggregates['BRCA1']['members'])
+
+    def test_partial_update_retried(self):
+        # the write of the aggregate of CFTR fails after the one of BRCA1 is applied
+        with patch('coveragedata.aggregate_manager.COVERAGE_INSERT_BATCH_SIZE', 2):
+            self.assertRaises(ConnectionFailure, self.aggregates,
+                              FailingCollection(self.aggregate_collection, fail_on_call=2),
+                              ('add_sample', ('sample0', 'groupA', 2)))
+            self.assertEqual(['BRCA1'], [d['name'] for d in self.aggregate_collection.find({'n': 1})])
+            aggregates = self.aggregates(self.aggregate_collection, ('add_sample', ('sample0', 'groupA', 2)))
+        self.assertEqual([1, 1], [aggregates[gene]['n'] for gene in ('BRCA1', 'CFTR')])
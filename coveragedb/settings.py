@@ -127,8 +127,70 @@ STATIC_URL = '/static/'
 
 COVERAGE_DB = os.getenv('COVERAGE_DB', 'coverage')
 COVERAGE_DB_HOST = os.getenv('COVERAGE_DB_HOST', 'localhost')
+# options of the MongoDB client shared by every manager of a process, the defaults are those of pymongo
+COVERAGE_DB_MAX_POOL_SIZE = int(os.getenv('COVERAGE_DB_MAX_POOL_SIZE', 100))
+COVERAGE_DB_MIN_POOL_SIZE = int(os.getenv('COVERAGE_DB_MIN_POOL_SIZE', 0))
+COVERAGE_DB_MAX_IDLE_TIME_MS = os.getenv('COVERAGE_DB_MAX_IDLE_TIME_MS')
+COVERAGE_DB_CONNECT_TIMEOUT_MS = int(os.getenv('COVERAGE_DB_CONNECT_TIMEOUT_MS', 20000))
+COVERAGE_DB_SOCKET_TIMEOUT_MS = os.getenv('COVERAGE_DB_SOCKET_TIMEOUT_MS')
+COVERAGE_DB_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv('COVERAGE_DB_SERVER_SELECTION_TIMEOUT_MS', 30000))
+COVERAGE_DB_WAIT_QUEUE_TIMEOUT_MS = os.getenv('COVERAGE_DB_WAIT_QUEUE_TIMEOUT_MS')
+# eg: primary, primaryPreferred, secondary, secondaryPreferred or nearest
+COVERAGE_DB_READ_PREFERENCE = os.getenv('COVERAGE_DB_READ_PREFERENCE', 'primary')
+# eg: 1 or majority, the write concern of the server if not set
+COVERAGE_DB_WRITE_CONCERN = os.getenv('COVERAGE_DB_WRITE_CONCERN')
+# comma separated wire compressors in order of preference among zstd, snappy and zlib, none if not set
+COVERAGE_DB_COMPRESSORS = os.getenv('COVERAGE_DB_COMPRESSORS')
+# coverage documents are inserted in unordered batches closed by number of documents or by size in bytes
+COVERAGE_INSERT_BATCH_SIZE = int(os.getenv('COVERAGE_INSERT_BATCH_SIZE', 500))
+COVERAGE_INSERT_BATCH_BYTES = int(os.getenv('COVERAGE_INSERT_BATCH_BYTES', 8 * 1024 * 1024))
+COVERAGE_INSERT_WRITERS = int(os.getenv('COVERAGE_INSERT_WRITERS', 4))
+# coverage documents of deleted samples are removed in the background this many at a time
+COVERAGE_DELETE_BATCH_SIZE = int(os.getenv('COVERAGE_DELETE_BATCH_SIZE', 1000))
+# stores the exons of new coverage documents as packed binary arrays, both formats can coexist
+COVERAGE_PACKED_EXONS = os.getenv('COVERAGE_PACKED_EXONS', 'false').lower() == 'true'
+# ingestions interrupted by a database connection failure are retried from their last checkpoint
+INGESTION_MAX_RETRIES = int(os.getenv('INGESTION_MAX_RETRIES', 3))
+INGESTION_RETRY_DELAY = int(os.getenv('INGESTION_RETRY_DELAY', 60))
+# maximum number of samples of an ingestion batch being ingested at the same time
+INGESTION_BATCH_CONCURRENCY = int(os.getenv('INGESTION_BATCH_CONCURRENCY', 8))
+# every INGESTION_BATCH_REFILL_SECONDS the slots of batch samples whose task was lost are given to the next samples,
+# a running ingestion is lost when its task failed without freeing its slot or gave no sign of life for
+# INGESTION_BATCH_STALL_SECONDS
+INGESTION_BATCH_REFILL_SECONDS = int(os.getenv('INGESTION_BATCH_REFILL_SECONDS', 60))
+INGESTION_BATCH_STALL_SECONDS = int(os.getenv('INGESTION_BATCH_STALL_SECONDS', 60 * 60))
+# longest time in seconds a status request waits for an ingestion to change, it checks every
+# INGESTION_STATUS_POLL_SECONDS doubling up to INGESTION_STATUS_MAX_POLL_SECONDS
+INGESTION_STATUS_MAX_WAIT = int(os.getenv('INGESTION_STATUS_MAX_WAIT', 60))
+INGESTION_STATUS_POLL_SECONDS = float(os.getenv('INGESTION_STATUS_POLL_SECONDS', 0.25))
+INGESTION_STATUS_MAX_POLL_SECONDS = float(os.getenv('INGESTION_STATUS_MAX_POLL_SECONDS', 2))
+# bytes of responses of the coverage endpoints kept by every process, 0 disables the cache
+COVERAGE_CACHE_BYTES = int(os.getenv('COVERAGE_CACHE_BYTES', 64 * 1024 * 1024))
+# folder of a second tier of the cache shared by the processes of the host, not used if not set
+COVERAGE_SHARED_CACHE_DIR = os.getenv('COVERAGE_SHARED_CACHE_DIR')
+COVERAGE_SHARED_CACHE_SIZE = int(os.getenv('COVERAGE_SHARED_CACHE_SIZE', 10000))
+COVERAGE_SHARED_CACHE_TIMEOUT = int(os.getenv('COVERAGE_SHARED_CACHE_TIMEOUT', 24 * 60 * 60))
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+if COVERAGE_SHARED_CACHE_DIR:
+    CACHES['coverage'] = {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': COVERAGE_SHARED_CACHE_DIR,
+        'TIMEOUT': COVERAGE_SHARED_CACHE_TIMEOUT,
+        'OPTIONS': {'MAX_ENTRIES': COVERAGE_SHARED_CACHE_SIZE}
+    }
 
 CELERY_IMPORTS = (
     'coveragedbingestion.tasks',
 )
 CELERY_RESULT_BACKEND = 'django-db'
+CELERY_BEAT_SCHEDULE = {
+    'refill-ingestion-batches': {
+        'task': 'coveragedbingestion.tasks.refill_batches',
+        'schedule': INGESTION_BATCH_REFILL_SECONDS
+    }
+}
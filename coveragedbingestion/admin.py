@@ -1,10 +1,24 @@
 from django.contrib import admin
 
-from .models import SampleIngestion, GeneCollection
+from .models import SampleIngestion, GeneCollection, IngestionBatch, IngestionMetrics, BulkDeletion
 
 
 class SampleIngestionAdmin(admin.ModelAdmin):
-    list_display = ['name', 'input_file', 'gene_collection', 'task', 'seconds']
+    list_display = ['name', 'input_file', 'gene_collection', 'task', 'seconds', 'batch']
+
+
+class IngestionBatchAdmin(admin.ModelAdmin):
+    list_display = ['id', 'created', 'concurrency']
+
+
+class IngestionMetricsAdmin(admin.ModelAdmin):
+    list_display = ['sample_ingestion', 'attempt', 'succeeded', 'seconds', 'read_seconds', 'transform_seconds',
+                    'insert_seconds', 'sample_seconds']
+
+
+class BulkDeletionAdmin(admin.ModelAdmin):
+    list_display = ['id', 'created', 'finished', 'gene_collection', 'total_samples', 'samples_deleted',
+                    'documents_deleted']
 
 
 class GeneCollectionAdmin(admin.ModelAdmin):
@@ -13,3 +27,6 @@ class GeneCollectionAdmin(admin.ModelAdmin):
 
 admin.site.register(SampleIngestion, SampleIngestionAdmin)
 admin.site.register(GeneCollection, GeneCollectionAdmin)
+admin.site.register(IngestionBatch, IngestionBatchAdmin)
+admin.site.register(IngestionMetrics, IngestionMetricsAdmin)
+admin.site.register(BulkDeletion, BulkDeletionAdmin)
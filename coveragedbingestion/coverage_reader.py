@@ -0,0 +1,181 @@
+import gzip
+import io
+import json
+import re
+from contextlib import contextmanager
+
+CHUNK_SIZE = 1024 * 1024
+
+READ_BUFFER_SIZE = 4 * 1024 * 1024
+
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+
+def _decompressed(raw):
+    """
+    Wraps a binary file in a stream decompressing it on the fly according to its magic bytes, bgzip files are
+    gzip files with many members
+    """
+    magic = raw.peek(len(ZSTD_MAGIC))[:len(ZSTD_MAGIC)]
+    if magic.startswith(GZIP_MAGIC):
+        return gzip.GzipFile(fileobj=raw, mode='rb')
+    if magic == ZSTD_MAGIC:
+        try:
+            import zstandard
+        except ImportError:
+            raise ValueError('The package zstandard is required to read zstd compressed coverage files')
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(raw, read_size=READ_BUFFER_SIZE),
+                                 buffer_size=READ_BUFFER_SIZE)
+    return raw
+
+
+@contextmanager
+def open_coverage_file(input_file):
+    """
+    Opens a coverage file for reading as text, gzip, bgzip and zstd compressed files are decompressed while they
+    are read
+
+    :param input_file: the path to the coverage file
+    """
+    with open(input_file, 'rb', buffering=READ_BUFFER_SIZE) as raw:
+        with io.TextIOWrapper(_decompressed(raw), encoding='utf-8') as fd:
+            yield fd
+
+
+class CoverageReader(object):
+    """
+    Incremental reader for the JSON output of gelcoverage.
+
+    Iterating over the reader yields the genes in `results.genes` one at a time, so memory usage is bounded by
+    the size of the largest gene rather than by the size of the file. Any other value in the document is small
+    and it is decoded as a whole. Once the genes have been consumed `parameters`, `coding_region` and
+    `whole_genome` hold the corresponding sections of the document.
+    """
+
+    def __init__(self, fd, chunk_size=CHUNK_SIZE):
+        """
+
+        :param fd: a file like object opened in text mode
+        :param chunk_size: the number of characters read from the file at a time
+        """
+        self.fd = fd
+        self.chunk_size = chunk_size
+        self.parameters = None
+        self.coding_region = {}
+        self.whole_genome = {}
+        self.number_of_genes = 0
+        self._decoder = json.JSONDecoder()
+        self._buffer = ''
+        self._pos = 0
+        self._eof = False
+
+    def __iter__(self):
+        self._expect('{')
+        for key in self._members():
+            if key == 'results':
+                yield from self._results()
+            elif key == 'parameters':
+                self.parameters = self._value()
+            else:
+                self._value()
+
+    def _results(self):
+        self._expect('{')
+        for key in self._members():
+            if key == 'genes':
+                yield from self._genes()
+            elif key == 'coding_region':
+                self.coding_region = self._value()
+            elif key == 'whole_genome':
+                self.whole_genome = self._value()
+            else:
+                self._value()
+
+    def _genes(self):
+        self._expect('[')
+        if self._peek() == ']':
+            self._pos += 1
+            return
+        while True:
+            gene = self._value()
+            self.number_of_genes += 1
+            yield gene
+            if self._separator(']'):
+                return
+
+    def _members(self):
+        """
+        Yields the keys of the object being read, the caller must consume the value of every key
+        """
+        if self._peek() == '}':
+            self._pos += 1
+            return
+        while True:
+            key = self._value()
+            self._expect(':')
+            yield key
+            if self._separator('}'):
+                return
+
+    def _read(self):
+        # reads at least as much as it is buffered so a value spanning many chunks is not decoded too many times
+        chunk = self.fd.read(max(self.chunk_size, len(self._buffer) - self._pos))
+        if not chunk:
+            self._eof = True
+        self._buffer = self._buffer[self._pos:] + chunk
+        self._pos = 0
+
+    def _skip_whitespace(self):
+        while True:
+            self._pos = WHITESPACE.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer) or self._eof:
+                return
+            self._read()
+
+    def _peek(self):
+        self._skip_whitespace()
+        if self._pos >= len(self._buffer):
+            raise ValueError('Unexpected end of coverage file')
+        return self._buffer[self._pos]
+
+    def _next(self):
+        char = self._peek()
+        self._pos += 1
+        return char
+
+    def _expect(self, char):
+        found = self._next()
+        if found != char:
+            raise ValueError("Malformed coverage file: expected '{}' but found '{}'".format(char, found))
+
+    def _separator(self, closing):
+        """
+        Consumes the separator after a value, returns True when it closes the current array or object
+        """
+        char = self._next()
+        if char == closing:
+            return True
+        if char != ',':
+            raise ValueError("Malformed coverage file: expected ',' or '{}' but found '{}'".format(closing, char))
+        return False
+
+    def _value(self):
+        while True:
+            self._skip_whitespace()
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+            except ValueError:
+                if self._eof:
+                    raise
+                self._read()
+                continue
+            # a number at the end of the buffer may continue in the next chunk
+            if end == len(self._buffer) and not self._eof:
+                self._read()
+                continue
+            self._pos = end
+            return value
@@ -0,0 +1,27 @@
+import hashlib
+import os
+
+BLOCK_SIZE = 4 * 1024 * 1024
+
+
+def file_signature(input_file):
+    """
+
+    :param input_file: the path to a file
+    :return: the size in bytes and the modification time of the file
+    """
+    stat = os.stat(input_file)
+    return stat.st_size, stat.st_mtime
+
+
+def content_hash(input_file):
+    """
+
+    :param input_file: the path to a file
+    :return: the SHA-256 hex digest of the content of the file, compressed files are hashed as they are
+    """
+    digest = hashlib.sha256()
+    with open(input_file, 'rb') as fd:
+        for block in iter(lambda: fd.read(BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
@@ -1,55 +1,162 @@
-import json
-
-from coveragedata.constants import STATS_ORDERED_KEYS, EXON_EXCLUDED_KEYS
+import os
+import time
+from itertools import chain
+from operator import itemgetter
+
+from coveragedbingestion.coverage_reader import CoverageReader, open_coverage_file
+from coveragedbingestion.metrics import IngestionStats, TimedIterator
+from coveragedata.constants import STATS_ORDERED_KEYS, EXON_EXCLUDED_KEYS, GAP_MIN_LENGTH
+from coveragedb.settings import COVERAGE_PACKED_EXONS
 from coveragedata.coverage_manager import CoverageManager
+from coveragedata.packing import pack_gene, COVERAGE_SCHEMA_VERSION
 from coveragedata.sample_manager import SampleManager
 
 
-def build_coverage_document(sample, genes, gene_collection):
+TRANSFORM_CHUNK_SIZE = 64
+
+_exon_stats = itemgetter('stats')
+
+
+def build_coverage_document(sample, genes, gene_collection, packed=False, version=None):
+    """
+
+    :param packed: stores the exons as packed binary arrays
+    :param version: the version of the ingestion of the sample the documents belong to
+    """
+    keys = {'sample': sample, 'gcol': gene_collection}
+    if version is not None:
+        keys['ver'] = version
     for gene in genes:
-        yield {**{'sample': sample, 'gcol': gene_collection}, **gene}
+        if packed:
+            yield {**keys, **pack_gene(gene)}
+        else:
+            yield {**keys, 'v': COVERAGE_SCHEMA_VERSION, **gene}
 
 
-def convert_gaps(gaps):
-    return list(map(lambda p: (p['s'], p['e']), list(filter(lambda x: x['e'] - x['s'] > 5, gaps))))
+def convert_gaps(gaps, min_length=GAP_MIN_LENGTH):
+    return [(gap['s'], gap['e']) for gap in gaps if gap['e'] - gap['s'] > min_length]
 
 
 def clean_exon(exon, excluded_keys=EXON_EXCLUDED_KEYS, stats_ordered_keys=STATS_ORDERED_KEYS):
     exon['gaps'] = convert_gaps(gaps=exon.get('gaps', []))
     exon['stats'] = [exon['stats'][key] for key in stats_ordered_keys]
-    list(map(lambda k: exon.pop(k), excluded_keys))
+    for key in excluded_keys:
+        del exon[key]
 
 
 def minimize_exons(gene_data):
-    list(map(lambda exon: clean_exon(exon), gene_data['exons']))
+    for exon in gene_data['exons']:
+        clean_exon(exon)
 
 
 def minimize_gene(gene):
-    minimize_exons(gene['union_tr'])
-    list(map(lambda gene_data: minimize_exons(gene_data), gene['trs']))
+    return minimize_genes([gene])[0]
+
+
+def minimize_genes(genes, excluded_keys=EXON_EXCLUDED_KEYS, stats_ordered_keys=STATS_ORDERED_KEYS):
+    """
+    Minimizes the exons of many genes at once. All the exons of every transcript are gathered in a single list and
+    the statistics are projected into lists ordered by `stats_ordered_keys` in one pass, the result is the same
+    as calling `clean_exon` on every exon.
+
+    :param genes: a list of genes, they are modified in place
+    :return: the list of genes
+    """
+    exons = [exon for gene in genes for transcript in chain((gene['union_tr'],), gene['trs'])
+             for exon in transcript['exons']]
+    stats_getter = itemgetter(*stats_ordered_keys)
+    if len(stats_ordered_keys) == 1:
+        stats = [[value] for value in map(stats_getter, map(_exon_stats, exons))]
+    else:
+        stats = list(map(list, map(stats_getter, map(_exon_stats, exons))))
+    for exon, exon_stats in zip(exons, stats):
+        gaps = exon.get('gaps')
+        exon['gaps'] = convert_gaps(gaps) if gaps else []
+        exon['stats'] = exon_stats
+        for key in excluded_keys:
+            del exon[key]
+    return genes
 
 
 def transform_data(data):
-    list(map(lambda gene: minimize_gene(gene), data))
-    return data
-
-
-def ingest_data(input_file, sample, gene_collection_id):
-    with open(input_file) as fd:
-        j = json.load(fd)
-
-    parameters = j['parameters']
-    coding_region = j.get('results', {}).get('coding_region', {})
-    genes = transform_data(j.get('results', {}).get('genes', []))
-    nog = len(genes)
-    whole_genome = j.get('results', {}).get('whole_genome', {})
+    return minimize_genes(data)
+
+
+def transform_genes(genes, skip=0, chunk_size=TRANSFORM_CHUNK_SIZE):
+    """
+    Minimizes a stream of genes in chunks of `chunk_size` genes
+
+    :param genes: an iterable of genes
+    :param skip: the number of leading genes to drop without minimizing them
+    """
+    chunk = []
+    for i, gene in enumerate(genes):
+        if i < skip:
+            continue
+        chunk.append(gene)
+        if len(chunk) >= chunk_size:
+            yield from minimize_genes(chunk)
+            chunk = []
+    yield from minimize_genes(chunk)
+
+
+def ingest_data(input_file, sample, gene_collection_id, skip_genes=0, resume=False, on_checkpoint=None, stats=None,
+                version=None, on_stored=None):
+    """
+    Streams the genes in the coverage file into the database one at a time, so memory usage does not depend on
+    the size of the file. The sample is registered once all its genes are stored.
+
+    The genes are stored under the given version next to those of any previous version of the sample, the caller
+    hides the new version until the sample is registered, see CoverageManager.hide_version.
+
+    Genes are committed in batches that are kept if the ingestion fails, `on_checkpoint` is called with the
+    number of leading genes in the file already stored. A resumed ingestion skips those genes and any other
+    gene stored by the previous attempt.
+
+    :param input_file: the path to the gelcoverage JSON output, it may be gzip, bgzip or zstd compressed
+    :param sample: the sample name
+    :param gene_collection_id: the gene collection name
+    :param skip_genes: the number of leading genes stored by a previous attempt
+    :param resume: whether a previous attempt may have stored any gene
+    :param on_checkpoint: called with the number of leading genes stored so far
+    :param stats: the IngestionStats to fill, it holds the stages finished so far if the ingestion fails
+    :param version: the version of the ingestion of the sample
+    :param on_stored: called once all the genes are stored, before the sample is registered
+    :return: the IngestionStats of the ingestion
+    """
     cm = CoverageManager()
     sm = SampleManager()
-
-    sm.add_sample(sample_name=sample, number_of_genes=nog, parameters=parameters, coding_region=coding_region,
-                  whole_genome=whole_genome, gene_collection=gene_collection_id
+    stats = stats if stats is not None else IngestionStats()
+
+    def on_commit(documents):
+        if on_checkpoint is not None:
+            on_checkpoint(skip_genes + documents)
+
+    start = time.perf_counter()
+    with open_coverage_file(input_file) as fd:
+        reader = CoverageReader(fd)
+        parsed = TimedIterator(reader)
+        transformed = TimedIterator(transform_genes(parsed, skip=skip_genes))
+        try:
+            write_stats = cm.add_coverage_data(
+                build_coverage_document(sample, stats.count(transformed), gene_collection_id,
+                                        packed=COVERAGE_PACKED_EXONS, version=version),
+                all_or_nothing=False, resume=resume or skip_genes > 0, on_commit=on_commit)
+        finally:
+            # the time of every stage excludes the time of the stages it reads from
+            stats.seconds['read'] += parsed.seconds
+            stats.seconds['transform'] += transformed.seconds - parsed.seconds
+            stats.seconds['insert'] += time.perf_counter() - start - transformed.seconds
+        stats.add_write(write_stats)
+    # the whole file is read, including the genes skipped
+    stats.bytes_read += os.path.getsize(input_file)
+
+    if on_stored is not None:
+        on_stored()
+    start = time.perf_counter()
+    sm.add_sample(sample_name=sample, number_of_genes=reader.number_of_genes, parameters=reader.parameters,
+                  coding_region=reader.coding_region, whole_genome=reader.whole_genome,
+                  gene_collection=gene_collection_id, version=version
                   )
-    cm.add_coverage_data(build_coverage_document(sample, genes, gene_collection_id))
-
-
-
+    stats.seconds['sample'] += time.perf_counter() - start
+    return stats
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from coveragedata.indexes import INDEXES_VERSION, migrate_indexes
+from coveragedata.mongo import mongo_clients
+
+
+class Command(BaseCommand):
+    help = 'Creates the collections and indexes of the coverage database and drops the indexes superseded'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', dest='force', action='store_true',
+                            help='Migrates the indexes even if they are at the current version already')
+
+    def handle(self, *args, **options):
+        version = migrate_indexes(mongo_clients.database, force=options['force'])
+        if version >= INDEXES_VERSION and not options['force']:
+            self.stdout.write('Indexes are at version {} already'.format(version))
+        else:
+            self.stdout.write('Migrated indexes from version {} to {}'.format(version, INDEXES_VERSION))
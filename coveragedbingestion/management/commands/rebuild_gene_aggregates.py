@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from coveragedata.aggregate_manager import AggregateManager
+from coveragedata.coverage_manager import CoverageManager
+from coveragedbingestion.models import GeneCollection
+
+
+class Command(BaseCommand):
+    help = 'Computes again the per gene aggregates of the coverage from the coverage of the registered samples'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--gene-collection', dest='gene_collections', action='append',
+                            help='Gene collection to rebuild, it can be given many times [default: all]')
+
+    def handle(self, *args, **options):
+        gene_collections = options['gene_collections'] or list(GeneCollection.objects.values_list('name', flat=True))
+        am = AggregateManager()
+        cm = CoverageManager()
+        for gene_collection in gene_collections:
+            genes = am.rebuild(gene_collection, cm.visible({'gcol': gene_collection}, gene_collection=gene_collection))
+            self.stdout.write('Rebuilt the aggregates of {} genes for collection {}'.format(genes, gene_collection))
@@ -0,0 +1,83 @@
+import time
+
+# stages of an ingestion in the order they happen, inserting includes building the documents, encoding them as
+# BSON and waiting for the writers
+STAGES = ('fingerprint', 'read', 'transform', 'insert', 'sample')
+
+
+class TimedIterator(object):
+    """
+    Accumulates the time spent producing the items of an iterable, including the time of the iterables it reads
+    """
+
+    def __init__(self, iterable):
+        self.iterator = iter(iterable)
+        self.seconds = 0.0
+        self.items = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            item = next(self.iterator)
+        finally:
+            self.seconds += time.perf_counter() - start
+        self.items += 1
+        return item
+
+
+class IngestionStats(object):
+    """
+    Wall time of every stage of an ingestion and the amount of data that went through it
+    """
+
+    def __init__(self):
+        self.seconds = {stage: 0.0 for stage in STAGES}
+        self.bytes_read = 0
+        self.genes = 0
+        self.transcripts = 0
+        self.exons = 0
+        self.documents = 0
+        self.document_bytes = 0
+        self.batch_latencies = []
+
+    def count(self, genes):
+        """
+        Counts the genes, transcripts and exons, including those of the union transcript, going through
+
+        :param genes: an iterable of minimized genes
+        """
+        for gene in genes:
+            self.genes += 1
+            self.transcripts += len(gene['trs'])
+            self.exons += len(gene['union_tr']['exons']) + sum(len(t['exons']) for t in gene['trs'])
+            yield gene
+
+    def add_write(self, write_stats):
+        """
+
+        :param write_stats: the BulkWriteStats of the coverage documents written
+        """
+        self.documents += write_stats.documents
+        self.document_bytes += write_stats.bytes
+        self.batch_latencies.extend(b.seconds for b in write_stats.batches)
+
+    @property
+    def total_seconds(self):
+        return sum(self.seconds.values())
+
+    def to_json_dict(self):
+        return {'seconds': self.total_seconds,
+                'stages': dict(self.seconds),
+                'bytes_read': self.bytes_read,
+                'genes': self.genes,
+                'transcripts': self.transcripts,
+                'exons': self.exons,
+                'documents': self.documents,
+                'document_bytes': self.document_bytes,
+                'batches': len(self.batch_latencies),
+                'batch_seconds_total': sum(self.batch_latencies),
+                'batch_seconds_max': max(self.batch_latencies) if self.batch_latencies else None
+                }
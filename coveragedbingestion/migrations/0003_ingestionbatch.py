@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.5 on 2026-10-18 06:59
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def mark_existing_dispatched(apps, schema_editor):
+    # ingestions created before batches existed were all sent to the workers on creation
+    apps.get_model('coveragedbingestion', 'SampleIngestion').objects.update(dispatched=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('coveragedbingestion', '0002_sampleingestion_name_slug'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IngestionBatch',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('concurrency', models.PositiveIntegerField(default=8)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='sampleingestion',
+            name='dispatched',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='sampleingestion',
+            name='batch',
+            field=models.ForeignKey(default=None, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='samples', to='coveragedbingestion.IngestionBatch'),
+        ),
+        migrations.RunPython(mark_existing_dispatched, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.5 on 2026-10-18 07:01
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('coveragedbingestion', '0003_ingestionbatch'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sampleingestion',
+            name='genes_committed',
+            field=models.IntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.5 on 2026-10-18 07:05
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('coveragedbingestion', '0004_sampleingestion_genes_committed'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sampleingestion',
+            name='content_hash',
+            field=models.CharField(db_index=True, default=None, max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='sampleingestion',
+            name='duplicate_of',
+            field=models.ForeignKey(default=None, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='duplicates', to='coveragedbingestion.SampleIngestion'),
+        ),
+        migrations.AddField(
+            model_name='sampleingestion',
+            name='file_mtime',
+            field=models.FloatField(default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name='sampleingestion',
+            name='file_size',
+            field=models.BigIntegerField(default=None, null=True),
+        ),
+    ]
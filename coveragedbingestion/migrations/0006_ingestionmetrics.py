@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.5 on 2026-10-18 07:09
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('coveragedbingestion', '0005_sampleingestion_fingerprint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IngestionMetrics',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('attempt', models.PositiveIntegerField(default=0)),
+                ('succeeded', models.BooleanField(default=False)),
+                ('seconds', models.FloatField(default=0.0)),
+                ('fingerprint_seconds', models.FloatField(default=0.0)),
+                ('read_seconds', models.FloatField(default=0.0)),
+                ('transform_seconds', models.FloatField(default=0.0)),
+                ('insert_seconds', models.FloatField(default=0.0)),
+                ('sample_seconds', models.FloatField(default=0.0)),
+                ('bytes_read', models.BigIntegerField(default=0)),
+                ('genes', models.IntegerField(default=0)),
+                ('transcripts', models.IntegerField(default=0)),
+                ('exons', models.BigIntegerField(default=0)),
+                ('documents', models.IntegerField(default=0)),
+                ('document_bytes', models.BigIntegerField(default=0)),
+                ('batches', models.IntegerField(default=0)),
+                ('batch_seconds_total', models.FloatField(default=0.0)),
+                ('batch_seconds_max', models.FloatField(default=None, null=True)),
+                ('sample_ingestion', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='metrics', to='coveragedbingestion.SampleIngestion')),
+            ],
+        ),
+    ]
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.5 on 2026-10-18 07:15
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_celery_results', '0001_initial'),
+        ('coveragedbingestion', '0006_ingestionmetrics'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BulkDeletion',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('finished', models.DateTimeField(default=None, null=True)),
+                ('total_samples', models.IntegerField(default=0)),
+                ('samples_deleted', models.IntegerField(default=0)),
+                ('documents_deleted', models.BigIntegerField(default=0)),
+                ('gene_collection', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='coveragedbingestion.GeneCollection')),
+                ('task', models.ForeignKey(default=None, null=True, on_delete=django.db.models.deletion.SET_NULL, to='django_celery_results.TaskResult')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='sampleingestion',
+            name='deletion',
+            field=models.ForeignKey(default=None, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='samples', to='coveragedbingestion.BulkDeletion'),
+        ),
+    ]
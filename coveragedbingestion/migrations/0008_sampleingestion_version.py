@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.5 on 2026-10-18 07:16
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def mark_existing_unversioned(apps, schema_editor):
+    # the coverage of the samples already ingested was stored without a version
+    SampleIngestion = apps.get_model('coveragedbingestion', 'SampleIngestion')
+    SampleIngestion.objects.update(version=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('coveragedbingestion', '0007_bulkdeletion'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sampleingestion',
+            name='version',
+            field=models.PositiveIntegerField(default=1, null=True),
+        ),
+        migrations.RunPython(mark_existing_unversioned, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.5 on 2026-10-18 07:51
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('coveragedbingestion', '0008_sampleingestion_version'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='sampleingestion',
+            name='duplicate_of',
+            field=models.ForeignKey(default=None, null=True, on_delete=django.db.models.deletion.PROTECT,
+                                    related_name='duplicates', to='coveragedbingestion.SampleIngestion'),
+        ),
+    ]
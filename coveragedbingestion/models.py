@@ -1,10 +1,50 @@
-from django.db import models
+import time
+from datetime import timedelta
+
+from celery import group, states
+from django.db import models, transaction
+from django.db.models import ProtectedError
+from django.db.models import Count, F, Max, Sum
+from django.utils import timezone
 from django.utils.text import slugify
 from django_celery_results.models import TaskResult
 
+from coveragedb.settings import INGESTION_BATCH_CONCURRENCY, INGESTION_STATUS_POLL_SECONDS, \
+    INGESTION_STATUS_MAX_POLL_SECONDS, INGESTION_BATCH_STALL_SECONDS
+from coveragedbingestion.fingerprint import file_signature, content_hash
+from coveragedbingestion.metrics import STAGES
+
+from coveragedata.aggregate_manager import AggregateManager
 from coveragedata.coverage_manager import CoverageManager
 from coveragedata.sample_manager import SampleManager
-from coveragedbingestion.tasks import ingest
+from coveragedbingestion.tasks import ingest, purge, refill_batch
+
+# status of an ingestion skipped because the same content was already ingested for the gene collection
+DUPLICATE = 'DUPLICATE'
+
+# status of an ingestion whose task has not started yet
+NOT_STARTED = 'NOT STARTED'
+
+# status of an ingestion whose coverage is hidden and being removed
+DELETING = 'DELETING'
+
+# statuses of the ingestions that do not change unless they are resumed
+FINISHED_STATUSES = states.READY_STATES | {DUPLICATE, DELETING}
+
+
+def ingestion_status(task_status, duplicate_of_id, deletion_id=None):
+    """
+
+    :param task_status: the status of the task of the ingestion, None when there is no task yet
+    :param duplicate_of_id: the id of the ingestion with the same content, if any
+    :param deletion_id: the id of the bulk deletion removing the ingestion, if any
+    :return: the status of the ingestion
+    """
+    if deletion_id is not None:
+        return DELETING
+    if duplicate_of_id is not None:
+        return DUPLICATE
+    return task_status if task_status is not None else NOT_STARTED
 
 
 class GeneCollection(models.Model):
@@ -14,6 +54,116 @@ class GeneCollection(models.Model):
         return self.name
 
 
+class IngestionBatch(models.Model):
+    created = models.DateTimeField(auto_now_add=True)
+    concurrency = models.PositiveIntegerField(default=INGESTION_BATCH_CONCURRENCY)
+
+    def dispatch(self, slots):
+        """
+        Sends the next samples of the batch waiting to be ingested as a group of tasks
+
+        :param slots: the maximum number of samples to send
+        :return: the ids of the sample ingestions sent
+        """
+        candidates = self.samples.filter(dispatched=False).order_by('pk').values_list('pk', flat=True)[:slots]
+        # claims every sample with a conditional update so concurrent dispatches never send a sample twice
+        claimed = [pk for pk in candidates
+                   if SampleIngestion.objects.filter(pk=pk, dispatched=False).update(dispatched=True)]
+        if claimed:
+            # a task failing without freeing its slot, even when its worker is killed, frees it by the errback
+            group(ingest.si(pk).set(link_error=refill_batch.si(self.pk)) for pk in claimed).apply_async()
+        return claimed
+
+    def in_flight(self, exclude=None):
+        """
+
+        :param exclude: the id of a sample ingestion not counted, the one whose task is finishing
+        :return: the number of samples sent and not finished, without those whose task gave no sign of life for
+        INGESTION_BATCH_STALL_SECONDS
+        """
+        stalled = timezone.now() - timedelta(seconds=INGESTION_BATCH_STALL_SECONDS)
+        samples = self.samples.filter(dispatched=True, duplicate_of__isnull=True, deletion__isnull=True
+                                      ).exclude(task__status__in=states.READY_STATES
+                                                ).exclude(task__date_done__lt=stalled)
+        if exclude is not None:
+            samples = samples.exclude(pk=exclude)
+        return samples.count()
+
+    def refill(self):
+        """
+        Sends as many samples as there are free slots, so slots of tasks lost are given to the next samples
+
+        :return: the ids of the sample ingestions sent
+        """
+        slots = self.concurrency - self.in_flight()
+        return self.dispatch(slots) if slots > 0 else []
+
+    def status(self):
+        """
+
+        :return: the number of samples in each state, the throughput in samples per second and the estimated
+        number of seconds to finish
+        """
+        counts = {}
+        for dispatched, status, duplicate_of in self.samples.values_list('dispatched', 'task__status',
+                                                                         'duplicate_of'):
+            if duplicate_of is not None:
+                status = DUPLICATE
+            elif status is None:
+                status = states.PENDING if dispatched else NOT_STARTED
+            counts[status] = counts.get(status, 0) + 1
+        total = sum(counts.values())
+        finished = sum(counts.get(s, 0) for s in FINISHED_STATUSES)
+        elapsed = (timezone.now() - self.created).total_seconds()
+        throughput = finished / elapsed if elapsed > 0 else 0.0
+        return {'total': total,
+                'finished': finished,
+                'counts': counts,
+                'samples_per_second': throughput,
+                'eta_seconds': (total - finished) / throughput if throughput else None
+                }
+
+
+class BulkDeletion(models.Model):
+    created = models.DateTimeField(auto_now_add=True)
+    finished = models.DateTimeField(default=None, null=True)
+    gene_collection = models.ForeignKey(GeneCollection, on_delete=models.CASCADE)
+    task = models.ForeignKey(TaskResult, on_delete=models.SET_NULL, default=None, null=True)
+    total_samples = models.IntegerField(default=0)
+    samples_deleted = models.IntegerField(default=0)
+    documents_deleted = models.BigIntegerField(default=0)
+
+    def start(self, sample_names=None):
+        """
+        Hides the coverage of the samples straight away and sends the task removing their documents and ingestions.
+        The samples are marked as deleted only if their coverage could be hidden, and the task is sent once they are
+
+        :param sample_names: the names of the samples to delete, all the samples of the gene collection if None
+        """
+        with transaction.atomic():
+            samples = SampleIngestion.objects.filter(gene_collection=self.gene_collection, deletion__isnull=True)
+            if sample_names is not None:
+                samples = samples.filter(name__in=sample_names)
+            self.total_samples = samples.update(deletion=self)
+            self.save(update_fields=['total_samples'])
+            sm = SampleManager()
+            sample_names = list(self.samples.values_list('name', flat=True))
+            registered = sm.get_versions(sample_names, self.gene_collection.name)
+            cm = CoverageManager()
+            cm.hide_samples(sample_names, self.gene_collection.name)
+            try:
+                sm.remove_samples(sample_names, self.gene_collection.name)
+            except Exception:
+                # the samples are kept, so is their coverage
+                cm.show_samples(sample_names, self.gene_collection.name)
+                raise
+            transaction.on_commit(lambda: purge.delay(self.pk, registered))
+
+    def add_progress(self, samples_deleted=0, documents_deleted=0):
+        BulkDeletion.objects.filter(pk=self.pk).update(samples_deleted=F('samples_deleted') + samples_deleted,
+                                                       documents_deleted=F('documents_deleted') + documents_deleted)
+
+
 class SampleIngestion(models.Model):
     name = models.CharField(max_length=50)
     input_file = models.CharField(max_length=1000)
@@ -21,6 +171,21 @@ class SampleIngestion(models.Model):
     task = models.ForeignKey(TaskResult, on_delete=models.CASCADE, default=None, null=True)
     name_slug = models.SlugField(max_length=200, unique=True, editable=False, null=True)
     seconds = models.IntegerField(default=None, null=True)
+    batch = models.ForeignKey(IngestionBatch, related_name='samples', on_delete=models.SET_NULL, default=None,
+                              null=True)
+    dispatched = models.BooleanField(default=False)
+    genes_committed = models.IntegerField(default=0)
+    content_hash = models.CharField(max_length=64, default=None, null=True, db_index=True)
+    file_size = models.BigIntegerField(default=None, null=True)
+    file_mtime = models.FloatField(default=None, null=True)
+    # an ingestion whose content was stored by another one has no coverage of its own, it is deleted first
+    duplicate_of = models.ForeignKey('self', related_name='duplicates', on_delete=models.PROTECT, default=None,
+                                     null=True)
+    deletion = models.ForeignKey(BulkDeletion, related_name='samples', on_delete=models.SET_NULL, default=None,
+                                 null=True)
+    # coverage of every version is stored apart, queries read the version of the last successful ingestion. Samples
+    # ingested before versions were introduced have none
+    version = models.PositiveIntegerField(default=1, null=True)
 
     class Meta:
         unique_together = ('name', 'gene_collection',)
@@ -28,15 +193,211 @@ class SampleIngestion(models.Model):
     def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
         self.name_slug = '-'.join((slugify(self.name), slugify(self.gene_collection.name)))
         if self.pk is None:
+            # samples in a batch are sent by the batch itself
+            self.dispatched = self.batch_id is None
             super(SampleIngestion, self).save(force_insert, force_update, using, update_fields)
-            ingest.delay(self.pk)
+            if self.dispatched:
+                ingest.delay(self.pk)
         else:
             super(SampleIngestion, self).save(force_insert, force_update, using, update_fields)
 
+    @staticmethod
+    def statuses(slugs):
+        """
+
+        :param slugs: the `name_slug` of the ingestions
+        :return: the status of every ingestion found, read with a single query
+        """
+        return {slug: ingestion_status(task_status, duplicate_of, deletion)
+                for slug, task_status, duplicate_of, deletion in
+                SampleIngestion.objects.filter(name_slug__in=slugs).values_list('name_slug', 'task__status',
+                                                                                  'duplicate_of', 'deletion')}
+
+    @staticmethod
+    def wait_statuses(known, timeout):
+        """
+        Waits until the status of any of the ingestions differs from the one known by the caller, all of them are
+        finished or the timeout expires. Statuses are checked with a single query, first every
+        INGESTION_STATUS_POLL_SECONDS and then less and less often.
+
+        :param known: the status known by the caller of every `name_slug`, None when it is unknown
+        :param timeout: the maximum number of seconds to wait
+        :return: the status of every ingestion found
+        """
+        deadline = time.time() + timeout
+        poll_seconds = INGESTION_STATUS_POLL_SECONDS
+        while True:
+            statuses = SampleIngestion.statuses(list(known))
+            changed = any(statuses.get(slug) != status for slug, status in known.items())
+            finished = all(status in FINISHED_STATUSES for status in statuses.values())
+            remaining = deadline - time.time()
+            if changed or finished or remaining <= 0:
+                return statuses
+            time.sleep(min(poll_seconds, remaining))
+            poll_seconds = min(poll_seconds * 2, INGESTION_STATUS_MAX_POLL_SECONDS)
+
+    def _originals(self):
+        """
+
+        :return: the successful ingestions of the gene collection whose content was not found elsewhere
+        """
+        return SampleIngestion.objects.filter(gene_collection=self.gene_collection, duplicate_of__isnull=True,
+                                              task__status=states.SUCCESS).exclude(pk=self.pk)
+
+    def _hash(self):
+        """
+
+        :return: the content hash of the input file, read from an ingestion of the same unchanged file if any
+        """
+        same_file = SampleIngestion.objects.filter(input_file=self.input_file, file_size=self.file_size,
+                                                   file_mtime=self.file_mtime, content_hash__isnull=False
+                                                   ).exclude(pk=self.pk).first()
+        return same_file.content_hash if same_file is not None else content_hash(self.input_file)
+
+    def fingerprint(self):
+        """
+        Records the size and modification time of the input file, and its content hash if a successful ingestion
+        of the gene collection has a file of the same size. Files of a size never ingested are read only once, by
+        the ingestion itself. The originals of the same size are hashed then if they were not, as long as their
+        file is unchanged.
+        """
+        self.file_size, self.file_mtime = file_signature(self.input_file)
+        same_size = self._originals().filter(file_size=self.file_size)
+        if same_size.exists():
+            for original in same_size.filter(content_hash__isnull=True):
+                try:
+                    unchanged = file_signature(original.input_file) == (original.file_size, original.file_mtime)
+                except OSError:
+                    unchanged = False
+                if unchanged:
+                    SampleIngestion.objects.filter(pk=original.pk).update(content_hash=original._hash())
+            self.content_hash = self._hash()
+        self.save(update_fields=['file_size', 'file_mtime', 'content_hash'])
+
+    def find_duplicate(self):
+        """
+
+        :return: the first successful ingestion of the same content for the same gene collection, if any
+        """
+        if self.content_hash is None:
+            return None
+        return SampleIngestion.objects.filter(gene_collection=self.gene_collection, content_hash=self.content_hash,
+                                              duplicate_of__isnull=True, task__status=states.SUCCESS
+                                              ).exclude(pk=self.pk).order_by('pk').first()
+
+    def resume(self):
+        """
+        Sends again a failed ingestion, it continues after the genes already stored
+        """
+        ingest.delay(self.pk)
+
+    def replace(self, input_file):
+        """
+        Ingests a new coverage file for the sample as a new version. Queries keep reading the current version until
+        the new one is complete, then they switch to it at once and the previous versions are removed in the
+        background. If the ingestion fails the current version stays.
+
+        :param input_file: the path to the new coverage file
+        """
+        self.input_file = input_file
+        # replacements start at version 2, also for samples ingested before versions, so only first ingestions
+        # are at version 1
+        self.version = (self.version or 1) + 1
+        self.task = None
+        self.genes_committed = 0
+        self.seconds = None
+        self.content_hash = None
+        self.file_size = None
+        self.file_mtime = None
+        self.duplicate_of = None
+        self.save()
+        ingest.delay(self.pk)
+
     def delete(self, using=None, keep_parents=False):
+        # checked before any coverage is removed
+        duplicates = list(self.duplicates.all())
+        if duplicates:
+            raise ProtectedError('The coverage of sample {} is shared by the duplicated ingestions of samples {}, '
+                                 'delete them first'.format(self.name, ', '.join(d.name for d in duplicates)),
+                                 duplicates)
         cm = CoverageManager()
         sm = SampleManager()
+        registered = sm.get_versions([self.name], self.gene_collection.name)
+        cm.hide_samples([self.name], self.gene_collection.name)
+        if self.name in registered:
+            AggregateManager().remove_sample(self.name, self.gene_collection.name, registered[self.name])
         cm.remove_coverage_data(self.name, self.gene_collection.name)
         sm.remove_sample(self.name, self.gene_collection.name)
+        cm.show_samples([self.name], self.gene_collection.name)
         delete_stats = super(SampleIngestion, self).delete(using=None, keep_parents=False)
         return delete_stats
+
+
+class IngestionMetrics(models.Model):
+    """
+    Wall time of every stage of one attempt to ingest a sample and the amount of data that went through it
+    """
+    sample_ingestion = models.ForeignKey(SampleIngestion, related_name='metrics', on_delete=models.CASCADE)
+    created = models.DateTimeField(auto_now_add=True)
+    # the number of previous attempts, including retries and resumptions
+    attempt = models.PositiveIntegerField(default=0)
+    succeeded = models.BooleanField(default=False)
+    seconds = models.FloatField(default=0.0)
+    fingerprint_seconds = models.FloatField(default=0.0)
+    read_seconds = models.FloatField(default=0.0)
+    transform_seconds = models.FloatField(default=0.0)
+    insert_seconds = models.FloatField(default=0.0)
+    sample_seconds = models.FloatField(default=0.0)
+    bytes_read = models.BigIntegerField(default=0)
+    genes = models.IntegerField(default=0)
+    transcripts = models.IntegerField(default=0)
+    exons = models.BigIntegerField(default=0)
+    documents = models.IntegerField(default=0)
+    document_bytes = models.BigIntegerField(default=0)
+    batches = models.IntegerField(default=0)
+    batch_seconds_total = models.FloatField(default=0.0)
+    batch_seconds_max = models.FloatField(default=None, null=True)
+
+    @classmethod
+    def record(cls, sample_ingestion, stats, succeeded=False):
+        """
+
+        :param sample_ingestion: the SampleIngestion the attempt belongs to
+        :param stats: the IngestionStats of the attempt
+        :param succeeded: whether the attempt finished the ingestion
+        :return: the metrics stored
+        """
+        values = stats.to_json_dict()
+        stages = values.pop('stages')
+        attempt = sample_ingestion.metrics.count()
+        return cls.objects.create(sample_ingestion=sample_ingestion, attempt=attempt, succeeded=succeeded,
+                                  **dict(values, **{'{}_seconds'.format(s): stages[s] for s in STAGES}))
+
+    @staticmethod
+    def summary(queryset):
+        """
+        Aggregates the metrics of many attempts, the bottleneck is the stage taking the largest share of the time
+
+        :param queryset: the IngestionMetrics to aggregate
+        :return: the totals, the time and share of every stage, the throughput and the bottleneck stage
+        """
+        stage_fields = {s: Sum('{}_seconds'.format(s)) for s in STAGES}
+        totals = queryset.aggregate(runs=Count('pk'), seconds=Sum('seconds'), bytes_read=Sum('bytes_read'),
+                                    genes=Sum('genes'), transcripts=Sum('transcripts'), exons=Sum('exons'),
+                                    documents=Sum('documents'), document_bytes=Sum('document_bytes'),
+                                    batches=Sum('batches'), batch_seconds_total=Sum('batch_seconds_total'),
+                                    batch_seconds_max=Max('batch_seconds_max'), **stage_fields)
+        stage_seconds = {s: totals.pop(s) or 0.0 for s in STAGES}
+        seconds = totals['seconds'] or 0.0
+        batches = totals.pop('batches') or 0
+        batch_seconds_total = totals.pop('batch_seconds_total') or 0.0
+        summary = {k: v or 0 for k, v in totals.items()}
+        summary['stages'] = {s: {'seconds': v, 'share': v / seconds if seconds else 0.0}
+                             for s, v in stage_seconds.items()}
+        summary['bottleneck'] = max(STAGES, key=stage_seconds.get) if seconds else None
+        summary['genes_per_second'] = summary['genes'] / seconds if seconds else 0.0
+        summary['bytes_read_per_second'] = summary['bytes_read'] / seconds if seconds else 0.0
+        summary['batches'] = batches
+        summary['batch_seconds_mean'] = batch_seconds_total / batches if batches else None
+        summary['batch_seconds_max'] = totals['batch_seconds_max']
+        return summary
@@ -5,34 +5,206 @@ import time
 from celery import shared_task, states
 from django.apps import apps
 from django_celery_results.models import TaskResult
+from pymongo.errors import ConnectionFailure
+
+from django.utils import timezone
+
+from coveragedb.settings import INGESTION_MAX_RETRIES, INGESTION_RETRY_DELAY
+from coveragedata.aggregate_manager import AggregateManager
+from coveragedata.coverage_manager import CoverageManager
+from coveragedata.sample_manager import SampleManager
 from coveragedbingestion.ingest_data import ingest_data
+from coveragedbingestion.metrics import IngestionStats, STAGES
 
 
-@shared_task
-def ingest(sample_ingest_id):
+def update_aggregates(sample_name, gene_collection, version, registered, stats):
+    """
+    Replaces in the gene aggregates the coverage of the version of the sample registered before the ingestion by the
+    new one. It runs before the new version is registered, so a version already registered was added in full by a
+    previous attempt, and the aggregates skip the genes a failed attempt updated already.
+    """
+    if sample_name in registered and registered[sample_name] == version:
+        return
+    start = time.perf_counter()
+    am = AggregateManager()
+    if sample_name in registered:
+        am.remove_sample(sample_name, gene_collection, registered[sample_name])
+    am.add_sample(sample_name, gene_collection, version)
+    stats.seconds['sample'] += time.perf_counter() - start
+
+
+@shared_task(bind=True, max_retries=INGESTION_MAX_RETRIES, default_retry_delay=INGESTION_RETRY_DELAY)
+def ingest(self, sample_ingest_id):
     sample_ingestion_model = apps.get_model('coveragedbingestion', 'SampleIngestion')
+    ingestion_metrics_model = apps.get_model('coveragedbingestion', 'IngestionMetrics')
     logging.info(sample_ingestion_model)
     sample_ingest = sample_ingestion_model.objects.get(id=sample_ingest_id)
-    task_id = ingest.request.id
+    task_id = self.request.id
     logging.info("Starting task with id '{}'".format(task_id))
-    # saves the task in pending status
-    task_result = TaskResult(task_id=task_id)
+    # saves the task in started status, a retried task keeps its id
+    task_result, _ = TaskResult.objects.get_or_create(task_id=task_id)
     task_result.status = states.STARTED
     task_result.save()
+    # any previous attempt may have stored some genes
+    resume = sample_ingest.task_id is not None
     # associates the task to the sample ingestion entity
     sample_ingest.task = task_result
     sample_ingest.save()
+    retrying = False
+    succeeded = False
+    stats = IngestionStats()
+
+    def checkpoint(genes_committed):
+        sample_ingestion_model.objects.filter(pk=sample_ingest.pk).update(genes_committed=genes_committed)
+        # tells batches the task is alive
+        TaskResult.objects.filter(task_id=task_id).update(date_done=timezone.now())
+
+    if sample_ingest.genes_committed:
+        logging.info("Resuming ingestion after {} genes".format(sample_ingest.genes_committed))
     start_time = time.time()
     try:
+        if not resume:
+            fingerprint_start = time.perf_counter()
+            sample_ingest.fingerprint()
+            stats.seconds['fingerprint'] = time.perf_counter() - fingerprint_start
+            # a replacement stores the data of the sample even if the same content is stored for another one
+            replacement = sample_ingest.version is not None and sample_ingest.version > 1
+            duplicate_of = sample_ingest.find_duplicate() if not replacement else None
+            if duplicate_of is not None:
+                logging.info("The content of '{}' was already ingested by sample '{}', skipping it".format(
+                    sample_ingest.input_file, duplicate_of.name))
+                sample_ingest.duplicate_of = duplicate_of
+                sample_ingest.seconds = int(time.time() - start_time)
+                sample_ingest.save(update_fields=["duplicate_of", "seconds"])
+                return
+        gene_collection = sample_ingest.gene_collection.name
+        registered = SampleManager().get_versions([sample_ingest.name], gene_collection)
+        cm = CoverageManager()
+        # queries skip the new version until it is registered
+        cm.hide_version(sample_ingest.name, gene_collection, sample_ingest.version)
         ingest_data(input_file=sample_ingest.input_file, sample=sample_ingest.name,
-                    gene_collection_id=sample_ingest.gene_collection.name)
+                    gene_collection_id=gene_collection,
+                    skip_genes=sample_ingest.genes_committed, resume=resume, on_checkpoint=checkpoint, stats=stats,
+                    version=sample_ingest.version,
+                    on_stored=lambda: update_aggregates(sample_ingest.name, gene_collection, sample_ingest.version,
+                                                        registered, stats))
+        # any other version stored, including the coverage stored before versions, is removed in the background
+        if cm.show_version(sample_ingest.name, gene_collection, sample_ingest.version):
+            collect_versions.delay(sample_ingest.name, gene_collection, sample_ingest.version)
+        succeeded = True
         seconds = time.time() - start_time
         logging.info("Task succeeded in {} seconds!".format(seconds))
+        logging.info("Seconds per stage: {}".format(
+            ", ".join("{} {:.3f}".format(stage, stats.seconds[stage]) for stage in STAGES)))
         sample_ingest.seconds = int(seconds)
         sample_ingest.save(update_fields=["seconds"])
+    except ConnectionFailure as ex:
+        seconds = time.time() - start_time
+        sample_ingest.seconds = int(seconds)
+        sample_ingest.save(update_fields=["seconds"])
+        if self.request.retries >= self.max_retries:
+            logging.error("Task failed: {}".format(str(ex)))
+            raise ex
+        # the retry resumes from the last checkpoint
+        logging.warning("Task interrupted, it will be retried: {}".format(str(ex)))
+        retrying = True
+        raise self.retry(exc=ex)
     except Exception as ex:
         seconds = time.time() - start_time
         sample_ingest.seconds = int(seconds)
         sample_ingest.save(update_fields=["seconds"])
         logging.error("Task failed: {}".format(str(ex)))
         raise ex
+    finally:
+        if sample_ingest.duplicate_of_id is None:
+            ingestion_metrics_model.record(sample_ingest, stats, succeeded=succeeded)
+        # frees the slot of this sample for the next one in the batch
+        if not retrying and sample_ingest.batch_id is not None:
+            sample_ingest.batch.dispatch(1)
+
+
+@shared_task
+def refill_batch(batch_id):
+    """
+    Gives the free slots of a batch to its next samples, it is the errback of the ingestion of every sample of the
+    batch so slots are freed also when a task fails before freeing its own one or its worker is killed
+    """
+    ingestion_batch_model = apps.get_model('coveragedbingestion', 'IngestionBatch')
+    sent = ingestion_batch_model.objects.get(id=batch_id).refill()
+    if sent:
+        logging.info("Sent {} samples of batch {} to free slots".format(len(sent), batch_id))
+
+
+@shared_task
+def refill_batches():
+    """
+    Gives the free slots of every batch with samples waiting to their next samples, it runs periodically to recover
+    the slots of ingestions lost with their worker
+    """
+    ingestion_batch_model = apps.get_model('coveragedbingestion', 'IngestionBatch')
+    for batch_id in ingestion_batch_model.objects.filter(samples__dispatched=False).values_list(
+            'id', flat=True).distinct():
+        refill_batch(batch_id)
+
+
+@shared_task(bind=True)
+def purge(self, bulk_deletion_id, registered=None):
+    """
+    Removes the coverage of the samples of a bulk deletion in batches
+
+    :param registered: the version of the coverage of every sample registered before the deletion
+    """
+    bulk_deletion_model = apps.get_model('coveragedbingestion', 'BulkDeletion')
+    sample_ingestion_model = apps.get_model('coveragedbingestion', 'SampleIngestion')
+    bulk_deletion = bulk_deletion_model.objects.get(id=bulk_deletion_id)
+    task_id = self.request.id
+    logging.info("Starting bulk deletion task with id '{}'".format(task_id))
+    task_result, _ = TaskResult.objects.get_or_create(task_id=task_id)
+    task_result.status = states.STARTED
+    task_result.save()
+    bulk_deletion.task = task_result
+    bulk_deletion.save(update_fields=["task"])
+    cm = CoverageManager()
+    am = AggregateManager()
+    registered = registered or {}
+    start_time = time.time()
+    try:
+        # duplicated ingestions go first, their originals cannot be deleted before them
+        for sample_ingestion in sorted(bulk_deletion.samples.all(), key=lambda s: s.duplicate_of_id is None):
+            if sample_ingestion.name in registered:
+                am.remove_sample(sample_ingestion.name, bulk_deletion.gene_collection.name,
+                                 registered.pop(sample_ingestion.name))
+            # the coverage is already hidden, it is removed in batches so no single operation takes long
+            while True:
+                documents_deleted = cm.remove_coverage_data_batch(sample_ingestion.name,
+                                                                  bulk_deletion.gene_collection.name)
+                if not documents_deleted:
+                    break
+                bulk_deletion.add_progress(documents_deleted=documents_deleted)
+            cm.show_samples([sample_ingestion.name], bulk_deletion.gene_collection.name)
+            # deletes the queryset to skip the synchronous removal of SampleIngestion.delete
+            sample_ingestion_model.objects.filter(pk=sample_ingestion.pk).delete()
+            bulk_deletion.add_progress(samples_deleted=1)
+        bulk_deletion.finished = timezone.now()
+        bulk_deletion.save(update_fields=["finished"])
+        logging.info("Bulk deletion succeeded in {} seconds!".format(time.time() - start_time))
+    except Exception as ex:
+        logging.error("Bulk deletion failed: {}".format(str(ex)))
+        raise ex
+
+
+@shared_task
+def collect_versions(sample_name, gene_collection, version):
+    """
+    Removes in batches the coverage of the versions of a sample before the one queries read
+    """
+    cm = CoverageManager()
+    documents_deleted = 0
+    while True:
+        deleted = cm.remove_coverage_data_batch(sample_name, gene_collection, below_version=version)
+        if not deleted:
+            break
+        documents_deleted += deleted
+    cm.forget_versions(sample_name, gene_collection, version)
+    logging.info("{} documents of previous versions of sample {} for collection {} were removed".format(
+        documents_deleted, sample_name, gene_collection))
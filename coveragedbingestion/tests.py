@@ -1,8 +1,47 @@
+import copy
+import gzip
+import io
+import json
+import os
+import sys
+import tempfile
+from collections import OrderedDict
+from datetime import timedelta
+
+import numpy
+from unittest import skipIf
+
+from bson import BSON
+from bson.raw_bson import RawBSONDocument
+
+from celery import states
 from django.test import TestCase
-from mock import patch
+from django.utils import timezone
+from django_celery_results.models import TaskResult
+from mock import patch, Mock
+from pymongo.errors import ConnectionFailure, PyMongoError
+from rest_framework.test import APIClient
+from coveragedb.settings import INGESTION_BATCH_STALL_SECONDS
 import coveragedbingestion.ingest_data as ingest_data
-from coveragedata.coverage_manager import CoverageManager
+from coveragedbingestion.coverage_reader import CoverageReader, open_coverage_file
+from coveragedbingestion.metrics import IngestionStats, STAGES
+from coveragedbingestion.models import GeneCollection, SampleIngestion, IngestionBatch, IngestionMetrics, \
+    BulkDeletion, DUPLICATE, DELETING
+from coveragedbingestion.fingerprint import content_hash
+from coveragedbingestion.tasks import ingest, purge, collect_versions, refill_batch, update_aggregates
+from coveragedata.aggregate_manager import AggregateManager
+from coveragedata.bulk_writer import BulkWriter, BulkWriteStats
+from coveragedata.models import GeneCoverage, CoverageMatrix, TranscriptCoverage
+from coveragedata.packing import pack_exons, unpack_exons, pack_transcript, PACKED_EXONS_KEY
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+from coveragedata.coverage_manager import CoverageManager, COVERAGE_DEPTH_PROJECTIONS
 from coveragedata.sample_manager import SampleManager
+from webservices.renderers import NpzRenderer
+from webservices.serializers import BulkDeletionSerializer
 
 
 class TestDataIngestion(TestCase):
@@ -10,11 +49,756 @@ class TestDataIngestion(TestCase):
     def setUp(self):
         self.input_file = "../resources/test/mocked_coverage_1520552294_0.json"
 
-    @patch.object(CoverageManager, 'add_coverage_data', lambda self, x: None)
+    @patch.object(CoverageManager, 'add_coverage_data', lambda self, x, **kwargs: BulkWriteStats())
     @patch.object(SampleManager, 'add_sample',
-                  lambda self, sample_name, number_of_genes, parameters, coding_region, whole_genome, gene_collection: None)
+                  lambda self, sample_name, number_of_genes, parameters, coding_region, whole_genome, gene_collection,
+                  version=None: None)
     def test1(self):
         try:
             ingest_data.ingest_data(self.input_file, "test_sample", "test_gene_collection")
         except Exception as e:
             self.assertTrue(False, "Ingestion returned an error: {}".format(str(e)))
+
+    def test_streamed_ingestion(self):
+        with open(self.input_file) as fd:
+            expected = json.load(fd)
+        inserted = []
+        with patch.object(CoverageManager, 'add_coverage_data',
+                          lambda self, x, **kwargs: inserted.extend(x) or BulkWriteStats()), \
+                patch.object(SampleManager, 'add_sample') as add_sample:
+            ingest_data.ingest_data(self.input_file, "test_sample", "test_gene_collection")
+        genes = ingest_data.transform_data(expected['results']['genes'])
+        self.assertEqual(list(ingest_data.build_coverage_document("test_sample", genes, "test_gene_collection")),
+                         inserted)
+        add_sample.assert_called_once_with(sample_name="test_sample", number_of_genes=len(genes),
+                                           parameters=expected['parameters'],
+                                           coding_region=expected['results']['coding_region'], whole_genome={},
+                                           gene_collection="test_gene_collection", version=None)
+
+    def test_resumed_ingestion(self):
+        inserted = []
+        with patch.object(CoverageManager, 'add_coverage_data') as add_coverage_data, \
+                patch.object(SampleManager, 'add_sample') as add_sample:
+            add_coverage_data.side_effect = lambda x, **kwargs: inserted.extend(x) or BulkWriteStats()
+            ingest_data.ingest_data(self.input_file, "test_sample", "test_gene_collection", skip_genes=1)
+        self.assertEqual(['CFTR'], [d['name'] for d in inserted])
+        self.assertTrue(add_coverage_data.call_args[1]['resume'])
+        self.assertEqual(2, add_sample.call_args[1]['number_of_genes'])
+
+    def test_ingestion_stats(self):
+        collection = Mock()
+        with patch.object(CoverageManager, 'add_coverage_data',
+                          lambda self, x, **kwargs: BulkWriter(collection, batch_size=1, batch_bytes=1024 * 1024,
+                                                               writers=1).write(x)), \
+                patch.object(SampleManager, 'add_sample'):
+            stats = ingest_data.ingest_data(self.input_file, "test_sample", "test_gene_collection")
+        genes = ingest_data.transform_data(json.load(open(self.input_file))['results']['genes'])
+        self.assertEqual(len(genes), stats.genes)
+        self.assertEqual(sum(len(g['trs']) for g in genes), stats.transcripts)
+        self.assertEqual(len(genes), stats.documents)
+        self.assertEqual(len(genes), len(stats.batch_latencies))
+        self.assertEqual(os.path.getsize(self.input_file), stats.bytes_read)
+        self.assertTrue(all(stats.seconds[stage] > 0 for stage in ('read', 'transform', 'insert', 'sample')))
+
+
+class SampleIngestionTestCase(TestCase):
+    """
+    Creates the gene collection groupA, the samples of the tests are created in it without sending their tasks
+    """
+
+    def setUp(self):
+        self.gene_collection = GeneCollection.objects.create(name='groupA')
+
+    def create_samples(self, count, statuses=(), **fields):
+        """
+
+        :param count: the number of samples, named sample0, sample1... and read from sample0.json, sample1.json...
+        :param statuses: the status of the task of the first samples, the other samples have no task
+        :param fields: any other field of the samples
+        :return: the sample ingestions
+        """
+        with patch('coveragedbingestion.models.ingest') as self.ingest:
+            samples = [SampleIngestion.objects.create(**dict({'name': 'sample{}'.format(i),
+                                                              'input_file': 'sample{}.json'.format(i),
+                                                              'gene_collection': self.gene_collection}, **fields))
+                       for i in range(count)]
+        for i, (sample, status) in enumerate(zip(samples, statuses)):
+            sample.task = TaskResult.objects.create(task_id='task{}'.format(i), status=status)
+            sample.save()
+        return samples
+
+
+class TestIngestionMetrics(SampleIngestionTestCase):
+
+    def setUp(self):
+        super(TestIngestionMetrics, self).setUp()
+        self.sample_ingestion, = self.create_samples(1)
+
+    def record(self, **seconds):
+        stats = IngestionStats()
+        stats.seconds.update(seconds)
+        stats.genes = 10
+        stats.batch_latencies = [0.5, 1.5]
+        return IngestionMetrics.record(self.sample_ingestion, stats, succeeded=True)
+
+    def test_record(self):
+        self.assertEqual(0, self.record(read=1.0).attempt)
+        metrics = self.record(read=1.0, insert=2.0)
+        self.assertEqual(1, metrics.attempt)
+        self.assertEqual(3.0, metrics.seconds)
+        self.assertEqual(2, metrics.batches)
+        self.assertEqual(1.5, metrics.batch_seconds_max)
+
+    def test_summary(self):
+        self.record(read=1.0, transform=1.0, insert=2.0)
+        self.record(read=1.0, transform=3.0, insert=2.0)
+        summary = IngestionMetrics.summary(IngestionMetrics.objects.all())
+        self.assertEqual(2, summary['runs'])
+        self.assertEqual('transform', summary['bottleneck'])
+        self.assertEqual(0.4, summary['stages']['transform']['share'])
+        self.assertEqual(set(STAGES), set(summary['stages']))
+        self.assertEqual(2.0, summary['genes_per_second'])
+        self.assertEqual(1.0, summary['batch_seconds_mean'])
+
+    def test_empty_summary(self):
+        summary = IngestionMetrics.summary(IngestionMetrics.objects.none())
+        self.assertEqual(0, summary['runs'])
+        self.assertIsNone(summary['bottleneck'])
+
+
+class TestDeduplication(SampleIngestionTestCase):
+
+    def setUp(self):
+        super(TestDeduplication, self).setUp()
+        self.input_file = "../resources/test/mocked_coverage_1520552294_0.json"
+        self.original, self.resubmitted = self.create_samples(2, [states.SUCCESS], input_file=self.input_file)
+
+    def test_duplicate(self):
+        with patch('coveragedbingestion.models.content_hash', side_effect=content_hash) as hashed:
+            # no other ingestion of this size, the file is not hashed
+            self.original.fingerprint()
+            self.assertIsNone(self.original.content_hash)
+            # the original is hashed now and its hash is reused for the same unchanged file
+            self.resubmitted.fingerprint()
+            self.assertEqual(1, hashed.call_count)
+        self.original.refresh_from_db()
+        self.assertEqual(self.original.content_hash, self.resubmitted.content_hash)
+        self.assertEqual(self.original, self.resubmitted.find_duplicate())
+
+    def test_other_gene_collection(self):
+        self.original.fingerprint()
+        self.resubmitted.gene_collection = GeneCollection.objects.create(name='groupB')
+        with patch('coveragedbingestion.models.content_hash') as hashed:
+            self.resubmitted.fingerprint()
+            hashed.assert_not_called()
+        self.assertIsNone(self.resubmitted.find_duplicate())
+
+    @patch('coveragedbingestion.tasks.ingest_data')
+    @patch.object(SampleManager, 'add_sample')
+    def test_duplicate_not_registered(self, add_sample, ingest_data_):
+        # the coverage endpoints return nothing for the sample of a duplicated ingestion
+        with patch.object(SampleIngestion, 'find_duplicate', return_value=self.original):
+            ingest.apply(args=(self.resubmitted.pk,))
+        self.resubmitted.refresh_from_db()
+        self.assertEqual(self.original, self.resubmitted.duplicate_of)
+        ingest_data_.assert_not_called()
+        add_sample.assert_not_called()
+
+
+class TestTransform(TestCase):
+
+    def setUp(self):
+        with open("../resources/test/mocked_coverage_1521067460_0.json") as fd:
+            self.genes = json.load(fd)['results']['genes']
+
+    def test_clean_exon(self):
+        exon = {'e': 200, 's': 100, 'exon': 'exon1', 'gaps': [{'s': 110, 'e': 115}, {'s': 120, 'e': 130}],
+                'stats': {k: i for i, k in enumerate(reversed(ingest_data.STATS_ORDERED_KEYS))}}
+        ingest_data.clean_exon(exon)
+        self.assertEqual({'e': 200, 's': 100, 'gaps': [(120, 130)], 'stats': [7, 6, 5, 4, 3, 2, 1, 0]}, exon)
+
+    def test_minimize_genes(self):
+        expected = copy.deepcopy(self.genes)
+        for gene in expected:
+            for transcript in [gene['union_tr']] + gene['trs']:
+                for exon in transcript['exons']:
+                    ingest_data.clean_exon(exon)
+        genes = ingest_data.minimize_genes(self.genes)
+        self.assertEqual([BSON.encode(g) for g in expected], [BSON.encode(g) for g in genes])
+
+    def test_transform_genes_in_chunks(self):
+        expected = ingest_data.transform_data(copy.deepcopy(self.genes))
+        self.assertEqual(expected, list(ingest_data.transform_genes(iter(self.genes), chunk_size=1)))
+
+
+class TestPacking(TestCase):
+
+    def setUp(self):
+        with open("../resources/test/mocked_coverage_1520552294_0.json") as fd:
+            genes = ingest_data.transform_data(json.load(fd)['results']['genes'])
+        self.documents = [BSON.encode(d) for d in ingest_data.build_coverage_document("test_sample", genes, "test")]
+        self.packed_documents = [BSON.encode(d) for d in
+                                 ingest_data.build_coverage_document("test_sample", genes, "test", packed=True)]
+
+    def assertIdentical(self, expected, actual):
+        # JSON tells integers and floats apart, 1200 and 1200.0 are equal in Python
+        self.assertEqual(json.dumps(expected, sort_keys=True), json.dumps(actual, sort_keys=True))
+
+    def test_unpack_exons(self):
+        exons = [{'s': 100, 'e': 200, 'stats': [1.5, 0.03402, None, 3, 4, None, 6.5, 7.0],
+                  'gaps': [[110, 120], [130, 140]]},
+                 {'s': 300, 'e': 400, 'stats': [8.0, 9.0, 10, 11, 1200, None, 0.123456789, 15.25], 'gaps': []}]
+        packed = pack_exons(exons)
+        self.assertEqual('ffiiifdf', packed['sc'])
+        self.assertIdentical(exons, unpack_exons(BSON.encode({'x': packed}).decode()['x']))
+
+    def test_mixed_exons_not_packed(self):
+        exons = [{'s': 1, 'e': 2, 'stats': [1, 1.5, 1, 1, 1, 1, 1, 1], 'gaps': []},
+                 {'s': 3, 'e': 4, 'stats': [1.5, 1.5, 1, 1, 1, 1, 1, 2 ** 40], 'gaps': []}]
+        self.assertRaises(ValueError, pack_exons, exons)
+        transcript = {'id': 'tr', 'stats': {}, 'exons': exons}
+        self.assertIs(transcript, pack_transcript(transcript))
+
+    def test_packed_integer_stats(self):
+        with open("../resources/test/mocked_coverage_1520552294_0.json") as fd:
+            genes = ingest_data.transform_data(json.load(fd)['results']['genes'])
+        # some statistics are counts
+        for gene in genes:
+            for transcript in [gene['union_tr']] + gene['trs']:
+                for exon in transcript['exons']:
+                    exon['stats'][6] = int(exon['stats'][6] * 1000)
+        documents = ingest_data.build_coverage_document("test_sample", copy.deepcopy(genes), "test")
+        packed_documents = ingest_data.build_coverage_document("test_sample", genes, "test", packed=True)
+        for document, packed_document in zip(documents, packed_documents):
+            self.assertIn(PACKED_EXONS_KEY, packed_document['union_tr'])
+            decoded = BSON.encode(packed_document).decode()
+            self.assertIdentical(GeneCoverage(document).to_json_dict(), GeneCoverage(decoded).to_json_dict())
+            self.assertEqual(GeneCoverage(document).to_json_text(), GeneCoverage(decoded).to_json_text())
+
+    def test_packed_gene_coverage(self):
+        for document, packed_document in zip(self.documents, self.packed_documents):
+            self.assertLess(len(packed_document), len(document))
+            self.assertIdentical(GeneCoverage(**document.decode()).to_json_dict(),
+                                 GeneCoverage(**packed_document.decode()).to_json_dict())
+
+    def test_raw_gene_coverage(self):
+        for document in self.documents + self.packed_documents:
+            decoded = document.decode()
+            # the serialisation built from the transcript objects
+            expected = {'name': decoded['name'],
+                        'union_transcript': TranscriptCoverage(**decoded['union_tr']).to_json_dict(),
+                        'gen_collection': decoded['gcol'],
+                        'sample': decoded['sample'],
+                        'transcripts': [TranscriptCoverage(**t).to_json_dict() for t in decoded['trs']]
+                        }
+            gene = GeneCoverage(RawBSONDocument(document))
+            self.assertEqual(expected, gene.to_json_dict())
+            self.assertEqual(expected, GeneCoverage(**decoded).to_json_dict())
+            self.assertEqual(expected['transcripts'], [t.to_json_dict() for t in gene.transcripts])
+
+
+class TestCoverageReader(TestCase):
+
+    def setUp(self):
+        self.input_file = "../resources/test/mocked_coverage_1520552294_0.json"
+        with open(self.input_file) as fd:
+            self.expected = json.load(fd)
+
+    def test_small_chunks(self):
+        with open(self.input_file) as fd:
+            reader = CoverageReader(fd, chunk_size=7)
+            genes = list(reader)
+        self.assertEqual(self.expected['results']['genes'], genes)
+        self.assertEqual(len(genes), reader.number_of_genes)
+        self.assertEqual(self.expected['parameters'], reader.parameters)
+        self.assertEqual(self.expected['results']['coding_region'], reader.coding_region)
+
+    def test_sections_in_any_order(self):
+        document = {'parameters': {'threshold': 15}, 'results': {'whole_genome': {'stats': {'avg': 30.5}},
+                                                                 'genes': [], 'coding_region': {}}}
+        reader = CoverageReader(io.StringIO(json.dumps(document, indent=2)), chunk_size=3)
+        self.assertEqual([], list(reader))
+        self.assertEqual(document['parameters'], reader.parameters)
+        self.assertEqual(document['results']['whole_genome'], reader.whole_genome)
+
+    def read_compressed(self, content):
+        fd, path = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, 'wb') as compressed:
+                compressed.write(content)
+            with open_coverage_file(path) as fd:
+                return list(CoverageReader(fd, chunk_size=1024))
+        finally:
+            os.remove(path)
+
+    def test_gzip(self):
+        with open(self.input_file, 'rb') as fd:
+            content = fd.read()
+        self.assertEqual(self.expected['results']['genes'], self.read_compressed(gzip.compress(content)))
+        # bgzip files are made of many gzip members
+        bgzip = b''.join(gzip.compress(content[i:i + 4096]) for i in range(0, len(content), 4096))
+        self.assertEqual(self.expected['results']['genes'], self.read_compressed(bgzip))
+
+    @skipIf(zstandard is None, 'zstandard is not installed')
+    def test_zstd(self):
+        with open(self.input_file, 'rb') as fd:
+            content = zstandard.ZstdCompressor().compress(fd.read())
+        self.assertEqual(self.expected['results']['genes'], self.read_compressed(content))
+
+    def test_malformed(self):
+        reader = CoverageReader(io.StringIO('{"results": {"genes": [{"name": "BRCA1"} {"name": "CFTR"}]}}'))
+        with self.assertRaises(ValueError):
+            list(reader)
+
+
+class TestIngestionBatch(SampleIngestionTestCase):
+
+    def setUp(self):
+        super(TestIngestionBatch, self).setUp()
+        self.batch = IngestionBatch.objects.create(concurrency=2)
+        self.create_samples(3, batch=self.batch)
+        self.ingest.delay.assert_not_called()
+
+    @patch('coveragedbingestion.models.group')
+    def test_dispatch(self, group):
+        self.assertEqual(2, len(self.batch.dispatch(self.batch.concurrency)))
+        self.assertEqual(1, len(self.batch.dispatch(self.batch.concurrency)))
+        self.assertEqual([], self.batch.dispatch(self.batch.concurrency))
+        self.assertEqual(2, group.call_count)
+        status = self.batch.status()
+        self.assertEqual({'PENDING': 3}, status['counts'])
+        self.assertEqual(0, status['finished'])
+        self.assertIsNone(status['eta_seconds'])
+
+    def started(self, name, status=states.STARTED):
+        sample = SampleIngestion.objects.get(name=name)
+        sample.task = TaskResult.objects.create(task_id='task-{}'.format(name), status=status)
+        sample.save()
+        return sample
+
+    @patch('coveragedbingestion.models.group')
+    def test_refill_failed(self, group):
+        self.batch.dispatch(self.batch.concurrency)
+        self.started('sample1')
+        self.assertEqual([], self.batch.refill())
+        # the task failed before freeing its slot
+        self.started('sample0', states.FAILURE)
+        self.assertEqual(1, len(self.batch.refill()))
+        self.assertEqual([], self.batch.refill())
+
+    @patch('coveragedbingestion.models.group')
+    def test_refill_stalled(self, group):
+        self.batch.dispatch(self.batch.concurrency)
+        self.started('sample0')
+        self.started('sample1')
+        self.assertEqual([], self.batch.refill())
+        TaskResult.objects.filter(task_id='task-sample0').update(
+            date_done=timezone.now() - timedelta(seconds=INGESTION_BATCH_STALL_SECONDS + 1))
+        self.assertEqual(1, self.batch.in_flight())
+        self.assertEqual(1, len(self.batch.refill()))
+
+    @patch('coveragedbingestion.models.group')
+    def test_errback(self, group):
+        self.batch.dispatch(1)
+        signature = list(group.call_args[0][0])[0]
+        self.assertEqual(refill_batch.si(self.batch.pk), signature.options['link_error'])
+        with patch('coveragedbingestion.models.group'):
+            self.started('sample0', states.FAILURE)
+            refill_batch(self.batch.pk)
+        self.assertEqual(3, self.batch.samples.filter(dispatched=True).count())
+
+
+class TestIngestionStatus(SampleIngestionTestCase):
+
+    def setUp(self):
+        super(TestIngestionStatus, self).setUp()
+        self.samples = self.create_samples(3, [states.SUCCESS, states.STARTED])
+        self.samples[2].duplicate_of = self.samples[0]
+        self.samples[2].save()
+        self.slugs = [s.name_slug for s in self.samples]
+
+    def test_statuses(self):
+        self.assertEqual(dict(zip(self.slugs, [states.SUCCESS, states.STARTED, DUPLICATE])),
+                         SampleIngestion.statuses(self.slugs + ['unknown-groupa']))
+
+    def test_wait_returns_on_change(self):
+        with patch('coveragedbingestion.models.time.sleep') as sleep:
+            statuses = SampleIngestion.wait_statuses({self.slugs[1]: states.PENDING}, timeout=60)
+            sleep.assert_not_called()
+        self.assertEqual({self.slugs[1]: states.STARTED}, statuses)
+
+    def test_wait_returns_when_finished(self):
+        with patch('coveragedbingestion.models.time.sleep') as sleep:
+            SampleIngestion.wait_statuses({self.slugs[0]: states.SUCCESS, self.slugs[2]: DUPLICATE}, timeout=60)
+            sleep.assert_not_called()
+
+    def test_wait_times_out(self):
+        statuses = SampleIngestion.wait_statuses({self.slugs[1]: states.STARTED}, timeout=0.1)
+        self.assertEqual({self.slugs[1]: states.STARTED}, statuses)
+
+
+class FakeHiddenCollection(object):
+
+    def __init__(self, hidden):
+        self.hidden = hidden
+
+    def find(self, query, projection=None):
+        gene_collections = query.get('gcol', {'$in': [h['gcol'] for h in self.hidden]})
+        if not isinstance(gene_collections, dict):
+            gene_collections = {'$in': [gene_collections]}
+        return [h for h in self.hidden if h['sample'] in query.get('sample', {}).get('$in', [h['sample']]) and
+                h['gcol'] in gene_collections['$in']]
+
+
+class TestVisibleCoverage(TestCase):
+
+    def setUp(self):
+        self.coverage_manager = CoverageManager()
+        self.hidden_collection = FakeHiddenCollection([{'sample': 'sample0', 'gcol': 'groupA', 'shown': 2},
+                                                       {'sample': 'sample1', 'gcol': 'groupA', 'vers': [1]},
+                                                       {'sample': 'sample3', 'gcol': 'groupA', 'all': True},
+                                                       {'sample': 'sample0', 'gcol': 'groupB', 'vers': [None]}])
+
+    def test_hidden_samples(self):
+        with patch.object(CoverageManager, 'hidden_collection', self.hidden_collection):
+            query = self.coverage_manager.visible({'name': 'BRCA1'}, ['sample0', 'sample2'], 'groupA')
+        self.assertEqual({'$and': [{'name': 'BRCA1'}, {'$nor': [{'sample': 'sample0', 'gcol': 'groupA',
+                                                                  'ver': {'$ne': 2}}]}]}, query)
+
+    def test_versions(self):
+        with patch.object(CoverageManager, 'hidden_collection', self.hidden_collection):
+            query = self.coverage_manager.visible({}, gene_collection='groupA')
+        self.assertEqual([{'sample': 'sample0', 'gcol': 'groupA', 'ver': {'$ne': 2}},
+                          {'sample': 'sample1', 'gcol': 'groupA', 'ver': {'$in': [1]}},
+                          {'sample': 'sample3', 'gcol': 'groupA'}],
+                         query['$and'][1]['$nor'])
+
+    def test_many_gene_collections(self):
+        with patch.object(CoverageManager, 'hidden_collection', self.hidden_collection):
+            query = self.coverage_manager.visible({}, ['sample0'])
+        self.assertEqual([{'sample': 'sample0', 'gcol': 'groupA', 'ver': {'$ne': 2}},
+                          {'sample': 'sample0', 'gcol': 'groupB', 'ver': {'$in': [None]}}],
+                         query['$and'][1]['$nor'])
+
+    def test_nothing_hidden(self):
+        # queries are left as they are, whatever the number of samples
+        with patch.object(CoverageManager, 'hidden_collection', self.hidden_collection):
+            query = self.coverage_manager.visible({'gcol': 'groupC'}, gene_collection='groupC')
+        self.assertEqual({'gcol': 'groupC'}, query)
+
+    def test_genes_by_groups(self):
+        coverage_collection = Mock(**{'aggregate.return_value': iter([{'_id': 'BRCA1', 'groups': 2}])})
+        with patch.object(CoverageManager, 'hidden_collection', self.hidden_collection), \
+                patch.object(CoverageManager, 'coverage_collection', coverage_collection):
+            genes = self.coverage_manager.get_genes_by_groups(['groupB', 'groupA', 'groupB'])
+        self.assertEqual(['BRCA1'], genes)
+        pipeline = coverage_collection.aggregate.call_args[0][0]
+        self.assertEqual({'gcol': {'$in': ['groupA', 'groupB']}}, pipeline[0]['$match']['$and'][0])
+        self.assertEqual(4, len(pipeline[0]['$match']['$and'][1]['$nor']))
+        self.assertEqual({'$match': {'groups': 2}}, pipeline[3])
+        self.assertEqual(1, coverage_collection.aggregate.call_count)
+
+    def test_samples_by_groups(self):
+        coverage_collection = Mock(**{'aggregate.return_value': iter(
+            [{'_id': {'sample': 'sample0', 'gcol': 'groupA'}}, {'_id': {'sample': 'sample0', 'gcol': 'groupB'}},
+             {'_id': {'sample': 'sample1', 'gcol': 'groupA'}}])})
+        with patch.object(CoverageManager, 'hidden_collection', self.hidden_collection), \
+                patch.object(CoverageManager, 'coverage_collection', coverage_collection):
+            samples = self.coverage_manager.get_samples_by_groups(['groupB', 'groupA'])
+            self.assertEqual([], self.coverage_manager.get_samples_by_groups([]))
+        self.assertEqual(['sample0', 'sample0', 'sample1'], samples)
+        self.assertEqual(1, coverage_collection.aggregate.call_count)
+
+
+class TestBulkDeletion(SampleIngestionTestCase):
+
+    def setUp(self):
+        super(TestBulkDeletion, self).setUp()
+        self.samples = self.create_samples(3, [states.SUCCESS] * 3)
+
+    @patch('coveragedbingestion.models.purge')
+    @patch.object(SampleManager, 'get_versions', lambda self, names, gene_collection: {'sample0': 2})
+    @patch.object(SampleManager, 'remove_samples')
+    @patch.object(CoverageManager, 'hide_samples')
+    def test_start(self, hide_samples, remove_samples, purge):
+        bulk_deletion = BulkDeletion.objects.create(gene_collection=self.gene_collection)
+        # the test case never commits, the callbacks are run as they are registered
+        with patch('coveragedbingestion.models.transaction.on_commit', side_effect=lambda callback: callback()):
+            bulk_deletion.start(['sample0', 'sample1'])
+        self.assertEqual(2, bulk_deletion.total_samples)
+        self.assertEqual(['sample0', 'sample1'], sorted(hide_samples.call_args[0][0]))
+        self.assertEqual(['sample0', 'sample1'], sorted(remove_samples.call_args[0][0]))
+        purge.delay.assert_called_once_with(bulk_deletion.pk, {'sample0': 2})
+        self.assertEqual([DELETING, DELETING, states.SUCCESS],
+                         [SampleIngestion.statuses([s.name_slug])[s.name_slug] for s in self.samples])
+
+    @patch('coveragedbingestion.models.purge')
+    @patch.object(SampleManager, 'get_versions', lambda self, names, gene_collection: {})
+    @patch.object(SampleManager, 'remove_samples', side_effect=PyMongoError())
+    @patch.object(CoverageManager, 'hide_samples')
+    @patch.object(CoverageManager, 'show_samples')
+    def test_start_failed(self, show_samples, hide_samples, remove_samples, purge):
+        bulk_deletion = BulkDeletion.objects.create(gene_collection=self.gene_collection)
+        with patch('coveragedbingestion.models.transaction.on_commit', side_effect=lambda callback: callback()):
+            self.assertRaises(PyMongoError, bulk_deletion.start, ['sample0', 'sample1'])
+        purge.delay.assert_not_called()
+        # the samples are kept, their coverage is shown again
+        self.assertEqual(hide_samples.call_args, show_samples.call_args)
+        self.assertEqual([states.SUCCESS] * 3,
+                         [SampleIngestion.statuses([s.name_slug])[s.name_slug] for s in self.samples])
+        self.assertEqual(0, BulkDeletion.objects.get(pk=bulk_deletion.pk).total_samples)
+
+    @patch.object(AggregateManager, 'remove_sample')
+    @patch.object(CoverageManager, 'remove_coverage_data_batch')
+    @patch.object(CoverageManager, 'hide_samples')
+    @patch.object(CoverageManager, 'show_samples')
+    def test_purge(self, show_samples, hide_samples, remove_coverage_data_batch, remove_sample):
+        remove_coverage_data_batch.side_effect = [3, 1, 0, 2, 0, 0]
+        bulk_deletion = BulkDeletion.objects.create(gene_collection=self.gene_collection)
+        with patch('coveragedbingestion.models.purge'), patch.object(SampleManager, 'remove_samples'), \
+                patch.object(SampleManager, 'get_versions'):
+            bulk_deletion.start()
+        purge.apply(args=(bulk_deletion.pk, {'sample1': 2}))
+        remove_sample.assert_called_once_with('sample1', 'groupA', 2)
+        # every sample stops being hidden once its coverage is removed
+        self.assertEqual(['sample0', 'sample1', 'sample2'], sorted(c[0][0][0] for c in show_samples.call_args_list))
+        bulk_deletion.refresh_from_db()
+        self.assertEqual(3, bulk_deletion.samples_deleted)
+        self.assertEqual(6, bulk_deletion.documents_deleted)
+        self.assertIsNotNone(bulk_deletion.finished)
+        self.assertFalse(SampleIngestion.objects.exists())
+
+    @patch.object(AggregateManager, 'remove_sample')
+    @patch.object(CoverageManager, 'remove_coverage_data_batch', return_value=0)
+    @patch.object(CoverageManager, 'hide_samples', Mock())
+    @patch.object(CoverageManager, 'show_samples', Mock())
+    def test_purge_duplicates_first(self, remove_coverage_data_batch, remove_sample):
+        self.samples[2].duplicate_of = self.samples[0]
+        self.samples[2].save()
+        bulk_deletion = BulkDeletion.objects.create(gene_collection=self.gene_collection)
+        with patch('coveragedbingestion.models.purge'), patch.object(SampleManager, 'remove_samples'), \
+                patch.object(SampleManager, 'get_versions'):
+            bulk_deletion.start()
+        purge.apply(args=(bulk_deletion.pk, {}))
+        self.assertFalse(SampleIngestion.objects.exists())
+
+    def test_original_kept_with_duplicates(self):
+        self.samples[2].duplicate_of = self.samples[0]
+        self.samples[2].save()
+        serializer = BulkDeletionSerializer(data={'gene_collection': 'groupA', 'sample_list': ['sample0', 'sample1']})
+        self.assertFalse(serializer.is_valid())
+        self.assertIn('sample0', str(serializer.errors))
+        serializer = BulkDeletionSerializer(data={'gene_collection': 'groupA', 'sample_list': ['sample0', 'sample2']})
+        self.assertTrue(serializer.is_valid())
+
+    @patch.object(CoverageManager, 'remove_coverage_data')
+    def test_delete_original(self, remove_coverage_data):
+        self.samples[2].duplicate_of = self.samples[0]
+        self.samples[2].save()
+        response = APIClient().delete('/api/sample-ingestion/{}/'.format(self.samples[0].name_slug))
+        self.assertEqual(409, response.status_code)
+        self.assertIn('sample2', response.json()['detail'])
+        remove_coverage_data.assert_not_called()
+        self.assertTrue(SampleIngestion.objects.filter(pk=self.samples[0].pk).exists())
+
+
+class TestReplace(SampleIngestionTestCase):
+
+    def setUp(self):
+        super(TestReplace, self).setUp()
+        self.sample_ingestion, = self.create_samples(1, [states.SUCCESS], genes_committed=10)
+
+    def test_versioned_documents(self):
+        genes = [{'name': 'BRCA1'}]
+        document = next(ingest_data.build_coverage_document('sample0', genes, 'groupA', version=2))
+        self.assertEqual(2, document['ver'])
+        self.assertNotIn('ver', next(ingest_data.build_coverage_document('sample0', genes, 'groupA')))
+
+    @patch('coveragedbingestion.models.ingest')
+    def test_replace(self, ingest):
+        self.sample_ingestion.replace('sample0.v2.json')
+        self.sample_ingestion.refresh_from_db()
+        self.assertEqual(2, self.sample_ingestion.version)
+        self.assertEqual('sample0.v2.json', self.sample_ingestion.input_file)
+        self.assertIsNone(self.sample_ingestion.task)
+        self.assertEqual(0, self.sample_ingestion.genes_committed)
+        ingest.delay.assert_called_once_with(self.sample_ingestion.pk)
+
+    @patch('coveragedbingestion.models.ingest')
+    def test_replace_unversioned(self, ingest):
+        self.sample_ingestion.version = None
+        self.sample_ingestion.save()
+        self.sample_ingestion.replace('sample0.v2.json')
+        self.assertEqual(2, self.sample_ingestion.version)
+
+    @patch('coveragedbingestion.tasks.ingest_data')
+    @patch('coveragedbingestion.tasks.collect_versions')
+    @patch.object(SampleManager, 'get_versions', lambda self, names, gene_collection: {'sample0': None})
+    @patch.object(CoverageManager, 'hide_version', Mock())
+    @patch.object(CoverageManager, 'show_version', return_value=True)
+    def test_ingest_unversioned_replacement(self, show_version, collect_versions_, ingest_data_):
+        self.sample_ingestion.version = None
+        self.sample_ingestion.save()
+        with patch('coveragedbingestion.models.ingest'):
+            self.sample_ingestion.replace("../resources/test/mocked_coverage_1520552294_0.json")
+        # the same content ingested for another sample does not stop a replacement
+        with patch.object(SampleIngestion, 'find_duplicate') as find_duplicate:
+            ingest.apply(args=(self.sample_ingestion.pk,))
+        find_duplicate.assert_not_called()
+        self.assertEqual(2, ingest_data_.call_args[1]['version'])
+        show_version.assert_called_once_with('sample0', 'groupA', 2)
+        # the coverage stored without a version is removed
+        collect_versions_.delay.assert_called_once_with('sample0', 'groupA', 2)
+
+    @patch.object(CoverageManager, 'remove_coverage_data_batch')
+    @patch.object(CoverageManager, 'forget_versions')
+    def test_collect_versions(self, forget_versions, remove_coverage_data_batch):
+        remove_coverage_data_batch.side_effect = [5, 2, 0]
+        collect_versions('sample0', 'groupA', 3)
+        self.assertEqual(3, remove_coverage_data_batch.call_count)
+        remove_coverage_data_batch.assert_called_with('sample0', 'groupA', below_version=3)
+        forget_versions.assert_called_once_with('sample0', 'groupA', 3)
+
+    def test_show_version(self):
+        hidden_collection = Mock()
+        coverage_collection = Mock(**{'find_one.return_value': {'_id': 1}})
+        with patch.object(CoverageManager, 'hidden_collection', hidden_collection), \
+                patch.object(CoverageManager, 'coverage_collection', coverage_collection):
+            self.assertTrue(CoverageManager().show_version('sample0', 'groupA', 2))
+        # the other versions are hidden by the write showing the new one
+        hidden_collection.update_one.assert_called_once_with({'sample': 'sample0', 'gcol': 'groupA'},
+                                                             {'$pull': {'vers': 2}, '$set': {'shown': 2}},
+                                                             upsert=True)
+        hidden_collection.delete_one.assert_not_called()
+
+    def test_show_first_version(self):
+        hidden_collection = Mock()
+        coverage_collection = Mock(**{'find_one.return_value': None})
+        with patch.object(CoverageManager, 'hidden_collection', hidden_collection), \
+                patch.object(CoverageManager, 'coverage_collection', coverage_collection):
+            self.assertFalse(CoverageManager().show_version('sample0', 'groupA', 1))
+        # nothing is left hidden, the sample is forgotten
+        self.assertEqual({'sample': 'sample0', 'gcol': 'groupA'},
+                         {k: v for k, v in hidden_collection.delete_one.call_args[0][0].items()
+                          if k in ('sample', 'gcol')})
+
+
+class TestUpdateAggregates(TestCase):
+
+    @patch.object(AggregateManager, 'add_sample')
+    def test_ingestion_retried(self, add_sample):
+        # the ingestion fails after updating the aggregates but before registering the sample, the retry finds
+        # the sample unregistered and updates the aggregates again, they skip the genes including it already
+        def ingest():
+            ingest_data.ingest_data("../resources/test/mocked_coverage_1520552294_0.json", 'sample0', 'groupA',
+                                    version=1, on_stored=lambda: update_aggregates('sample0', 'groupA', 1, {},
+                                                                                   IngestionStats()))
+        with patch.object(CoverageManager, 'add_coverage_data', return_value=BulkWriteStats()), \
+                patch.object(SampleManager, 'add_sample', side_effect=[ConnectionFailure('connection lost'), None]):
+            self.assertRaises(ConnectionFailure, ingest)
+            ingest()
+        self.assertEqual([(('sample0', 'groupA', 1),)] * 2, [c[0:1] for c in add_sample.call_args_list])
+
+    @patch.object(AggregateManager, 'add_sample')
+    @patch.object(AggregateManager, 'remove_sample')
+    def test_version_registered(self, remove_sample, add_sample):
+        # a version registered was added in full by a previous attempt
+        update_aggregates('sample0', 'groupA', 2, {'sample0': 2}, IngestionStats())
+        add_sample.assert_not_called()
+        update_aggregates('sample0', 'groupA', 3, {'sample0': 2}, IngestionStats())
+        remove_sample.assert_called_once_with('sample0', 'groupA', 2)
+        add_sample.assert_called_once_with('sample0', 'groupA', 3)
+
+
+class TestCoverageMatrix(TestCase):
+
+    def setUp(self):
+        self.documents = [{'sample': 'sample1', 'name': 'CFTR', 'union_tr': {'stats': {'avg': 30.5, 'med': 29}}},
+                          {'sample': 'sample0', 'name': 'BRCA1', 'union_tr': {'stats': {'avg': 10.0}}},
+                          {'sample': 'sample0', 'name': 'CFTR', 'union_tr': {'stats': {'avg': 20.0, 'med': 18}}}]
+
+    def test_matrix(self):
+        matrix = CoverageMatrix(None, ['BRCA1', 'CFTR', 'TP53'], ['avg', 'med'], self.documents)
+        self.assertEqual(['sample0', 'sample1'], matrix.samples)
+        self.assertEqual([[[10.0, 20.0, None], [None, 30.5, None]],
+                          [[None, 18, None], [None, 29, None]]], matrix.values)
+
+    def test_matrix_given_samples(self):
+        matrix = CoverageMatrix(['sample2', 'sample1'], ['CFTR'], ['avg'], self.documents)
+        self.assertEqual({'samples': ['sample2', 'sample1'], 'genes': ['CFTR'], 'stats': ['avg'],
+                          'values': [[[None], [30.5]]]}, matrix.to_json_dict())
+
+    def test_npz(self):
+        matrix = CoverageMatrix(None, ['BRCA1', 'CFTR'], ['avg'], self.documents)
+        arrays = numpy.load(io.BytesIO(NpzRenderer().render(matrix.to_json_dict())))
+        self.assertEqual(['sample0', 'sample1'], arrays['samples'].tolist())
+        self.assertEqual(['avg'], arrays['stats'].tolist())
+        self.assertEqual((1, 2, 2), arrays['values'].shape)
+        self.assertEqual(30.5, arrays['values'][0, 1, 1])
+        self.assertTrue(numpy.isnan(arrays['values'][0, 1, 0]))
+
+
+def project(document, projection):
+    """
+    Applies an inclusion projection of MongoDB, with dotted paths going through arrays, to a document
+    """
+    if projection is None:
+        return document
+    result = {}
+    for path, included in projection.items():
+        if included:
+            _project_path(document, result, path.split('.'))
+    return result
+
+
+def _project_path(source, target, keys):
+    if keys[0] not in source:
+        return
+    value = source[keys[0]]
+    if len(keys) == 1:
+        target[keys[0]] = value
+    elif isinstance(value, list):
+        items = target.setdefault(keys[0], [{} for _ in value])
+        for item, projected in zip(value, items):
+            _project_path(item, projected, keys[1:])
+    else:
+        _project_path(value, target.setdefault(keys[0], {}), keys[1:])
+
+
+class TestCoverageDepth(TestCase):
+
+    def setUp(self):
+        with open("../resources/test/mocked_coverage_1520552294_0.json") as fd:
+            genes = ingest_data.transform_data(json.load(fd)['results']['genes'])
+        self.document = BSON.encode(next(ingest_data.build_coverage_document("test_sample", genes, "test"))).decode()
+        self.gene = GeneCoverage(**self.document).to_json_dict()
+
+    def test_union(self):
+        gene = GeneCoverage(**project(self.document, COVERAGE_DEPTH_PROJECTIONS['union'])).to_json_dict()
+        self.assertEqual({'name', 'union_transcript', 'gen_collection', 'sample'}, set(gene))
+        self.assertEqual({'name': None, 'stats': self.gene['union_transcript']['stats']}, gene['union_transcript'])
+
+    def test_union_exons(self):
+        gene = GeneCoverage(**project(self.document, COVERAGE_DEPTH_PROJECTIONS['union_exons'])).to_json_dict()
+        self.assertNotIn('transcripts', gene)
+        self.assertEqual(self.gene['union_transcript'], gene['union_transcript'])
+
+    def test_stats(self):
+        gene = GeneCoverage(**project(self.document, COVERAGE_DEPTH_PROJECTIONS['stats'])).to_json_dict()
+        self.assertNotIn('exons', gene['union_transcript'])
+        self.assertEqual([{'name': t['name'], 'stats': t['stats']} for t in self.gene['transcripts']],
+                         gene['transcripts'])
+
+    def test_all(self):
+        gene = GeneCoverage(**project(self.document, COVERAGE_DEPTH_PROJECTIONS['all'])).to_json_dict()
+        self.assertEqual(self.gene, gene)
+
+    @skipIf(sys.version_info < (3, 6), 'dicts keep no order')
+    def test_key_order(self):
+        self.assertEqual(['name', 'union_transcript', 'gen_collection', 'transcripts', 'sample'], list(self.gene))
+        self.assertEqual(['exons', 'name', 'stats'], list(self.gene['transcripts'][0]))
+
+    def test_text_key_order(self):
+        gene = json.loads(GeneCoverage(**self.document).to_json_text(), object_pairs_hook=OrderedDict)
+        self.assertEqual(['name', 'union_transcript', 'gen_collection', 'transcripts', 'sample'], list(gene))
+        self.assertEqual(['exons', 'name', 'stats'], list(gene['transcripts'][0]))
@@ -0,0 +1,215 @@
+#!/bin/python
+"""
+Ingestion throughput benchmark. It generates synthetic gelcoverage outputs with the structure of
+`resources/test/mocked_coverage_*.json`, from a handful of genes up to whole exome size, and ingests them timing
+separately parsing, `transform_data`, building the documents and inserting them.
+
+Documents are inserted either in a local MongoDB, in a throwaway database, or in an in-process stand-in that
+only counts them. Every size runs in its own process so peak RSS is measured per size. Results are printed as JSON
+so they can be compared between commits.
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from coveragedbingestion.coverage_reader import CoverageReader, open_coverage_file
+from coveragedbingestion.ingest_data import build_coverage_document, transform_genes
+from coveragedbingestion.metrics import TimedIterator
+from coveragedata.bulk_writer import BulkWriter
+from coveragedb.settings import COVERAGE_INSERT_BATCH_SIZE, COVERAGE_INSERT_BATCH_BYTES, COVERAGE_INSERT_WRITERS
+
+DEFAULT_SIZES = '10,100,1000,20000'
+
+BENCHMARK_DB = 'calypso_benchmark'
+
+EXON_STATS = ('pct75', 'med', 'lt15x', 'rmsd', 'gte30x', 'gte15x', 'pct25', 'gte50x', 'gc', 'avg', 'sd')
+
+TRANSCRIPT_STATS = EXON_STATS + ('bases',)
+
+
+def random_stats(rng, keys):
+    stats = {k: round(rng.uniform(0, 100), 3) for k in keys}
+    for k in ('lt15x', 'gte15x', 'gte30x', 'gte50x'):
+        if k in stats:
+            stats[k] = round(rng.random(), 5)
+    if 'bases' in stats:
+        stats['bases'] = rng.randint(1, 100)
+    return stats
+
+
+def random_exon(rng, number, start):
+    end = start + rng.randint(50, 300)
+    exon = {'e': end, 's': start, 'stats': random_stats(rng, EXON_STATS), 'exon': 'exon{}'.format(number)}
+    if rng.random() < 0.1:
+        gaps = []
+        for _ in range(rng.randint(1, 3)):
+            gap_start = rng.randint(start, end)
+            gaps.append({'s': gap_start, 'e': gap_start + rng.randint(1, 50)})
+        exon['gaps'] = gaps
+    return exon
+
+
+def random_gene(rng, number):
+    start = rng.randint(1000000, 200000000)
+    exons = []
+    for i in range(rng.randint(2, 40)):
+        exon = random_exon(rng, i + 1, start)
+        start = exon['e'] + rng.randint(100, 10000)
+        exons.append(exon)
+    transcripts = []
+    for i in range(rng.randint(1, 10)):
+        transcript_exons = [dict(e, stats=random_stats(rng, EXON_STATS)) for e in exons if rng.random() < 0.8]
+        transcripts.append({'stats': random_stats(rng, TRANSCRIPT_STATS), 'id': 'ENST{:011d}'.format(number * 100 + i),
+                            'exons': transcript_exons or exons[:1]})
+    return {'trs': transcripts,
+            'chr': 'chr{}'.format(rng.randint(1, 22)),
+            'name': 'GENE{}'.format(number),
+            'union_tr': {'stats': random_stats(rng, TRANSCRIPT_STATS), 'exons': exons}}
+
+
+def generate_coverage(output_file, number_of_genes, seed=0):
+    """
+    Writes a synthetic coverage file one gene at a time, so any size can be generated with little memory
+    """
+    rng = random.Random(seed)
+    with open(output_file, 'w') as fd:
+        fd.write('{"results":{"genes":[')
+        for i in range(number_of_genes):
+            if i:
+                fd.write(',')
+            json.dump(random_gene(rng, i), fd)
+        fd.write('],"coding_region":')
+        json.dump({'chrs': {}, 'stats': random_stats(rng, TRANSCRIPT_STATS)}, fd)
+        fd.write(',"uncovered_genes":[]},"parameters":')
+        json.dump({'assembly': 'GRCh38', 'gap_length_threshold': 5, 'coverage_threshold': 15}, fd)
+        fd.write('}')
+
+
+class CountingCollection(object):
+    """
+    In-process stand-in of a MongoDB collection, documents arrive already encoded as BSON
+    """
+
+    def __init__(self):
+        self.documents = 0
+
+    def insert_many(self, documents, ordered=True):
+        self.documents += len(documents)
+
+    def delete_many(self, query):
+        pass
+
+
+def run(input_file, collection, packed):
+    start = time.perf_counter()
+    with open_coverage_file(input_file) as fd:
+        parsed = TimedIterator(CoverageReader(fd))
+        transformed = TimedIterator(transform_genes(parsed))
+        built = TimedIterator(build_coverage_document('benchmark_sample', transformed, 'benchmark', packed=packed))
+        writer = BulkWriter(collection, batch_size=COVERAGE_INSERT_BATCH_SIZE, batch_bytes=COVERAGE_INSERT_BATCH_BYTES,
+                            writers=COVERAGE_INSERT_WRITERS)
+        write_stats = writer.write(built)
+    seconds = time.perf_counter() - start
+    megabytes = os.path.getsize(input_file) / (1024.0 * 1024.0)
+    latencies = sorted(b.seconds for b in write_stats.batches)
+    return {
+        'genes': parsed.items,
+        'documents': write_stats.documents,
+        'file_megabytes': megabytes,
+        'document_megabytes': write_stats.bytes / (1024.0 * 1024.0),
+        'seconds': seconds,
+        # exclusive time of every stage, inserting includes BSON encoding and waiting for the writers
+        'stages': {
+            'parse': parsed.seconds,
+            'transform': transformed.seconds - parsed.seconds,
+            'build': built.seconds - transformed.seconds,
+            'insert': seconds - built.seconds
+        },
+        'documents_per_second': write_stats.documents / seconds,
+        'megabytes_per_second': megabytes / seconds,
+        'batches': len(latencies),
+        'batch_latency_median': latencies[len(latencies) // 2] if latencies else None,
+        'batch_latency_max': latencies[-1] if latencies else None,
+        # on Linux ru_maxrss is in kilobytes
+        'peak_rss_megabytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    }
+
+
+def run_size(number_of_genes, mongo_uri, packed, folder):
+    input_file = os.path.join(folder, 'synthetic_coverage_{}.json'.format(number_of_genes))
+    if not os.path.exists(input_file):
+        generate_coverage(input_file, number_of_genes)
+    if mongo_uri:
+        from pymongo import MongoClient
+        client = MongoClient(mongo_uri)
+        collection = client[BENCHMARK_DB]['coverage']
+        collection.drop()
+        try:
+            return run(input_file, collection, packed)
+        finally:
+            client.drop_database(BENCHMARK_DB)
+    return run(input_file, CountingCollection(), packed)
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Calypso ingestion benchmark')
+    parser.add_argument('--sizes', metavar='sizes', default=DEFAULT_SIZES,
+                        help='Comma separated numbers of genes of the synthetic files [default: {}]'.format(
+                            DEFAULT_SIZES))
+    parser.add_argument('--mongo-uri', metavar='mongo_uri',
+                        help='MongoDB to insert into, the database {} is dropped afterwards '
+                             '[default: in-process stand-in]'.format(BENCHMARK_DB))
+    parser.add_argument('--packed', dest='packed', action='store_true',
+                        help='Stores exons as packed binary arrays')
+    parser.add_argument('--folder', metavar='folder',
+                        help='Folder to keep the synthetic files between runs [default: a temporary folder]')
+    parser.add_argument('--output', metavar='output', help='File to write the results to [default: stdout]')
+    parser.add_argument('--single', metavar='single', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single is not None:
+        print(json.dumps(run_size(args.single, args.mongo_uri, args.packed, args.folder)))
+        return
+
+    folder = args.folder or tempfile.mkdtemp(prefix='calypso_benchmark_')
+    results = []
+    try:
+        for size in [int(s) for s in args.sizes.split(',')]:
+            command = [sys.executable, os.path.abspath(__file__), '--single', str(size), '--folder', folder]
+            if args.mongo_uri:
+                command += ['--mongo-uri', args.mongo_uri]
+            if args.packed:
+                command.append('--packed')
+            results.append(json.loads(subprocess.check_output(command).decode().strip().splitlines()[-1]))
+    finally:
+        if not args.folder:
+            shutil.rmtree(folder)
+    report = json.dumps({'revision': git_revision(),
+                         'python': sys.version.split()[0],
+                         'target': 'mongodb' if args.mongo_uri else 'in-process',
+                         'packed': args.packed,
+                         'results': results
+                         }, indent=2)
+    if args.output:
+        with open(args.output, 'w') as fd:
+            fd.write(report)
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    main()
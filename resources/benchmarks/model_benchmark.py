@@ -0,0 +1,98 @@
+#!/bin/python
+"""
+Micro-benchmark of the serialisation of the gene coverage endpoints. It compares building the transcript, exon and
+stats objects from decoded documents, as it was done before, with `GeneCoverage` serialising decoded documents
+and raw BSON documents directly. Time per document and the peak of memory allocated while serialising all the
+documents, which includes the intermediate objects, are reported.
+"""
+import argparse
+import gc
+import glob
+import json
+import os
+import time
+import tracemalloc
+
+from bson import BSON
+from bson.raw_bson import RawBSONDocument
+
+from coveragedbingestion.ingest_data import transform_data, build_coverage_document
+from coveragedata.models import GeneCoverage, TranscriptCoverage
+
+DEFAULT_INPUT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'test', 'mocked_coverage_*.json')
+
+
+def legacy_to_json_dict(raw_document):
+    document = BSON(raw_document).decode()
+    return {'name': document.get('name', None),
+            'union_transcript': TranscriptCoverage(**document['union_tr']).to_json_dict(),
+            'gen_collection': document.get('gcol', None),
+            'sample': document.get('sample', None),
+            'transcripts': [TranscriptCoverage(**t).to_json_dict() for t in document['trs']]
+            }
+
+
+def direct_to_json_dict(raw_document):
+    return GeneCoverage(BSON(raw_document).decode()).to_json_dict()
+
+
+def raw_to_json_dict(raw_document):
+    return GeneCoverage(RawBSONDocument(raw_document)).to_json_dict()
+
+
+def time_serialisation(serialise, documents, repeats):
+    timings = []
+    for _ in range(repeats):
+        # as timeit does, garbage collection is disabled so it does not add noise to the timings
+        gc.disable()
+        start = time.perf_counter()
+        results = [serialise(d) for d in documents]
+        timings.append(time.perf_counter() - start)
+        gc.enable()
+    return min(timings), results
+
+
+def peak_megabytes(serialise, documents):
+    tracemalloc.start()
+    for document in documents:
+        serialise(document)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak / (1024.0 * 1024.0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Gene coverage serialisation micro-benchmark')
+    parser.add_argument('--input', metavar='input', default=DEFAULT_INPUT,
+                        help='Glob of gelcoverage JSON files to read genes from [default: mocked test data]')
+    parser.add_argument('--packed', dest='packed', action='store_true',
+                        help='Stores exons as packed binary arrays')
+    parser.add_argument('--repeats', metavar='repeats', type=int, default=5,
+                        help='Number of runs, the fastest one is reported [default: 5]')
+    args = parser.parse_args()
+
+    documents = []
+    for input_file in sorted(glob.glob(args.input)):
+        with open(input_file) as fd:
+            genes = transform_data(json.load(fd)['results']['genes'])
+        documents.extend(bytes(BSON.encode(d)) for d in build_coverage_document('benchmark_sample', genes,
+                                                                                'benchmark', packed=args.packed))
+
+    results = {'documents': len(documents), 'packed': args.packed}
+    legacy_results = None
+    for name, serialise in (('legacy', legacy_to_json_dict), ('direct', direct_to_json_dict),
+                            ('raw', raw_to_json_dict)):
+        seconds, serialised = time_serialisation(serialise, documents, args.repeats)
+        seconds /= len(documents)
+        results['{}_seconds_per_document'.format(name)] = seconds
+        results['{}_peak_megabytes'.format(name)] = peak_megabytes(serialise, documents)
+        if legacy_results is None:
+            legacy_results = serialised
+        else:
+            results['{}_identical_output'.format(name)] = serialised == legacy_results
+            results['{}_speedup'.format(name)] = results['legacy_seconds_per_document'] / seconds
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+#!/bin/python
+"""
+Micro-benchmark of rendering the gene coverage endpoints as JSON, from the decoded documents to the bytes of the
+response. It compares the REST framework path, through `CoverageSerializer` and `JSONRenderer`, with the JSON
+text written straight from the documents by `GeneCoverage.to_json_text`. The output of both must be identical.
+"""
+import argparse
+import gc
+import glob
+import json
+import os
+import time
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'coveragedb.settings')
+django.setup()
+
+from bson import BSON  # noqa: E402
+from rest_framework.renderers import JSONRenderer  # noqa: E402
+
+from coveragedbingestion.ingest_data import transform_data, build_coverage_document  # noqa: E402
+from coveragedata.models import GeneCoverage  # noqa: E402
+from webservices.renderers import json_bytes  # noqa: E402
+from webservices.serializers import CoverageSerializer  # noqa: E402
+
+DEFAULT_INPUT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'test', 'mocked_coverage_*.json')
+
+
+def render_with_serializer(documents):
+    genes = [GeneCoverage(d) for d in documents]
+    return JSONRenderer().render(CoverageSerializer(instance=genes, many=True).data)
+
+
+def render_text(documents):
+    return json_bytes('[' + ','.join([GeneCoverage(d).to_json_text() for d in documents]) + ']')
+
+
+def time_rendering(render, documents, repeats):
+    timings = []
+    for _ in range(repeats):
+        # as timeit does, garbage collection is disabled so it does not add noise to the timings
+        gc.disable()
+        start = time.perf_counter()
+        content = render(documents)
+        timings.append(time.perf_counter() - start)
+        gc.enable()
+    return min(timings), content
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Gene coverage rendering micro-benchmark')
+    parser.add_argument('--input', metavar='input', default=DEFAULT_INPUT,
+                        help='Glob of gelcoverage JSON files to read genes from [default: mocked test data]')
+    parser.add_argument('--packed', dest='packed', action='store_true',
+                        help='Stores exons as packed binary arrays')
+    parser.add_argument('--repeats', metavar='repeats', type=int, default=20,
+                        help='Number of runs, the fastest one is reported [default: 20]')
+    args = parser.parse_args()
+
+    documents = []
+    for input_file in sorted(glob.glob(args.input)):
+        with open(input_file) as fd:
+            genes = transform_data(json.load(fd)['results']['genes'])
+        documents.extend(BSON.encode(d).decode() for d in build_coverage_document('benchmark_sample', genes,
+                                                                                  'benchmark', packed=args.packed))
+
+    serializer_seconds, serializer_content = time_rendering(render_with_serializer, documents, args.repeats)
+    text_seconds, text_content = time_rendering(render_text, documents, args.repeats)
+    print(json.dumps({
+        'genes': len(documents),
+        'packed': args.packed,
+        'bytes_per_gene': len(text_content) / len(documents),
+        'serializer_seconds_per_gene': serializer_seconds / len(documents),
+        'text_seconds_per_gene': text_seconds / len(documents),
+        'speedup': serializer_seconds / text_seconds,
+        'identical_output': serializer_content == text_content
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+#!/bin/python
+"""
+Micro-benchmark of the exon minimisation applied to every gene during ingestion. It compares the original
+exon by exon implementation with the batched one in `coveragedbingestion.ingest_data`.
+"""
+import argparse
+import gc
+import glob
+import json
+import os
+import pickle
+import time
+
+from coveragedbingestion.ingest_data import minimize_genes, TRANSFORM_CHUNK_SIZE
+from coveragedata.constants import STATS_ORDERED_KEYS, EXON_EXCLUDED_KEYS
+
+DEFAULT_INPUT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'test', 'mocked_coverage_*.json')
+
+
+def legacy_convert_gaps(gaps):
+    return list(map(lambda p: (p['s'], p['e']), list(filter(lambda x: x['e'] - x['s'] > 5, gaps))))
+
+
+def legacy_clean_exon(exon, excluded_keys=EXON_EXCLUDED_KEYS, stats_ordered_keys=STATS_ORDERED_KEYS):
+    exon['gaps'] = legacy_convert_gaps(gaps=exon.get('gaps', []))
+    exon['stats'] = [exon['stats'][key] for key in stats_ordered_keys]
+    list(map(lambda k: exon.pop(k), excluded_keys))
+
+
+def legacy_minimize_exons(gene_data):
+    list(map(lambda exon: legacy_clean_exon(exon), gene_data['exons']))
+
+
+def legacy_minimize_gene(gene):
+    legacy_minimize_exons(gene['union_tr'])
+    list(map(lambda gene_data: legacy_minimize_exons(gene_data), gene['trs']))
+
+
+def legacy_transform(genes):
+    list(map(lambda gene: legacy_minimize_gene(gene), genes))
+    return genes
+
+
+def batched_transform(genes):
+    for i in range(0, len(genes), TRANSFORM_CHUNK_SIZE):
+        minimize_genes(genes[i:i + TRANSFORM_CHUNK_SIZE])
+    return genes
+
+
+def time_transform(transform, serialised_genes, copies, repeats):
+    timings = []
+    for _ in range(repeats):
+        genes = [gene for _ in range(copies) for gene in pickle.loads(serialised_genes)]
+        # as timeit does, garbage collection is disabled so it does not add noise to the timings
+        gc.disable()
+        start = time.perf_counter()
+        transform(genes)
+        timings.append(time.perf_counter() - start)
+        gc.enable()
+    return min(timings), genes
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Exon minimisation micro-benchmark')
+    parser.add_argument('--input', metavar='input', default=DEFAULT_INPUT,
+                        help='Glob of gelcoverage JSON files to read genes from [default: mocked test data]')
+    parser.add_argument('--copies', metavar='copies', type=int, default=20,
+                        help='Number of times the genes are replicated [default: 20]')
+    parser.add_argument('--repeats', metavar='repeats', type=int, default=5,
+                        help='Number of runs, the fastest one is reported [default: 5]')
+    args = parser.parse_args()
+
+    genes = []
+    for input_file in sorted(glob.glob(args.input)):
+        with open(input_file) as fd:
+            genes.extend(json.load(fd)['results']['genes'])
+    serialised_genes = pickle.dumps(genes)
+    exons = sum(len(t['exons']) for g in genes for t in [g['union_tr']] + g['trs']) * args.copies
+
+    legacy_seconds, legacy_genes = time_transform(legacy_transform, serialised_genes, args.copies,
+                                                   args.repeats)
+    batched_seconds, batched_genes = time_transform(batched_transform, serialised_genes, args.copies,
+                                                     args.repeats)
+    print(json.dumps({
+        'genes': len(genes) * args.copies,
+        'exons': exons,
+        'legacy_seconds': legacy_seconds,
+        'batched_seconds': batched_seconds,
+        'legacy_exons_per_second': exons / legacy_seconds,
+        'batched_exons_per_second': exons / batched_seconds,
+        'speedup': legacy_seconds / batched_seconds,
+        'identical_output': legacy_genes == batched_genes
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
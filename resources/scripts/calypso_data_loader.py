@@ -1,9 +1,276 @@
 #!/bin/python
 import argparse
+import asyncio
 import requests
 import logging
-from celery import states
+import sys
 import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from celery import states
+from django.utils.text import slugify
+from requests.adapters import HTTPAdapter
+
+# the content of the sample was already ingested for the gene collection under another name
+DUPLICATE = 'DUPLICATE'
+
+# statuses of the ingestions that do not change anymore
+FINISHED_STATUSES = states.READY_STATES | {DUPLICATE}
+
+# longest time in seconds every status request waits on the server for any ingestion to change
+WAIT_SECONDS = 30
+
+# in concurrent mode a single status request follows every ingestion in flight, it waits for a shorter time so
+# samples sent while it waits are not followed too late
+CONCURRENT_WAIT_SECONDS = 5
+
+# responses of a server that may succeed if the request is sent again
+TRANSIENT_STATUS_CODES = (502, 503, 504)
+
+RETRIES = 5
+
+BACKOFF_SECONDS = 1
+
+PROGRESS_SECONDS = 5
+
+
+class CalypsoError(ValueError):
+
+    def __init__(self, status_code, content):
+        super(CalypsoError, self).__init__("Calypso returned {}: {}".format(status_code, content))
+        self.status_code = status_code
+
+
+def read_entries(input_file):
+    with open(input_file, "r") as input_data:
+        for entry in input_data:
+            sample_name, json_path, group_name = entry.strip().split("\t")
+            yield {
+                "name": sample_name,
+                "input_file": json_path,
+                "gene_collection": group_name
+            }
+
+
+def wait_for_ingestions(rest_api, url_base, slugs, wait_seconds=WAIT_SECONDS):
+    """
+    Waits for the ingestions to finish with long polling requests that return as soon as any of them changes,
+    yields the status of every ingestion after each change
+    """
+    known = {slug: None for slug in slugs}
+    while True:
+        response = rest_api.post(url_base + "sample-ingestion/status/",
+                                 json={"samples": known, "timeout": wait_seconds})
+        if response.status_code != 200:
+            raise ValueError("Calypso failed to retrieve the ingestion status: {}".format(str(response.content)))
+        known = response.json()
+        missing = [slug for slug, status in known.items() if status is None]
+        if missing:
+            logging.error("Failed to find sent data in Calypso: {}".format(", ".join(missing)))
+            raise ValueError("Calypso failed to retrieve sent data: {}".format(", ".join(missing)))
+        yield known
+        if all(status in FINISHED_STATUSES for status in known.values()):
+            return
+
+
+def load_batch(rest_api, url_base, input_file, concurrency):
+    post_data = {"samples": list(read_entries(input_file))}
+    if concurrency:
+        post_data["concurrency"] = concurrency
+    response = rest_api.post(url_base + "ingestion-batch/", json=post_data)
+    if response.status_code != 201:
+        logging.error("Failed to send batch to Calypso: {}".format(input_file))
+        raise ValueError("Calypso load error: {}".format(str(response.content)))
+    batch_id = response.json()["id"]
+    slugs = [s["name_slug"] for s in response.json()["samples"]]
+    logging.debug("Batch {} with {} samples sent to Calypso".format(batch_id, len(slugs)))
+    for statuses in wait_for_ingestions(rest_api, url_base, slugs):
+        counts = {}
+        for status in statuses.values():
+            counts[status] = counts.get(status, 0) + 1
+        logging.info("Batch {}: {} of {} samples finished {}".format(
+            batch_id, sum(counts.get(s, 0) for s in FINISHED_STATUSES), len(slugs), counts))
+    failed = [slug for slug, status in statuses.items() if status == states.FAILURE]
+    if failed:
+        logging.error("Calypso failed to ingest {} samples: {}".format(len(failed), ", ".join(failed)))
+        raise ValueError("Calypso failed to ingest data for samples: {}".format(", ".join(failed)))
+    logging.debug("Ingestion for batch {} was successful!".format(batch_id))
+
+
+class ConcurrentLoader(object):
+    """
+    Sends the samples one by one keeping at most `max_in_flight` ingestions unfinished. A single long polling
+    request follows all of the ingestions in flight and frees the slot of every ingestion as soon as it finishes.
+    GET requests failing with a connection error or a transient server error are sent again after waiting twice as
+    long each time. A sample whose POST fails may have been created anyway, so its ingestion is looked up before it
+    is sent again. Failed ingestions do not stop the load, they are reported at the end.
+    """
+
+    def __init__(self, url_base, max_in_flight, retries=RETRIES, backoff_seconds=BACKOFF_SECONDS):
+        self.url_base = url_base
+        self.max_in_flight = max_in_flight
+        self.retries = retries
+        self.backoff_seconds = backoff_seconds
+        # the status request holds one connection while the others send samples
+        self.session = requests.session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_in_flight + 1)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.executor = ThreadPoolExecutor(max_workers=max_in_flight + 1)
+        self.in_flight = {}
+        self.counts = {}
+        self.failures = []
+        self.total = 0
+        self.finished = 0
+
+    def load(self, entries):
+        """
+
+        :param entries: the samples to ingest as sent to the sample ingestion endpoint
+        :return: the name of every sample that could not be ingested along with the reason
+        """
+        entries = list(entries)
+        self.total = len(entries)
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(self._load(entries))
+        finally:
+            loop.close()
+            self.executor.shutdown()
+        return self.failures
+
+    async def _load(self, entries):
+        self._slots = asyncio.Semaphore(self.max_in_flight)
+        self._sent = asyncio.Event()
+        watcher = asyncio.ensure_future(self._watch())
+        reporter = asyncio.ensure_future(self._report())
+        try:
+            await asyncio.gather(*[self._load_sample(entry) for entry in entries])
+        finally:
+            watcher.cancel()
+            reporter.cancel()
+            self._print_progress(final=True)
+
+    async def _backoff(self, url, error, attempt):
+        delay = self.backoff_seconds * 2 ** attempt
+        logging.warning("Request to {} failed ({}), retrying in {} seconds".format(url, error, delay))
+        await asyncio.sleep(delay)
+
+    async def _request(self, method, url, expected_status, **kwargs):
+        """
+        Sends a request, only GET requests are sent again when they fail as other methods may not be idempotent
+
+        :raises CalypsoError: if the response has any other status than `expected_status`
+        """
+        loop = asyncio.get_event_loop()
+        retries = self.retries if method == 'get' else 0
+        for attempt in range(retries + 1):
+            try:
+                response = await loop.run_in_executor(self.executor,
+                                                      partial(self.session.request, method, url, **kwargs))
+                if response.status_code not in TRANSIENT_STATUS_CODES:
+                    break
+                error = "server error {}".format(response.status_code)
+            except (requests.ConnectionError, requests.Timeout) as ex:
+                error = str(ex)
+                if attempt == retries:
+                    raise
+            if attempt < retries:
+                await self._backoff(url, error, attempt)
+        if response.status_code != expected_status:
+            raise CalypsoError(response.status_code, str(response.content))
+        return response.json()
+
+    async def _send_sample(self, post_data):
+        """
+        Creates the ingestion of a sample. When the POST fails, or it is rejected because the sample exists, the
+        ingestion is read by its slug, which is the one created by a previous attempt. The POST is only sent again
+        if there is no such ingestion.
+
+        :return: the ingestion
+        """
+        url = self.url_base + "sample-ingestion/"
+        slug = "-".join((slugify(post_data["name"]), slugify(post_data["gene_collection"])))
+        for attempt in range(self.retries + 1):
+            try:
+                return await self._request('post', url, 201, json=post_data)
+            except CalypsoError as ex:
+                if ex.status_code != 400 and ex.status_code not in TRANSIENT_STATUS_CODES:
+                    raise
+                error = ex
+            except (requests.ConnectionError, requests.Timeout) as ex:
+                error = ex
+            try:
+                return await self._request('get', url + slug + "/", 200)
+            except CalypsoError as ex:
+                if ex.status_code != 404:
+                    raise
+            if isinstance(error, CalypsoError) and error.status_code == 400:
+                # rejected for another reason than the sample existing
+                raise error
+            if attempt < self.retries:
+                await self._backoff(url, error, attempt)
+        raise error
+
+    async def _load_sample(self, post_data):
+        sample = "{}-{}".format(post_data["name"], post_data["gene_collection"])
+        async with self._slots:
+            try:
+                response = await self._send_sample(post_data)
+                slug = response["name_slug"]
+                finished = asyncio.get_event_loop().create_future()
+                self.in_flight[slug] = [response["status"], finished]
+                self._sent.set()
+                logging.debug("Sample '{}' sent to Calypso as '{}'".format(sample, slug))
+                status = await finished
+            except Exception as ex:
+                status = None
+                self.failures.append((sample, str(ex)))
+            else:
+                if status == DUPLICATE:
+                    logging.warning("Content for {} was already ingested".format(slug))
+                elif status != states.SUCCESS:
+                    self.failures.append((sample, "ingestion finished in state '{}'".format(status)))
+            self.counts[status] = self.counts.get(status, 0) + 1
+            self.finished += 1
+
+    async def _watch(self):
+        while True:
+            if not self.in_flight:
+                self._sent.clear()
+                await self._sent.wait()
+            known = {slug: status for slug, (status, _) in self.in_flight.items()}
+            try:
+                statuses = await self._request('post', self.url_base + "sample-ingestion/status/", 200,
+                                               json={"samples": known, "timeout": CONCURRENT_WAIT_SECONDS})
+            except asyncio.CancelledError:
+                raise
+            except Exception as ex:
+                # the ingestions are still running, it keeps following them
+                logging.error("Failed to retrieve the ingestion status: {}".format(str(ex)))
+                await asyncio.sleep(self.backoff_seconds)
+                continue
+            for slug, status in statuses.items():
+                if status is None:
+                    self.in_flight.pop(slug)[1].set_exception(ValueError("Calypso failed to find sent data"))
+                elif status in FINISHED_STATUSES:
+                    self.in_flight.pop(slug)[1].set_result(status)
+                else:
+                    self.in_flight[slug][0] = status
+
+    async def _report(self):
+        while True:
+            await asyncio.sleep(PROGRESS_SECONDS)
+            self._print_progress()
+
+    def _print_progress(self, final=False):
+        # rewrites the same line when the output is a terminal
+        end = "\n" if final or not sys.stderr.isatty() else "\r"
+        sys.stderr.write("{} of {} samples finished ({} succeeded, {} duplicated, {} failed), {} in progress{}".format(
+            self.finished, self.total, self.counts.get(states.SUCCESS, 0), self.counts.get(DUPLICATE, 0),
+            len(self.failures), len(self.in_flight), end))
+        sys.stderr.flush()
 
 
 def main():
@@ -21,43 +288,53 @@ def main():
                         help='The Calypso protocol for the REST API [default:http]', default="http")
     parser.add_argument('--verbose', dest='verbose',
                         help='Verbose logs in standard output', action='store_true')
+    parser.add_argument('--batch', dest='batch',
+                        help='Sends all samples at once as a single ingestion batch', action='store_true')
+    parser.add_argument('--concurrency', metavar='concurrency', type=int,
+                        help='Maximum number of samples of the batch ingested at the same time '
+                             '[default: server setting]')
+    parser.add_argument('--parallel', metavar='parallel', type=int,
+                        help='Sends the samples one by one keeping at most this number of ingestions in progress, '
+                             'failed samples are reported at the end')
 
     args = parser.parse_args()
     if args.verbose:
         logging.basicConfig(level='DEBUG')
     rest_api = requests.session()
     url_base = "{}://{}/api/".format(args.protocol, args.host)
-    with open(args.input, "r") as input_data:
-        for entry in input_data:
-            sample_name, json_path, group_name = entry.strip().split("\t")
-            post_data = {
-                "name": sample_name,
-                "input_file": json_path,
-                "gene_collection": group_name
-            }
+    if args.batch:
+        load_batch(rest_api, url_base, args.input, args.concurrency)
+    elif args.parallel:
+        start = time.time()
+        failures = ConcurrentLoader(url_base, args.parallel).load(read_entries(args.input))
+        logging.info("Load finished in {:.1f} seconds".format(time.time() - start))
+        if failures:
+            for sample, reason in failures:
+                logging.error("Calypso failed to ingest {}: {}".format(sample, reason))
+            raise ValueError("Calypso failed to ingest data for samples: {}".format(
+                ", ".join(sample for sample, _ in failures)))
+    else:
+        for post_data in read_entries(args.input):
+            sample_name = post_data["name"]
+            group_name = post_data["gene_collection"]
             # posts to Calypso
             response = rest_api.post(url_base + "sample-ingestion/", json=post_data)
             if response.status_code != 201:
                 logging.error("Failed to send data to Calypso: {}".format(str(post_data)))
                 raise ValueError("Calypso load error: {}".format(str(response.content)))
             logging.debug("Sample '{}' for gene collection '{}' sent to Calypso".format(sample_name, group_name))
-            # checks for the status of the data ingestion
-            ingestion_status = states.PENDING
-            while ingestion_status != states.SUCCESS:
-                response = rest_api.get(
-                    url_base + "sample-ingestion/{}-{}/".format(sample_name.lower(), group_name.lower()))
-                if response.status_code != 200:
-                    logging.error("Failed to find sent data in Calypso: {}-{}".format(
-                        sample_name.lower(), group_name.lower()))
-                    raise ValueError("Calypso failed to retrieve sent data: {}".format(str(response.content)))
-                ingestion_status = response.json()["status"]
-                if ingestion_status == states.FAILURE:
-                    logging.error("Calypso failed to ingest data: {}".format(str(response.content)))
-                    raise ValueError("Calypso failed to ingest data: {}".format(str(response.content)))
-                if ingestion_status != states.SUCCESS:
+            slug = response.json()["name_slug"]
+            # waits for the data ingestion to finish
+            for statuses in wait_for_ingestions(rest_api, url_base, [slug]):
+                ingestion_status = statuses[slug]
+                if ingestion_status not in FINISHED_STATUSES:
                     logging.debug("Waiting for data in state '{}'...".format(ingestion_status))
-                    time.sleep(2)
-            logging.debug("Ingestion for {}-{} was successful!".format(sample_name.lower(), group_name.lower()))
+            if ingestion_status == DUPLICATE:
+                logging.warning("Content for {} was already ingested".format(slug))
+            elif ingestion_status != states.SUCCESS:
+                logging.error("Calypso failed to ingest data for {} in state '{}'".format(slug, ingestion_status))
+                raise ValueError("Calypso failed to ingest data for {}".format(slug))
+            logging.debug("Ingestion for {} was successful!".format(slug))
 
 
 if __name__ == '__main__':
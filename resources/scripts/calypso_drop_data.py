@@ -3,6 +3,10 @@ import argparse
 import requests
 import logging
 import sys
+import time
+from celery import states
+
+POLL_SECONDS = 5
 
 
 def main():
@@ -35,15 +39,30 @@ def main():
     rest_api = requests.session()
     url_base = "{}://{}/api/".format(args.protocol, args.host)
     response = rest_api.get(url_base + "sample-ingestion/")
-    samples = response.json()
-    for sample in samples:
-        sample_name = sample['name']
-        gene_collection = sample['gene_collection']
-        response = rest_api.delete(url_base + "sample-ingestion/{}-{}/".format(
-            sample_name.lower(), gene_collection.lower()))
-        # TODO: there is no way to check if deletion was successful as delete operation always returns 404
-        logging.debug("Successfully deleted sample {} form collection {}".format(sample_name, gene_collection))
-
+    gene_collections = sorted(set(sample['gene_collection'] for sample in response.json()))
+    # every gene collection is deleted with a single request, the data is removed in the background
+    deletions = []
+    for gene_collection in gene_collections:
+        response = rest_api.post(url_base + "bulk-deletion/", json={"gene_collection": gene_collection})
+        if response.status_code != 201:
+            logging.error("Failed to delete gene collection {}".format(gene_collection))
+            raise ValueError("Calypso delete error: {}".format(str(response.content)))
+        deletions.append(response.json()["id"])
+        logging.debug("Deletion of {} samples from collection {} started".format(
+            response.json()["total_samples"], gene_collection))
+    for deletion_id in deletions:
+        while True:
+            response = rest_api.get(url_base + "bulk-deletion/{}/".format(deletion_id))
+            deletion = response.json()
+            if deletion["status"] == states.FAILURE:
+                raise ValueError("Calypso failed to delete collection {}".format(deletion["gene_collection"]))
+            logging.debug("Collection {}: {} of {} samples deleted ({} documents)".format(
+                deletion["gene_collection"], deletion["samples_deleted"], deletion["total_samples"],
+                deletion["documents_deleted"]))
+            if deletion["finished"] is not None:
+                break
+            time.sleep(POLL_SECONDS)
+        logging.debug("Successfully deleted collection {}".format(deletion["gene_collection"]))
 
 if __name__ == '__main__':
     main()
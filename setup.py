@@ -23,11 +23,12 @@ setup(
         'djangorestframework==3.7.7',
         'Markdown==2.6.10',
         'Pygments==2.2.0',
-        'pymongo==3.5.1',
+        'pymongo==3.12.3',
         'mock==2.0.0',
         'numpy==1.14.2',
         'rpy2==2.9.2',
         'pandas==0.22.0',
-        'plotly==2.5.0'
+        'plotly==2.5.0',
+        'zstandard==0.13.0'
     ]
 )
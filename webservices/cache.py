@@ -0,0 +1,174 @@
+import hashlib
+import json
+import pickle
+import threading
+from collections import OrderedDict
+
+from django.core.cache import caches
+
+from coveragedb.settings import COVERAGE_CACHE_BYTES, CACHES
+from coveragedata.sample_manager import SampleManager
+
+SHARED_CACHE_ALIAS = 'coverage'
+
+_MISSING = object()
+
+
+class LRUCache(object):
+    """
+    In-process cache holding at most `max_bytes` of values, the least recently used entries are evicted to make
+    room. Values are measured once as they are set: the length of bytes, the length of their pickle otherwise
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def size(value):
+        return len(value) if isinstance(value, bytes) else len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                self._entries.move_to_end(key)
+            except KeyError:
+                return default
+            return self._entries[key][0]
+
+    def set(self, key, value):
+        if self.max_bytes <= 0:
+            return
+        size = self.size(value)
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.bytes -= previous[1]
+            # a value larger than the whole cache would only evict every other entry
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (value, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.bytes -= evicted
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+
+class ResponseCache(object):
+    """
+    Two tier cache of the responses of the coverage endpoints: an LRU cache in every process and, if configured,
+    a cache shared by the processes of the host. Keys include the registration token of every sample of the
+    response, which changes when a sample is ingested, replaced or deleted, so entries of changed samples are
+    never read again, whichever process changed them, and they age out of both tiers.
+    """
+    sample_manager = SampleManager()
+
+    def __init__(self, max_bytes=COVERAGE_CACHE_BYTES, shared=None):
+        """
+
+        :param max_bytes: the size of the in-process tier
+        :param shared: the Django cache of the shared tier, the `coverage` cache if configured
+        """
+        self.local = LRUCache(max_bytes)
+        if shared is None and SHARED_CACHE_ALIAS in CACHES:
+            shared = caches[SHARED_CACHE_ALIAS]
+        self.shared = shared
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def version(self, endpoint, sample_names, gene_collection, *parameters):
+        """
+
+        :param endpoint: the name of the endpoint
+        :param sample_names: the samples of the response
+        :param gene_collection: the gene collection of the response
+        :param parameters: any other parameter of the request the response depends on
+        :return: a hash identifying the response to the request with the current data of the samples, it is read
+        from the registration of the samples only
+        """
+        return self.registered_version(endpoint, sample_names, gene_collection, *parameters)[0]
+
+    def registered_version(self, endpoint, sample_names, gene_collection, *parameters):
+        """
+        Same as `version`, read by the same query as whether the samples exist
+
+        :return: the version and whether every sample of the response is registered
+        """
+        registrations = self.sample_manager.get_registrations(sample_names, gene_collection)
+        version = json.dumps([endpoint, gene_collection, sample_names, parameters,
+                              [registrations.get(s) for s in sample_names]])
+        return hashlib.sha1(version.encode('utf-8')).hexdigest(), all(s in registrations for s in sample_names)
+
+    @staticmethod
+    def cache_key(endpoint, version):
+        return '{}:{}'.format(endpoint, version)
+
+    def key(self, endpoint, sample_names, gene_collection, *parameters):
+        """
+
+        :return: the key of the response to the request with the current data of the samples, see `version`
+        """
+        return self.cache_key(endpoint, self.version(endpoint, sample_names, gene_collection, *parameters))
+
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def get_or_set(self, key, compute):
+        """
+
+        :param key: a key made by `key`
+        :param compute: called to build the response on a miss
+        :return: the cached response, or the one just built
+        """
+        value = self.local.get(key, _MISSING)
+        if value is not _MISSING:
+            self._count('hits')
+            return value
+        if self.shared is not None:
+            value = self.shared.get(key, _MISSING)
+            if value is not _MISSING:
+                self._count('shared_hits')
+                self.local.set(key, value)
+                return value
+        self._count('misses')
+        value = compute()
+        self.local.set(key, value)
+        if self.shared is not None:
+            self.shared.set(key, value)
+        return value
+
+    def clear(self):
+        self.local.clear()
+        if self.shared is not None:
+            self.shared.clear()
+
+    def stats(self):
+        requests = self.hits + self.shared_hits + self.misses
+        return {'hits': self.hits,
+                'shared_hits': self.shared_hits,
+                'misses': self.misses,
+                'hit_ratio': (self.hits + self.shared_hits) / requests if requests else None,
+                'evictions': self.local.evictions,
+                'entries': len(self.local),
+                'bytes': self.local.bytes,
+                'max_bytes': self.local.max_bytes,
+                'shared': self.shared is not None
+                }
+
+
+response_cache = ResponseCache()
@@ -0,0 +1,33 @@
+import io
+
+import numpy
+from rest_framework import renderers
+
+
+def json_bytes(text):
+    """
+    Encodes JSON text as the JSON renderer does
+    """
+    return text.replace('\u2028', '\\u2028').replace('\u2029', '\\u2029').encode('utf-8')
+
+
+class NpzRenderer(renderers.BaseRenderer):
+    """
+    Renders a mapping as a compressed NumPy archive, one array per key, to be read with `numpy.load`. Numbers
+    are stored as float64 arrays, with None as NaN, and strings as unicode arrays
+    """
+    media_type = 'application/x-npz'
+    format = 'npz'
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        arrays = {}
+        for k, v in data.items():
+            array = numpy.array(v)
+            arrays[k] = array if array.dtype.kind in 'US' else numpy.array(v, dtype=numpy.float64)
+        output = io.BytesIO()
+        numpy.savez_compressed(output, **arrays)
+        return output.getvalue()
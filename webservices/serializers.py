@@ -1,7 +1,10 @@
+from celery import states
+from django.db import transaction
 from rest_framework import serializers
 
 from coveragedata.models import GeneCoverage
-from coveragedbingestion.models import SampleIngestion
+from coveragedbingestion.models import SampleIngestion, IngestionBatch, IngestionMetrics, BulkDeletion, \
+    ingestion_status, FINISHED_STATUSES
 
 
 class StringListField(serializers.ListField):
@@ -20,18 +23,113 @@ class AggregationQuery(object):
         self.gene_list = gene_list
 
 
+class CoverageMatrixQuerySerializer(serializers.Serializer):
+    gene_collection = serializers.CharField()
+    gene_list = StringListField()
+    stats = serializers.ListField(child=serializers.RegexField(r'^\w+$'))
+    sample_list = StringListField(required=False)
+
+    def validate_gene_list(self, gene_list):
+        if not gene_list:
+            raise serializers.ValidationError('At least one gene is required')
+        return gene_list
+
+    def validate_stats(self, stats):
+        if not stats:
+            raise serializers.ValidationError('At least one statistic is required')
+        return stats
+
+
+class IngestionMetricsSerializer(serializers.ModelSerializer):
+    sample_ingestion = serializers.SlugRelatedField(slug_field='name_slug', read_only=True)
+
+    class Meta:
+        model = IngestionMetrics
+        exclude = ['id']
+
+
 class SampleIngestionSerializer(serializers.ModelSerializer):
     status = serializers.SerializerMethodField()
+    duplicate_of = serializers.SlugRelatedField(slug_field='name_slug', read_only=True)
+    metrics = IngestionMetricsSerializer(many=True, read_only=True)
 
     class Meta:
         model = SampleIngestion
-        fields = ['name', 'input_file', 'gene_collection', 'task', 'status']
+        fields = ['name', 'name_slug', 'input_file', 'gene_collection', 'task', 'status', 'version',
+                  'genes_committed', 'content_hash', 'duplicate_of', 'seconds', 'metrics']
+        read_only_fields = ['version', 'genes_committed', 'content_hash', 'seconds']
+
+    def get_status(self, obj):
+        return ingestion_status(obj.task.status if obj.task is not None else None, obj.duplicate_of_id,
+                                obj.deletion_id)
+
+
+class IngestionBatchSerializer(serializers.ModelSerializer):
+    samples = SampleIngestionSerializer(many=True)
+    status = serializers.SerializerMethodField()
+
+    class Meta:
+        model = IngestionBatch
+        fields = ['id', 'created', 'concurrency', 'samples', 'status']
+
+    def validate_samples(self, samples):
+        keys = [(s['name'], s['gene_collection'].name) for s in samples]
+        if len(set(keys)) != len(keys):
+            raise serializers.ValidationError('The combination of sample name and gene collection must be unique')
+        return samples
+
+    def get_status(self, obj):
+        return obj.status()
+
+    def create(self, validated_data):
+        samples = validated_data.pop('samples')
+        with transaction.atomic():
+            batch = IngestionBatch.objects.create(**validated_data)
+            for sample in samples:
+                SampleIngestion.objects.create(batch=batch, **sample)
+        batch.dispatch(batch.concurrency)
+        return batch
+
+
+class BulkDeletionSerializer(serializers.ModelSerializer):
+    sample_list = StringListField(write_only=True, required=False,
+                                  help_text='Names of the samples to delete, all the samples of the gene collection '
+                                            'if not given')
+    status = serializers.SerializerMethodField()
+
+    class Meta:
+        model = BulkDeletion
+        fields = ['id', 'created', 'finished', 'gene_collection', 'sample_list', 'status', 'total_samples',
+                  'samples_deleted', 'documents_deleted']
+        read_only_fields = ['finished', 'total_samples', 'samples_deleted', 'documents_deleted']
+
+    def validate(self, data):
+        samples = SampleIngestion.objects.filter(gene_collection=data['gene_collection'], deletion__isnull=True)
+        if 'sample_list' in data:
+            samples = samples.filter(name__in=data['sample_list'])
+        in_progress = [name for name, task_status, duplicate_of in
+                       samples.values_list('name', 'task__status', 'duplicate_of')
+                       if ingestion_status(task_status, duplicate_of) not in FINISHED_STATUSES]
+        if in_progress:
+            raise serializers.ValidationError('The ingestion of these samples is in progress: {}'.format(
+                ', '.join(in_progress)))
+        # the coverage of a duplicated ingestion is that of its original
+        originals = sorted(set(SampleIngestion.objects.filter(duplicate_of__in=samples).exclude(
+            pk__in=samples).values_list('duplicate_of__name', flat=True)))
+        if originals:
+            raise serializers.ValidationError('The coverage of these samples is shared by duplicated ingestions not '
+                                              'deleted with them: {}'.format(', '.join(originals)))
+        return data
 
     def get_status(self, obj):
-        try:
-            return obj.task.status
-        except:
-            return 'NOT STARTED'
+        return obj.task.status if obj.task is not None else states.PENDING
+
+    def create(self, validated_data):
+        sample_names = validated_data.pop('sample_list', None)
+        with transaction.atomic():
+            bulk_deletion = BulkDeletion.objects.create(**validated_data)
+            bulk_deletion.start(sample_names)
+        return bulk_deletion
 
 
 class CoverageSerializer(serializers.Serializer):
@@ -1,3 +1,198 @@
+import json
+import pickle
+
+from bson import BSON
+
+from django.core.cache.backends.locmem import LocMemCache
 from django.test import TestCase
+from mock import patch, Mock
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+
+import coveragedbingestion.ingest_data as ingest_data
+from coveragedata.coverage_manager import CoverageManager
+from coveragedata.models import GeneCoverage
+from coveragedata.sample_manager import SampleManager
+from webservices.cache import LRUCache, ResponseCache, response_cache
+from webservices.renderers import json_bytes
+
+
+class TestResponseCache(TestCase):
+
+    def setUp(self):
+        self.registrations = {'sample0': 'a', 'sample1': 'b'}
+        patcher = patch.object(SampleManager, 'get_registrations',
+                               lambda _, names, gene_collection: {n: self.registrations[n] for n in names
+                                                                  if n in self.registrations})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.responses = []
+
+    def compute(self):
+        self.responses.append({'results': len(self.responses)})
+        return self.responses[-1]
+
+    def test_lru(self):
+        cache = LRUCache(10)
+        cache.set('a', b'1234')
+        cache.set('b', b'1234')
+        self.assertEqual(b'1234', cache.get('a'))
+        cache.set('c', b'1234')
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(b'1234', cache.get('a'))
+        self.assertEqual(1, cache.evictions)
+        self.assertEqual(2, len(cache))
+        self.assertEqual(8, cache.bytes)
+
+    def test_lru_bytes(self):
+        cache = LRUCache(10)
+        for key in 'abcde':
+            cache.set(key, b'12')
+        # evicts as many entries as needed to stay under the cap
+        cache.set('f', b'12345678')
+        self.assertEqual([None, b'12', b'12345678'], [cache.get(k) for k in 'def'])
+        self.assertEqual(10, cache.bytes)
+        self.assertEqual(4, cache.evictions)
+        cache.set('f', b'1')
+        self.assertEqual(3, cache.bytes)
+        # a value larger than the cache is not kept
+        cache.set('g', b'12345678901')
+        self.assertIsNone(cache.get('g'))
+        self.assertEqual(3, cache.bytes)
+        self.assertEqual(len(pickle.dumps({'results': []}, pickle.HIGHEST_PROTOCOL)), LRUCache.size({'results': []}))
+
+    def test_hit(self):
+        cache = ResponseCache(max_bytes=1024, shared=None)
+        for _ in range(3):
+            key = cache.key('gene-coverage', ['sample0'], 'groupA', ['BRCA1'], None)
+            response = cache.get_or_set(key, self.compute)
+        self.assertEqual({'results': 0}, response)
+        other = cache.get_or_set(cache.key('gene-coverage', ['sample0'], 'groupA', ['CFTR'], None), self.compute)
+        self.assertEqual({'results': 1}, other)
+        self.assertEqual({'hits': 2, 'shared_hits': 0, 'misses': 2, 'hit_ratio': 0.5, 'evictions': 0, 'entries': 2,
+                          'bytes': 2 * LRUCache.size(response), 'max_bytes': 1024, 'shared': False}, cache.stats())
+
+    def test_invalidation(self):
+        cache = ResponseCache(max_bytes=1024, shared=None)
+        keys = [cache.key('sample-metrics', ['sample0', 'sample1'], 'groupA', None),
+                cache.key('sample-metrics', ['sample1'], 'groupA', None)]
+        for key in keys:
+            cache.get_or_set(key, self.compute)
+        self.registrations['sample0'] = 'c'
+        cache.get_or_set(cache.key('sample-metrics', ['sample0', 'sample1'], 'groupA', None), self.compute)
+        cache.get_or_set(cache.key('sample-metrics', ['sample1'], 'groupA', None), self.compute)
+        del self.registrations['sample1']
+        cache.get_or_set(cache.key('sample-metrics', ['sample1'], 'groupA', None), self.compute)
+        self.assertEqual(4, len(self.responses))
+        self.assertEqual(1, cache.hits)
+
+    def test_shared(self):
+        shared = LocMemCache('test_shared', {})
+        cache = ResponseCache(max_bytes=1024, shared=shared)
+        other_process = ResponseCache(max_bytes=1024, shared=shared)
+        cache.get_or_set(cache.key('gene-coverage', ['sample0'], 'groupA', 'BRCA1'), self.compute)
+        response = other_process.get_or_set(other_process.key('gene-coverage', ['sample0'], 'groupA', 'BRCA1'),
+                                            self.compute)
+        self.assertEqual({'results': 0}, response)
+        self.assertEqual(1, other_process.shared_hits)
+        self.assertEqual(1, len(other_process.local))
+
+
+class TestConditionalGet(TestCase):
+
+    def setUp(self):
+        response_cache.clear()
+        self.registrations = {'sample0': 'a'}
+        patcher = patch.object(SampleManager, 'get_registrations', lambda _, names, gene_collection: {
+            n: self.registrations[n] for n in names if n in self.registrations})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = APIClient()
+        self.url = '/api/sample-metrics/sample0/groupA'
+
+    @patch.object(SampleManager, 'get_sample_info')
+    def test_not_modified(self, get_sample_info):
+        get_sample_info.side_effect = lambda **kwargs: Mock(**{'next.return_value': {'_id': 1, 'name': 'sample0'}})
+        response = self.client.get(self.url, format='json')
+        self.assertEqual(200, response.status_code)
+        etag = response['ETag']
+        response = self.client.get(self.url, format='json', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(304, response.status_code)
+        self.assertEqual(etag, response['ETag'])
+        self.assertEqual(b'', response.content)
+        self.assertEqual(1, get_sample_info.call_count)
+
+    @patch.object(SampleManager, 'get_sample_info')
+    def test_modified(self, get_sample_info):
+        get_sample_info.side_effect = lambda **kwargs: Mock(**{'next.return_value': {'_id': 1, 'name': 'sample0'}})
+        etag = self.client.get(self.url, format='json')['ETag']
+        self.registrations['sample0'] = 'b'
+        response = self.client.get(self.url, format='json', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, response.status_code)
+        self.assertNotEqual(etag, response['ETag'])
+        self.assertEqual(2, get_sample_info.call_count)
+
+    @patch.object(SampleManager, 'get_sample_info')
+    def test_any_etag(self, get_sample_info):
+        get_sample_info.side_effect = lambda **kwargs: Mock(**{'next.return_value': {'_id': 1, 'name': 'sample1'}})
+        response = self.client.get(self.url, format='json', HTTP_IF_NONE_MATCH='*')
+        self.assertEqual(304, response.status_code)
+        # a sample not registered has no current representation for `*` to match
+        response = self.client.get('/api/sample-metrics/sample1/groupA', format='json', HTTP_IF_NONE_MATCH='*')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(1, get_sample_info.call_count)
+
+
+class TestGeneCoverageStream(TestCase):
+
+    @patch.object(CoverageManager, 'get_sample_info')
+    def test_stream(self, get_sample_info):
+        get_sample_info.return_value = iter(
+            [{'name': 'BRCA1', 'sample': 'sample0', 'gcol': 'groupA', 'union_tr': {'stats': {'avg': 10.0}}},
+             {'name': 'CFTR', 'sample': 'sample0', 'gcol': 'groupA', 'union_tr': {'stats': {'avg': 20.0}}}])
+        query = {'sample_name': 'sample0', 'gene_collection': 'groupA', 'depth': 'union'}
+        response = APIClient().post('/api/gene-coverage/stream/', query, format='json')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('application/x-ndjson', response['Content-Type'])
+        genes = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual(['BRCA1', 'CFTR'], [g['name'] for g in genes])
+        self.assertEqual(20.0, genes[1]['union_transcript']['stats']['avg'])
+        get_sample_info.assert_called_once_with('sample0', 'groupA', None, None, None, 'union')
+
+
+class TestGeneCoverageJson(TestCase):
+
+    def setUp(self):
+        with open("../resources/test/mocked_coverage_1520552294_0.json") as fd:
+            genes = ingest_data.transform_data(json.load(fd)['results']['genes'])
+        self.documents = [BSON.encode(d).decode() for packed in (False, True)
+                          for d in ingest_data.build_coverage_document("test_sample", genes, "test", packed=packed)]
+
+    def assertSameJson(self, gene):
+        """
+        The JSON text written from the document holds the same data as the one rendered from `to_json_dict`,
+        whatever the order of the keys, and integers and floats are told apart
+        """
+        rendered = json.loads(JSONRenderer().render(gene.to_json_dict()).decode('utf-8'))
+        written = json.loads(json_bytes(gene.to_json_text()).decode('utf-8'))
+        self.assertEqual(json.dumps(rendered, sort_keys=True), json.dumps(written, sort_keys=True))
+
+    def test_json_text(self):
+        for document in self.documents:
+            self.assertSameJson(GeneCoverage(document))
+
+    def test_json_text_missing_values(self):
+        document = self.documents[0]
+        exon = document['union_tr']['exons'][0]
+        exon['stats'][1] = None
+        del exon['gaps']
+        document['union_tr']['exons'][1]['stats'] = document['union_tr']['exons'][1]['stats'][:4]
+        self.assertSameJson(GeneCoverage(document))
 
-# Create your tests here.
+    def test_json_text_nan(self):
+        # NaN is not JSON, the text fails as the renderer does instead of writing it
+        document = self.documents[0]
+        document['union_tr']['exons'][0]['stats'][0] = float('nan')
+        gene = GeneCoverage(document)
+        self.assertRaises(ValueError, JSONRenderer().render, gene.to_json_dict())
+        self.assertRaises(ValueError, gene.to_json_text)
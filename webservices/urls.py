@@ -12,6 +12,23 @@ GET_SAMPLE_INGESTION = url(
     name='get-sample-ingestion'
 )
 
+RESUME_SAMPLE_INGESTION = url(
+    regex=r'^sample-ingestion/(?P<name_and_gene_collection>[A-za-z0-9\-_]+)/resume/$',
+    view=views.SampleIngestionViewSet.as_view({'post': 'resume'}),
+    name='resume-sample-ingestion'
+)
+
+REPLACE_SAMPLE_INGESTION = url(
+    regex=r'^sample-ingestion/(?P<name_and_gene_collection>[A-za-z0-9\-_]+)/replace/$',
+    view=views.SampleIngestionViewSet.as_view({'post': 'replace'}),
+    name='replace-sample-ingestion'
+)
+
+STATUS_SAMPLE_INGESTION = url(
+    regex=r'^sample-ingestion/status/$',
+    view=views.SampleIngestionViewSet.as_view({'post': 'status'}),
+    name='status-sample-ingestion'
+)
 
 LIST_CREATE_SAMPLE_INGESTION = url(
     regex=r'^sample-ingestion/$',
@@ -19,18 +36,66 @@ LIST_CREATE_SAMPLE_INGESTION = url(
     name='list-sample-ingestion'
 )
 
+LIST_CREATE_INGESTION_BATCH = url(
+    regex=r'^ingestion-batch/$',
+    view=views.IngestionBatchViewSet.as_view({'get': 'list', 'post': 'create'}),
+    name='list-ingestion-batch'
+)
+
+GET_INGESTION_BATCH = url(
+    regex=r'^ingestion-batch/(?P<pk>[0-9]+)/$',
+    view=views.IngestionBatchViewSet.as_view({'get': 'retrieve'}),
+    name='get-ingestion-batch'
+)
+
+LIST_CREATE_BULK_DELETION = url(
+    regex=r'^bulk-deletion/$',
+    view=views.BulkDeletionViewSet.as_view({'get': 'list', 'post': 'create'}),
+    name='list-bulk-deletion'
+)
+
+GET_BULK_DELETION = url(
+    regex=r'^bulk-deletion/(?P<pk>[0-9]+)/$',
+    view=views.BulkDeletionViewSet.as_view({'get': 'retrieve'}),
+    name='get-bulk-deletion'
+)
+
+LIST_INGESTION_METRICS = url(
+    regex=r'^ingestion-metrics/$',
+    view=views.IngestionMetricsViewSet.as_view({'get': 'list'}),
+    name='list-ingestion-metrics'
+)
+
+SUMMARY_INGESTION_METRICS = url(
+    regex=r'^ingestion-metrics/summary/$',
+    view=views.IngestionMetricsViewSet.as_view({'get': 'summary'}),
+    name='summary-ingestion-metrics'
+)
+
 LIST_GENE_COVERAGE = url(
     regex=r'^gene-coverage/$',
     view=views.GeneCoverageView.as_view({'post': 'list'}),
     name='gene-coverage-list'
 )
 
+STREAM_GENE_COVERAGE = url(
+    regex=r'^gene-coverage/stream/$',
+    view=views.GeneCoverageView.as_view({'post': 'stream'}),
+    name='gene-coverage-stream'
+)
+
 GET_GENE_COVERAGE = url(
     regex=r'^gene-coverage/(?P<sample_name>[A-za-z0-9\-_]+)/(?P<gene_collection>[A-za-z0-9\-_]+)/(?P<gene>[A-za-z0-9\-_]+)/$',
     view=views.GeneCoverageView.as_view({'get': 'retrieve'}),
     name='gene-coverage-detail'
 )
 
+LIST_COVERAGE_MATRIX = url(
+    regex=r'^coverage-matrix/$',
+    view=views.CoverageMatrixView.as_view({'post': 'list'}),
+    name='coverage-matrix-list'
+)
+
 LIST_SAMPLE_METRICS = url(
     regex=r'^sample-metrics/$',
     view=views.SampleMetricsView.as_view({'post': 'list'}),
@@ -43,6 +108,24 @@ GET_SAMPLE_METRICS = url(
     name='sample-metrics-detail'
 )
 
+GET_COVERAGE_CACHE = url(
+    regex=r'^coverage-cache/$',
+    view=views.CoverageCacheView.as_view({'get': 'list'}),
+    name='coverage-cache'
+)
+
+GET_MONGO_POOL = url(
+    regex=r'^mongo-pool/$',
+    view=views.MongoPoolView.as_view({'get': 'list'}),
+    name='mongo-pool'
+)
+
+LIST_GENE_AGGREGATES = url(
+    regex=r'^gene-aggregates/$',
+    view=views.AggregationsView.as_view({'post': 'aggregated_by_gene'}),
+    name='gene-aggregates-list'
+)
+
 schema_view = get_schema_view(
    openapi.Info(
       title="Calypso",
@@ -53,11 +136,25 @@ schema_view = get_schema_view(
 )
 
 urls = [LIST_CREATE_SAMPLE_INGESTION,
+        STATUS_SAMPLE_INGESTION,
         GET_SAMPLE_INGESTION,
+        RESUME_SAMPLE_INGESTION,
+        REPLACE_SAMPLE_INGESTION,
+        LIST_CREATE_INGESTION_BATCH,
+        GET_INGESTION_BATCH,
+        LIST_CREATE_BULK_DELETION,
+        GET_BULK_DELETION,
+        LIST_INGESTION_METRICS,
+        SUMMARY_INGESTION_METRICS,
+        STREAM_GENE_COVERAGE,
         GET_GENE_COVERAGE,
         LIST_GENE_COVERAGE,
+        LIST_COVERAGE_MATRIX,
         GET_SAMPLE_METRICS,
         LIST_SAMPLE_METRICS,
+        GET_COVERAGE_CACHE,
+        GET_MONGO_POOL,
+        LIST_GENE_AGGREGATES,
         url(r'^docs/$', schema_view.with_ui('swagger', cache_timeout=None), name='schema-swagger-ui')
         ]
 
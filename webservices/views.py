@@ -1,13 +1,25 @@
+from celery import states
+from django.db.models import ProtectedError
+from django.http import HttpResponse, StreamingHttpResponse
 from django.urls import reverse_lazy
+from django.utils.http import parse_etags, quote_etag
+from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
-from rest_framework import viewsets, mixins, pagination
+from rest_framework import viewsets, mixins, pagination, status, renderers
 from rest_framework.decorators import list_route, detail_route
+from rest_framework.exceptions import ValidationError
 
-from coveragedata.models import GeneCoverage
+from coveragedb.settings import INGESTION_STATUS_MAX_WAIT
+from coveragedata.models import GeneCoverage, CoverageMatrix, encode_json
+from coveragedata.mongo import mongo_clients
 from coveragedata.sample_manager import SampleManager
-from coveragedata.coverage_manager import CoverageManager
-from coveragedbingestion.models import SampleIngestion
-from webservices.serializers import SampleIngestionSerializer, CoverageSerializer, SampleCoverageSerializer
+from coveragedata.coverage_manager import CoverageManager, COVERAGE_DEPTH_PROJECTIONS, DEFAULT_COVERAGE_DEPTH
+from coveragedbingestion.models import SampleIngestion, IngestionBatch, IngestionMetrics, BulkDeletion, \
+    FINISHED_STATUSES, DELETING
+from webservices.cache import response_cache
+from webservices.renderers import NpzRenderer, json_bytes
+from webservices.serializers import SampleIngestionSerializer, CoverageSerializer, SampleCoverageSerializer, \
+    IngestionBatchSerializer, IngestionMetricsSerializer, BulkDeletionSerializer, CoverageMatrixQuerySerializer
 
 
 class SampleIngestionViewSet(mixins.CreateModelMixin,
@@ -24,7 +36,8 @@ class SampleIngestionViewSet(mixins.CreateModelMixin,
     list SampleIngestion data.
 
     delete:
-    Delete the Coverage data associated to a sample for a gene collection
+    Delete the Coverage data associated to a sample for a gene collection. Samples whose content was ingested again
+    for other samples, which were skipped as duplicates, cannot be deleted before them
 
     create:
     Trigger the ingestion of Coverage data, given a file a sample and a gene collection.
@@ -33,12 +46,145 @@ class SampleIngestionViewSet(mixins.CreateModelMixin,
     the same sample and same gene collection more than once before to delete
     the first one.
 
+    resume:
+    Send again a failed ingestion, it continues after the genes already stored
+
+    replace:
+    Ingest a new coverage file, given in `input_file`, for a sample already ingested. The current data is returned
+    by queries until the new data is complete, then queries switch to it at once. If the new ingestion fails the
+    current data stays.
+
+    status:
+    Return the status of many ingestions at once given their `name_slug`. Send `samples` as a list of slugs to
+    get their status straight away, or as a map from slug to the status you already know along with `timeout` in
+    seconds to wait until any of them changes or all of them finish.
+
     """
-    queryset = SampleIngestion.objects.all()
+    queryset = SampleIngestion.objects.prefetch_related('metrics')
     serializer_class = SampleIngestionSerializer
     lookup_field = 'name_slug'
     lookup_url_kwarg = 'name_and_gene_collection'
 
+    def destroy(self, request, *args, **kwargs):
+        try:
+            return super(SampleIngestionViewSet, self).destroy(request, *args, **kwargs)
+        except ProtectedError as ex:
+            return Response({'detail': ex.args[0]}, status=status.HTTP_409_CONFLICT)
+
+    @detail_route(methods=['post'])
+    def resume(self, request, name_and_gene_collection=None):
+        sample_ingestion = self.get_object()
+        if sample_ingestion.task is None or sample_ingestion.task.status != states.FAILURE:
+            return Response({'detail': 'Only failed ingestions can be resumed'}, status=status.HTTP_409_CONFLICT)
+        sample_ingestion.resume()
+        return Response(self.get_serializer(sample_ingestion).data, status=status.HTTP_202_ACCEPTED)
+
+    @detail_route(methods=['post'])
+    def replace(self, request, name_and_gene_collection=None):
+        sample_ingestion = self.get_object()
+        input_file = request.data.get('input_file')
+        if not input_file:
+            return Response({'detail': '`input_file` is required'}, status=status.HTTP_400_BAD_REQUEST)
+        current_status = self.get_serializer(sample_ingestion).data['status']
+        if current_status not in FINISHED_STATUSES or current_status == DELETING:
+            return Response({'detail': 'Only finished ingestions can be replaced'}, status=status.HTTP_409_CONFLICT)
+        sample_ingestion.replace(input_file)
+        return Response(self.get_serializer(sample_ingestion).data, status=status.HTTP_202_ACCEPTED)
+
+    @list_route(methods=['post'])
+    def status(self, request):
+        samples = request.data.get('samples')
+        if isinstance(samples, list):
+            known = {slug: None for slug in samples}
+        elif isinstance(samples, dict):
+            known = samples
+        else:
+            return Response({'detail': '`samples` must be a list of slugs or a map from slug to status'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        try:
+            timeout = min(max(float(request.data.get('timeout', 0)), 0.0), INGESTION_STATUS_MAX_WAIT)
+        except (TypeError, ValueError):
+            return Response({'detail': '`timeout` must be a number of seconds'}, status=status.HTTP_400_BAD_REQUEST)
+        statuses = SampleIngestion.wait_statuses(known, timeout)
+        return Response({slug: statuses.get(slug) for slug in known})
+
+
+class IngestionBatchViewSet(mixins.CreateModelMixin,
+                            mixins.ListModelMixin,
+                            mixins.RetrieveModelMixin,
+                            viewsets.GenericViewSet):
+    """
+
+    retrieve:
+    Return an ingestion batch with its aggregated status: number of samples in each state, throughput and ETA
+
+    list:
+    list ingestion batches.
+
+    create:
+    Trigger the ingestion of many samples at once, given a manifest of samples, files and gene collections.
+    All sample ingestions are created at once and ingested with at most `concurrency` samples in progress.
+
+    """
+    queryset = IngestionBatch.objects.all()
+    serializer_class = IngestionBatchSerializer
+
+
+class BulkDeletionViewSet(mixins.CreateModelMixin,
+                          mixins.ListModelMixin,
+                          mixins.RetrieveModelMixin,
+                          viewsets.GenericViewSet):
+    """
+
+    retrieve:
+    Return a bulk deletion with its progress: samples and coverage documents deleted so far
+
+    list:
+    list bulk deletions.
+
+    create:
+    Delete the coverage data of a whole gene collection, or of the samples in `sample_list`, at once. The data is
+    hidden straight away and removed in the background, the samples can be ingested again once the deletion is
+    finished.
+
+    """
+    queryset = BulkDeletion.objects.all()
+    serializer_class = BulkDeletionSerializer
+
+
+class IngestionMetricsViewSet(mixins.ListModelMixin,
+                              viewsets.GenericViewSet):
+    """
+
+    list:
+    list the metrics of every ingestion attempt: seconds per stage, bytes read, genes, transcripts and exons
+    processed, documents written and MongoDB batch latencies. Filter them by `gene_collection`, `batch` and
+    `succeeded`.
+
+    summary:
+    Aggregate the metrics of the ingestion attempts, with the same filters as list, and report the bottleneck
+    stage, the one taking the largest share of the time.
+
+    """
+    serializer_class = IngestionMetricsSerializer
+
+    def get_queryset(self):
+        queryset = IngestionMetrics.objects.select_related('sample_ingestion')
+        gene_collection = self.request.query_params.get('gene_collection')
+        if gene_collection is not None:
+            queryset = queryset.filter(sample_ingestion__gene_collection=gene_collection)
+        batch = self.request.query_params.get('batch')
+        if batch is not None:
+            queryset = queryset.filter(sample_ingestion__batch=batch)
+        succeeded = self.request.query_params.get('succeeded')
+        if succeeded is not None:
+            queryset = queryset.filter(succeeded=succeeded.lower() == 'true')
+        return queryset.order_by('pk')
+
+    @list_route(methods=['get'])
+    def summary(self, request):
+        return Response(IngestionMetrics.summary(self.get_queryset()))
+
 
 class GeneCoveragePagination(pagination.BasePagination):
     def get_paginated_response(self, data):
@@ -66,12 +212,60 @@ class SampleMetricsPagination(pagination.BasePagination):
         return None
 
 
-class GeneCoverageView(viewsets.ViewSet):
+class CachedResponseMixin(object):
+    """
+    Serves responses from the response cache. Responses of GET requests carry a strong ETag derived from the
+    registration of their samples, and requests whose `If-None-Match` matches it are answered with 304 before
+    reading any coverage
+    """
+
+    def cached_response(self, request, compute, endpoint, sample_names, gene_collection, *parameters):
+        """
+
+        :param compute: called on a miss to build the response data, or its JSON text when called with True
+        :param endpoint: the name of the endpoint
+        :param sample_names: the samples of the response
+        :param gene_collection: the gene collection of the response
+        :param parameters: any other parameter of the request the response depends on
+        """
+        version, registered = response_cache.registered_version(endpoint, sample_names, gene_collection, *parameters)
+        as_json = request.accepted_renderer.format == JSONRenderer.format
+        etag = None
+        if request.method == 'GET':
+            # the same data is rendered differently by every renderer
+            etag = quote_etag('{}-{}'.format(version, request.accepted_renderer.format))
+            etags = parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))
+            # `*` matches any current representation, there is none while a sample is not registered (RFC 7232)
+            if ('*' in etags and registered) or etag in etags or 'W/' + etag in etags:
+                response = Response(status=status.HTTP_304_NOT_MODIFIED)
+                response['ETag'] = etag
+                return response
+        if as_json:
+            # JSON is written by the view and cached already encoded, neither serializers nor renderers run
+            content = response_cache.get_or_set(response_cache.cache_key(endpoint + '.json', version),
+                                                lambda: json_bytes(compute(True)))
+            response = HttpResponse(content, content_type=JSONRenderer.media_type)
+        else:
+            response = Response(response_cache.get_or_set(response_cache.cache_key(endpoint, version),
+                                                          lambda: compute(False)))
+        if etag is not None:
+            response['ETag'] = etag
+        return response
+
+
+class GeneCoverageView(CachedResponseMixin, viewsets.ViewSet):
     """
 
     list:
     Lists Coverage metrics for one sample and a given list of genes
 
+    stream:
+    Same as list but returns all the genes at once, or all the genes of the sample if `gene_list` is not given,
+    read by a single query and streamed as they are read as newline delimited JSON, one gene per line
+
+    `depth`, in the body of list and in the query string of retrieve, limits the parts of the genes read:
+    `union` for the statistics of the union transcript, `union_exons` for the union transcript with its exons,
+    `stats` for the statistics of the union transcript and of every transcript, `all` for everything (default)
 
     """
     model = GeneCoverage
@@ -79,11 +273,17 @@ class GeneCoverageView(viewsets.ViewSet):
     page_size = 100
     pagination = GeneCoveragePagination()
 
-    def get_sample_page(self, sample_name, gene_collection, gene_list, last_gene):
-        return self.model.list(sample_name, gene_list, gene_collection, last_gene, limit=self.page_size)
+    def get_sample_page(self, sample_name, gene_collection, gene_list, last_gene, depth=DEFAULT_COVERAGE_DEPTH):
+        return self.model.list(sample_name, gene_list, gene_collection, last_gene, limit=self.page_size, depth=depth)
+
+    def get_sample_gene_info(self, sample, gene_collection, gene, depth=DEFAULT_COVERAGE_DEPTH):
+        return self.model.get(sample=sample, gene_collection=gene_collection, gene_name=gene, depth=depth)
 
-    def get_sample_gene_info(self, sample, gene_collection, gene):
-        return self.model.get(sample=sample, gene_collection=gene_collection, gene_name=gene)
+    @staticmethod
+    def validate_depth(depth):
+        if depth not in COVERAGE_DEPTH_PROJECTIONS:
+            raise ValidationError({'depth': 'Must be one of {}'.format(', '.join(sorted(COVERAGE_DEPTH_PROJECTIONS)))})
+        return depth
 
     def get_serializer_context(self):
         """
@@ -102,21 +302,70 @@ class GeneCoverageView(viewsets.ViewSet):
 
     @list_route(methods=['post'])
     def list(self, request):
+        depth = self.validate_depth(request.data.get('depth', DEFAULT_COVERAGE_DEPTH))
+        sample_name = request.data.get('sample_name', '')
+        gene_collection = request.data.get('gene_collection', '')
+        gene_list = request.data.get('gene_list', [])
+        last_gene = request.query_params.get('page')
+
+        def page(as_json):
+            r = self.get_sample_page(sample_name, gene_collection, gene_list, last_gene, depth)
+            if as_json:
+                genes = list(r)
+                next_link = self.pagination.get_next_link([[{'name': g.name} for g in genes], self.page_size])
+                return '{"next":' + encode_json(next_link) + ',"results":[' + \
+                       ','.join([g.to_json_text() for g in genes]) + ']}'
+            s = self.serializer(instance=r, many=True)
+            return self.pagination.get_paginated_response([s.data, self.page_size]).data
+
+        return self.cached_response(request, page, 'gene-coverage-list', [sample_name], gene_collection, gene_list,
+                                    last_gene, depth)
 
-        r = self.get_sample_page(request.data.get('sample_name', ''), request.data.get('gene_collection', ''),
-                                 request.data.get('gene_list', []), request.query_params.get('page')
-                                 )
-        s = self.serializer(instance=r, many=True)
-        paginated_response = self.pagination.get_paginated_response([s.data, self.page_size])
-        return paginated_response
+    @list_route(methods=['post'])
+    def stream(self, request):
+        depth = self.validate_depth(request.data.get('depth', DEFAULT_COVERAGE_DEPTH))
+        genes = self.model.list(request.data.get('sample_name', ''), request.data.get('gene_list'),
+                                request.data.get('gene_collection', ''), depth=depth)
+        lines = (json_bytes(gene.to_json_text() + '\n') for gene in genes)
+        return StreamingHttpResponse(lines, content_type='application/x-ndjson')
 
     def retrieve(self, request, sample_name, gene_collection, gene):
-        r = self.get_sample_gene_info([sample_name], gene_collection, gene)
-        s = self.serializer(instance=r, many=False)
-        return Response(s.data)
+        depth = self.validate_depth(request.query_params.get('depth', DEFAULT_COVERAGE_DEPTH))
+
+        def gene_info(as_json):
+            r = self.get_sample_gene_info([sample_name], gene_collection, gene, depth)
+            if as_json and r is not None:
+                return r.to_json_text()
+            data = self.serializer(instance=r, many=False).data
+            return encode_json(data) if as_json else data
 
+        return self.cached_response(request, gene_info, 'gene-coverage-detail', [sample_name], gene_collection, gene,
+                                    depth)
 
-class SampleMetricsView(viewsets.ViewSet):
+
+class CoverageMatrixView(viewsets.ViewSet):
+    """
+
+    list:
+    Return the `stats` of the union transcript of the genes in `gene_list` for the samples in `sample_list`, or for
+    every sample of `gene_collection` if not given, read by a single query. `values` holds one matrix per
+    statistic, with a row per sample and a column per gene, null when a gene is not covered in a sample. Add
+    `?format=npz` to get a compressed NumPy archive with the arrays `samples`, `genes`, `stats` and `values`,
+    the latter of shape (stats, samples, genes) with NaN for missing values.
+
+    """
+    model = CoverageMatrix
+    renderer_classes = (renderers.JSONRenderer, renderers.BrowsableAPIRenderer, NpzRenderer)
+
+    def list(self, request):
+        query = CoverageMatrixQuerySerializer(data=request.data)
+        query.is_valid(raise_exception=True)
+        matrix = self.model.get(query.validated_data.get('sample_list'), query.validated_data['gene_collection'],
+                                query.validated_data['gene_list'], query.validated_data['stats'])
+        return Response(matrix.to_json_dict())
+
+
+class SampleMetricsView(CachedResponseMixin, viewsets.ViewSet):
     """
 
     """
@@ -147,24 +396,68 @@ class SampleMetricsView(viewsets.ViewSet):
 
     @list_route(methods=['post'])
     def list(self, request):
-
-        r = self.get_sample_page(gene_collection=request.data.get('gene_collection', ''),
-                                 sample_list=request.data.get('sample_list', []),
-                                 last_sample=request.query_params.get('page')
-                                 )
-        s = self.serializer(instance=r, many=True)
-        paginated_response = self.pagination.get_paginated_response([s.data, self.page_size])
-        return paginated_response
+        gene_collection = request.data.get('gene_collection', '')
+        sample_list = request.data.get('sample_list', [])
+        last_sample = request.query_params.get('page')
+
+        def page(as_json):
+            r = self.get_sample_page(gene_collection=gene_collection, sample_list=sample_list,
+                                     last_sample=last_sample)
+            if as_json:
+                samples = list(r)
+                for sample in samples:
+                    sample.pop('_id')
+                return encode_json({'next': self.pagination.get_next_link([samples, self.page_size]),
+                                    'results': samples})
+            s = self.serializer(instance=r, many=True)
+            return self.pagination.get_paginated_response([s.data, self.page_size]).data
+
+        return self.cached_response(request, page, 'sample-metrics-list', sample_list, gene_collection, last_sample)
 
     def retrieve(self, request, sample_name, gene_collection):
-        r = self.get_sample_page([sample_name], gene_collection)
-        s = self.serializer(instance=r.next(), many=False)
-        return Response(s.data)
+
+        def sample_info(as_json):
+            r = self.get_sample_page([sample_name], gene_collection)
+            data = self.serializer(instance=r.next(), many=False).data
+            return encode_json(data) if as_json else data
+
+        return self.cached_response(request, sample_info, 'sample-metrics-detail', [sample_name], gene_collection)
+
+
+class CoverageCacheView(viewsets.ViewSet):
+    """
+
+    list:
+    Return the counters of the cache of the gene coverage and sample metrics endpoints in the process serving the
+    request: hits in the in-process tier, hits in the shared tier, misses and evictions
+
+    """
+
+    def list(self, request):
+        return Response(response_cache.stats())
+
+
+class MongoPoolView(viewsets.ViewSet):
+    """
+
+    list:
+    Return the options of the MongoDB client of the process serving the request and the usage of its connection
+    pools: connections open and in use, the most in use at once, checkouts and failed checkouts
+
+    """
+
+    def list(self, request):
+        return Response(mongo_clients.stats())
 
 
 class AggregationsView(viewsets.ViewSet):
     """
 
+    aggregated_by_gene:
+    Return for every gene in `gene_list` the number of samples and the mean, standard deviation, minimum and maximum
+    of every statistic of its union transcript across the samples of `gene_collection`, or of every gene
+    collection if not given. `stale` tells that minimum and maximum may include deleted samples.
+
     """
     coverage_manager = CoverageManager()
 
@@ -183,7 +476,8 @@ class AggregationsView(viewsets.ViewSet):
         kwargs['context'] = self.get_serializer_context()
         return serializer_class(*args, **kwargs)
 
+    @list_route(methods=['post'])
     def aggregated_by_gene(self, request):
-        self.cover
-        results = self.coverage_manager.get_aggregated_by_gene(request.data.get('gene_list', []))
-        return results
+        results = self.coverage_manager.get_aggregated_by_gene(request.data.get('gene_list', []),
+                                                               request.data.get('gene_collection'))
+        return Response(results)